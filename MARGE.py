@@ -18,6 +18,8 @@ import loader  as L
 import NN
 import stats   as S
 import utils   as U
+import server  as SV
+import retrieval as R
 
 
 def MARGE(confile):
@@ -69,9 +71,18 @@ def MARGE(confile):
             U.make_dir(os.path.join(datadir, 'train', ''))
             U.make_dir(os.path.join(datadir, 'valid', ''))
             U.make_dir(os.path.join(datadir, 'test', ''))
+            if "cachedir" in conf and conf["cachedir"] not in ["None", ""]:
+                if not os.path.isabs(conf["cachedir"]):
+                    cachedir = os.path.join(outputdir, conf["cachedir"], '')
+                else:
+                    cachedir = os.path.join(           conf["cachedir"], '')
+            else:
+                cachedir = None
             U.make_dir(preddir)
             U.make_dir(os.path.join(preddir, 'valid', ''))
             U.make_dir(os.path.join(preddir, 'test', ''))
+            if cachedir is not None:
+                U.make_dir(cachedir)
 
             # Main options
             datagen     = conf.getboolean("datagen")
@@ -79,6 +90,18 @@ def MARGE(confile):
             processdat  = conf.getboolean("processdat")
             preservedat = conf.getboolean("preservedat")
             NNmodel     = conf.getboolean("NNmodel")
+            if "predict" in conf:
+                predict = conf.getboolean("predict")
+            else:
+                predict = False
+            if "serve" in conf:
+                serve = conf.getboolean("serve")
+            else:
+                serve = False
+            if "retrieve" in conf:
+                retrieve = conf.getboolean("retrieve")
+            else:
+                retrieve = False
             gridsearch  = conf.getboolean("gridsearch")
             trainflag   = conf.getboolean("trainflag")
             validflag   = conf.getboolean("validflag")
@@ -87,7 +110,83 @@ def MARGE(confile):
             TFRfile     = conf["TFR_file"]
             if TFRfile != '':
                 TFRfile = TFRfile + '_' # Separator for file names
+            if "TFR_block" in conf:
+                TFRblock = conf.getint("TFR_block")
+            else:
+                TFRblock = 0 # One case per record
+            if "dtype" in conf:
+                dtype = np.dtype(conf["dtype"])
+                if dtype not in [np.float16, np.float32, np.float64]:
+                    raise ValueError("dtype must be float16, float32, or " + \
+                                     "float64.")
+            else:
+                dtype = np.dtype(np.float64)
             buffer_size = conf.getint("buffer")
+            if "shuffle_buffer" in conf:
+                shuffle_buffer = conf.getint("shuffle_buffer")
+            else:
+                shuffle_buffer = buffer_size
+            if "pred_dtype" in conf:
+                pred_dtype = conf["pred_dtype"]
+                if pred_dtype not in ['float32', 'float64']:
+                    raise ValueError("Invalid pred_dtype: " + pred_dtype + \
+                                     "\nAllowed options: float32, float64")
+                pred_dtype = np.dtype(pred_dtype)
+            else:
+                pred_dtype = np.float64
+            if "savepred" in conf:
+                savepred = conf.getboolean("savepred")
+            else:
+                savepred = True
+            if "queue_depth" in conf:
+                queue_depth = conf.getint("queue_depth")
+                if queue_depth < 0:
+                    raise ValueError("queue_depth must be >= 0.")
+            else:
+                queue_depth = 4
+            if "recompute_metrics" in conf:
+                recompute_metrics = conf.getboolean("recompute_metrics")
+            else:
+                recompute_metrics = False
+            if "checksum" in conf:
+                checksum = conf.getboolean("checksum")
+            else:
+                checksum = False
+            if "export" in conf:
+                export = conf["export"].split()
+                for fmt in export:
+                    if fmt not in ['npz', 'onnx']:
+                        raise ValueError("export format not understood: " + \
+                                         fmt + "\nAllowed options: npz, onnx")
+            else:
+                export = []
+            if "onnx_threads" in conf:
+                onnx_threads = conf.getint("onnx_threads")
+            else:
+                onnx_threads = 1
+            if "bench_inference" in conf:
+                bench_inference = conf.getboolean("bench_inference")
+            else:
+                bench_inference = False
+            if "backend" in conf:
+                backend = conf["backend"]
+                if backend not in ['tfrecord', 'packed']:
+                    raise ValueError("Invalid backend: " + backend + \
+                                     "\nAllowed options: tfrecord, packed")
+            else:
+                backend = 'tfrecord'
+            if "cache" in conf:
+                cache = conf["cache"]
+            else:
+                cache = 'auto'
+            if "TFR_readers" in conf:
+                TFRreaders = conf.getint("TFR_readers")
+            else:
+                TFRreaders = 1
+            if "TFR_interleave" in conf:
+                TFRinterleave = conf.getint("TFR_interleave")
+            else:
+                TFRinterleave = 1
             ncores      = conf.getint("ncores")
             if  ncores  > os.cpu_count():
                 ncores  = os.cpu_count()
@@ -174,6 +273,8 @@ def MARGE(confile):
                 weight_file = conf["weight_file"]
             epochs      = conf.getint("epochs")
             batch_size  = conf.getint("batch_size")
+            if TFRblock and batch_size % TFRblock:
+                raise ValueError("TFR_block must evenly divide batch_size.")
             patience    = conf.getint("patience")
             if gridsearch:
                 architectures = conf["architectures"].split('\n')
@@ -313,6 +414,80 @@ def MARGE(confile):
             ylabel     = conf["ylabel"]
             plot_cases = [int(num) for num in conf["plot_cases"].split()]
 
+            # Batch inference settings
+            if predict:
+                if gridsearch:
+                    raise ValueError("predict mode requires a single " + \
+                                     "architecture, not a grid search.")
+                if not os.path.isabs(conf["predict_input"]):
+                    predict_input = inputdir + conf["predict_input"]
+                else:
+                    predict_input = conf["predict_input"]
+                if "predict_output" in conf:
+                    if not os.path.isabs(conf["predict_output"]):
+                        predict_output = outputdir + conf["predict_output"]
+                    else:
+                        predict_output = conf["predict_output"]
+                else:
+                    predict_output = outputdir + 'predictions.npy'
+                if "predict_chunk" in conf:
+                    predict_chunk = conf.getint("predict_chunk")
+                else:
+                    predict_chunk = 10000
+
+            # Inference server settings
+            if serve:
+                if gridsearch:
+                    raise ValueError("serve mode requires a single " + \
+                                     "architecture, not a grid search.")
+                if "serve_host" in conf:
+                    serve_host = conf["serve_host"]
+                else:
+                    serve_host = '127.0.0.1'
+                if "serve_port" in conf:
+                    serve_port = conf.getint("serve_port")
+                else:
+                    serve_port = 8000
+                if "serve_max_batch" in conf:
+                    serve_max_batch = conf.getint("serve_max_batch")
+                else:
+                    serve_max_batch = 256
+                if "serve_max_latency" in conf:
+                    serve_max_latency = conf.getfloat("serve_max_latency")
+                else:
+                    serve_max_latency = 2.
+
+            # Retrieval settings
+            if retrieve:
+                if gridsearch:
+                    raise ValueError("retrieve mode requires a single " + \
+                                     "architecture, not a grid search.")
+                if not os.path.isabs(conf["retrieval_cfg"]):
+                    retrieval_cfg = inputdir + conf["retrieval_cfg"]
+                else:
+                    retrieval_cfg = conf["retrieval_cfg"]
+                if "predcache" in conf:
+                    predcache = conf.getboolean("predcache")
+                else:
+                    predcache = False
+                if "predcache_size" in conf:
+                    predcache_size = conf.getfloat("predcache_size")
+                else:
+                    predcache_size = 64.
+                if "predcache_quantum" in conf:
+                    predcache_quantum = np.array([float(num) for num in 
+                                           conf["predcache_quantum"].split()])
+                else:
+                    predcache_quantum = None
+                if "predcache_policy" in conf:
+                    predcache_policy = conf["predcache_policy"]
+                    if predcache_policy not in ['lru', 'fifo']:
+                        raise ValueError("Invalid predcache_policy: " + \
+                                         predcache_policy + \
+                                         "\nAllowed options: lru, fifo")
+                else:
+                    predcache_policy = 'lru'
+
             # Generate data set
             if datagen:
                 print('\nMode: Generate data\n')
@@ -320,7 +495,11 @@ def MARGE(confile):
 
             if processdat:
                 print('\nMode: Process data\n')
-                D.process_data(inputdir+cfile, datadir, preservedat)
+                if "dtype" in conf:
+                    D.process_data(inputdir+cfile, datadir, preservedat, 
+                                   dtype=dtype)
+                else:
+                    D.process_data(inputdir+cfile, datadir, preservedat)
 
             # Train a model
             if NNmodel:
@@ -337,7 +516,44 @@ def MARGE(confile):
                           lengthscale, max_lr, clr_mode, clr_steps, 
                           epochs, patience, weight_file, resume, 
                           plot_cases, fxvals, xlabel, ylabel, 
-                          filters, filt2um)
+                          filters, filt2um, TFRblock, dtype, 
+                          TFRreaders, TFRinterleave, shuffle_buffer, 
+                          cache, cachedir, backend, pred_dtype, savepred, 
+                          queue_depth, export, onnx_threads, 
+                          bench_inference, recompute_metrics, checksum)
+
+            # Predict for an array of inputs
+            if predict:
+                print('\nMode: Predict\n')
+                NN.predict(inputdir, predict_input, predict_output, 
+                           normalize, fmean, fstdev, 
+                           scale, fmin, fmax, scalelims, 
+                           inD, outD, ilog, olog, 
+                           layers, lay_params, activations, nodes, 
+                           weight_file, ncores, predict_chunk, pred_dtype)
+
+            # Serve predictions over HTTP
+            if serve:
+                print('\nMode: Serve\n')
+                fexport = NN.export_engine(inputdir, normalize, fmean, fstdev, 
+                                           scale, fmin, fmax, scalelims, 
+                                           inD, outD, ilog, olog, 
+                                           layers, lay_params, activations, 
+                                           nodes, weight_file)
+                SV.serve(fexport, serve_host, serve_port, 
+                         serve_max_batch, serve_max_latency)
+
+            # Retrieve with the model in place of radiative transfer
+            if retrieve:
+                print('\nMode: Retrieve\n')
+                fexport = NN.export_engine(inputdir, normalize, fmean, fstdev, 
+                                           scale, fmin, fmax, scalelims, 
+                                           inD, outD, ilog, olog, 
+                                           layers, lay_params, activations, 
+                                           nodes, weight_file)
+                R.retrieve(retrieval_cfg, fexport, np.load(fxvals), 
+                           filters, filt2um, seed, predcache, predcache_size, 
+                           predcache_quantum, predcache_policy)
 
     return
 
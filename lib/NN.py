@@ -3,6 +3,18 @@ Contains classes/functions related to NN models.
 
 NNModel: class that builds out a specified NN.
 
+build_layers: function that builds the layers of an NN.
+
+load_stats: function that loads the values to normalize and scale the data.
+
+predict: function that predicts the outputs for an array of inputs.
+
+jacobian: function that computes the Jacobian of the outputs with respect to 
+          the inputs, in physical units.
+
+export_engine: function that exports a trained model for the NumPy engine, 
+               if needed.
+
 driver: function that handles data & model initialization, and 
         trains/validates/tests the model.
 
@@ -36,15 +48,17 @@ from keras import initializers
 import tensorflow as tf
 from tensorflow.python import debug as tf_debug
 
-import onnx
-import keras2onnx
-from   onnx2keras import onnx_to_keras
-
 import callbacks as C
 import loader    as L
 import utils     as U
 import plotter   as P
 import stats     as S
+import prepare   as PR
+import catalog   as CA
+import packed    as PK
+import engine    as E
+import onnxengine as O
+import benchmark  as BM
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '1'
 
@@ -56,6 +70,12 @@ class NNModel:
     __init__: Initialization of the NN model.
 
     train: Trains the NN model.
+
+    attach_eval: Attaches unshuffled evaluation data pipelines to the model.
+
+    Yeval: Saves out the true or predicted Y values of a data set.
+
+    evaluate: Evaluates the model on a data set.
     """
     
     def __init__(self, ftrain_TFR, fvalid_TFR, ftest_TFR, 
@@ -69,11 +89,18 @@ class NNModel:
                  weight_file = 'weights.h5', stop_file = './STOP', 
                  train_flag = True, 
                  epsilon=1e-6, 
-                 debug=False, shuffle=False, resume=False):
+                 debug=False, shuffle=False, resume=False, 
+                 TFRblock=0, dtype=np.float64, 
+                 readers=1, interleave=1, shuffle_buffer=None, 
+                 cache='auto', cachedir=None, backend='tfrecord'):
         """
         ftrain_TFR : list, strings. TFRecords for the training   data.
+                                    If `backend` is 'packed', path/to/packed 
+                                    training data .npy
         fvalid_TFR : list, strings. TFRecords for the validation data.
+                                    As above for the packed validation data.
         ftest_TFR  : list, strings. TFRecords for the test       data.
+                                    As above for the packed test data.
         xlen       : int.   Dimensionality of the inputs.
         ylen       : int.   Dimensionality of the outputs.
         olog       : bool.  Determines if the target values are log10-scaled.
@@ -111,6 +138,22 @@ class NNModel:
         debug      : bool.  If True, turns on Tensorflow's debugger.
         shuffle    : bool.  Determines whether to shuffle the data.
         resume     : bool.  Determines whether to resume training a model.
+        TFRblock   : int.   Number of cases per TFRecords record.
+                            If 0, each record holds a single case.
+        dtype      : data type. Data type of the data stored in the TFRecords.
+        readers    : int.   Number of TFRecords files to read concurrently.
+        interleave : int.   Number of consecutive records to read from each 
+                            file before cycling to the next file.
+        shuffle_buffer: int. Number of batches to use for the shuffle buffer.
+                             If None, uses `buffer_size`.
+        cache      : string. Caching mode of the parsed training and 
+                             validation data, if shuffling.  
+                             See utils.get_cache().
+        cachedir   : string. Path/to/directory for file caches.
+        backend    : string. Data format to train from.  'tfrecord' for 
+                             TFRecords, or 'packed' for packed data sets 
+                             (see packed.py), which are already normalized 
+                             and scaled.
         """
         # Make sure everything is on the same graph
         if not debug and K.backend() == 'tensorflow':
@@ -121,22 +164,54 @@ class NNModel:
             sess.add_tensor_filter("has_inf_or_nan", tf_debug.has_inf_or_nan)
             K.set_session(sess)
 
+        # Determine caching of the data sets that are used every epoch
+        if shuffle and backend == 'tfrecord':
+            cache_train, nbytes = U.get_cache('train', 
+                                              nbatches[0]*batch_size, 
+                                              xlen, ylen, cache, cachedir)
+            cache_valid, _      = U.get_cache('valid', 
+                                              nbatches[1]*batch_size, 
+                                              xlen, ylen, cache, cachedir, 
+                                              reserved=nbytes)
+        else:
+            cache_train = None
+            cache_valid = None
+
         # Load data
-        self.X,    self.Y    = U.load_TFdataset(ftrain_TFR, ncores, batch_size, 
-                                                buffer_size, xlen, ylen, 
-                                                x_mean, x_std, y_mean, y_std,
-                                                x_min,  x_max, y_min,  y_max, 
-                                                scalelims, shuffle)
-        self.Xval, self.Yval = U.load_TFdataset(fvalid_TFR, ncores, batch_size, 
-                                                buffer_size, xlen, ylen, 
-                                                x_mean, x_std, y_mean, y_std,
-                                                x_min,  x_max, y_min,  y_max, 
-                                                scalelims, shuffle)
-        self.Xte,  self.Yte  = U.load_TFdataset(ftest_TFR,  ncores, batch_size, 
-                                                buffer_size, xlen, ylen, 
-                                                x_mean, x_std, y_mean, y_std,
-                                                x_min,  x_max, y_min,  y_max, 
-                                                scalelims, shuffle)
+        if backend == 'packed':
+            # Batches are slices of the memory-mapped packed data
+            self.X    = PK.PackedSequence(ftrain_TFR, batch_size, nbatches[0], 
+                                            shuffle)
+            self.Xval = PK.PackedSequence(fvalid_TFR, batch_size, nbatches[1])
+            self.Xte  = PK.PackedSequence(ftest_TFR,  batch_size, nbatches[2])
+            self.Y    = None
+            self.Yval = None
+            self.Yte  = None
+        elif backend == 'tfrecord':
+            self.X,    self.Y    = U.load_TFdataset(ftrain_TFR, ncores, batch_size, 
+                                                    buffer_size, xlen, ylen, 
+                                                    x_mean, x_std, y_mean, y_std,
+                                                    x_min,  x_max, y_min,  y_max, 
+                                                    scalelims, shuffle, TFRblock, 
+                                                    dtype, readers, interleave, 
+                                                    shuffle_buffer, cache_train)
+            self.Xval, self.Yval = U.load_TFdataset(fvalid_TFR, ncores, batch_size, 
+                                                    buffer_size, xlen, ylen, 
+                                                    x_mean, x_std, y_mean, y_std,
+                                                    x_min,  x_max, y_min,  y_max, 
+                                                    scalelims, shuffle, TFRblock, 
+                                                    dtype, readers, interleave, 
+                                                    shuffle_buffer, cache_valid)
+            self.Xte,  self.Yte  = U.load_TFdataset(ftest_TFR,  ncores, batch_size, 
+                                                    buffer_size, xlen, ylen, 
+                                                    x_mean, x_std, y_mean, y_std,
+                                                    x_min,  x_max, y_min,  y_max, 
+                                                    scalelims, shuffle, TFRblock, 
+                                                    dtype, readers, interleave, 
+                                                    shuffle_buffer)
+        else:
+            raise ValueError("Invalid backend: " + backend + "\nAllowed " + \
+                             "options: 'tfrecord' or 'packed'.")
         # Other variables
         self.inD  = xlen
         self.outD = ylen
@@ -166,69 +241,35 @@ class NNModel:
         self.train_flag = train_flag
         self.resume     = resume
         self.shuffle    = shuffle
+        self.backend    = backend
+
+        # Settings to build unshuffled data pipelines for evaluation
+        self.TFRfiles = {'train' : ftrain_TFR, 
+                         'valid' : fvalid_TFR, 
+                         'test'  : ftest_TFR}
+        self.TFRargs  = (ncores, batch_size, buffer_size, xlen, ylen, 
+                         x_mean, x_std, y_mean, y_std, 
+                         x_min,  x_max, y_min,  y_max, scalelims, 
+                         False, TFRblock, dtype, readers, interleave)
+        self.evalsets  = {}
+        self.predictor = None
         
         ### Build model
         # Input layer
-        if shuffle:
+        if shuffle and backend == 'tfrecord':
             inp = Input(shape=(xlen,), tensor=self.X)
         else:
             inp = Input(shape=(xlen,))
-        x = inp
-        # Hidden layers
-        n = 0 # Counter for layers with nodes
-        for i in range(len(layers)):
-            if layers[i] == 'conv1d':
-                tshape = tuple(val for val in K.int_shape(x) if val is not None)
-                if i == 0 or (i > 0 and layers[i-1] != 'conv1d'):
-                    # Add channel for convolution
-                    x = Reshape(tshape + (1,))(x)
-                if type(activations[n]) == str:
-                    # Simple activation: pass as layer parameter
-                    x = Convolution1D(nb_filter=nodes[n], 
-                                      kernel_size=lay_params[i], 
-                                      activation=activations[n], 
-                                      padding='same')(x)
-                else:
-                    # Advanced activation: use as its own layer
-                    x = Convolution1D(nb_filter=nodes[n], 
-                                      kernel_size=lay_params[i], 
-                                      padding='same')(x)
-                    x = activations[n](x)
-                n += 1
-            elif layers[i] == 'dense':
-                if i > 0:
-                    if layers[i-1] == 'conv1d':
-                        print('WARNING: Dense layer follows Conv1d layer. ' \
-                              + 'Flattening.')
-                        x = Flatten()(x)
-                if type(activations[n]) == str:
-                    x = Dense(nodes[n], activation=activations[n])(x)
-                else:
-                    x = Dense(nodes[n])(x)
-                    x = activations[n] (x)
-                n += 1
-            elif layers[i] == 'maxpool1d':
-                if layers[i-1] == 'dense' or layers[i-1] == 'flatten':
-                    raise Exception('MaxPool layers must follow Conv1d or ' \
-                                    + 'Pool layer.')
-                x = MaxPooling1D(pool_size=lay_params[i])(x)
-            elif layers[i] == 'avgpool1d':
-                if layers[i-1] == 'dense' or layers[i-1] == 'flatten':
-                    raise Exception('AvgPool layers must follow Conv1d or ' \
-                                    + 'Pool layer.')
-                x = AveragePooling1D(pool_size=lay_params[i])(x)
-            elif layers[i] == 'dropout':
-                if self.train_flag:
-                    x = Dropout(lay_params[i])(x)
-            elif layers[i] == 'flatten':
-                x = Flatten()(x)
-        # Output layer
-        out = Dense(ylen)(x)
+        out = build_layers(inp, ylen, layers, lay_params, activations, nodes, 
+                           self.train_flag)
 
         self.model = Model(inp, out)
+        if not (shuffle and backend == 'tfrecord'):
+            # Inputs are fed, so the model itself can predict
+            self.predictor = self.model
             
         # Compile model
-        if shuffle:
+        if shuffle and backend == 'tfrecord':
             self.model.compile(optimizer=adam(lr=self.lengthscale, amsgrad=True), 
                                loss=keras.losses.mean_squared_error, 
                                target_tensors=[self.Y])
@@ -306,18 +347,33 @@ class NNModel:
                       "not trained any further.".format(str(epochs), 
                                                         str(init_epochs)))
                 return
-            # Batch size is commented out because that is handled by TFRecords
-            self.historyNN = self.model.fit(initial_epoch=init_epoch, 
+            if self.backend == 'packed':
+                # Batches come from the packed data, in random order, and 
+                # are remade from shuffled runs of rows every epoch
+                self.historyNN = self.model.fit_generator(self.X, 
+                                             initial_epoch=init_epoch, 
                                              epochs=epochs, 
                                              steps_per_epoch=train_steps, 
-                                             #batch_size=self.batch_size, 
                                              verbose=2, 
-                                             validation_data=(self.Xval, 
-                                                              self.Yval), 
+                                             validation_data=self.Xval, 
                                              validation_steps=valid_steps, 
                                              callbacks=[clr, sig, Early_Stop, 
                                                         Nan_Stop, 
-                                                        model_checkpoint])
+                                                        model_checkpoint], 
+                                             shuffle=True)
+            else:
+                # Batch size is commented out; it is handled by TFRecords
+                self.historyNN = self.model.fit(initial_epoch=init_epoch, 
+                                               epochs=epochs, 
+                                               steps_per_epoch=train_steps, 
+                                               #batch_size=self.batch_size, 
+                                               verbose=2, 
+                                               validation_data=(self.Xval, 
+                                                                self.Yval), 
+                                               validation_steps=valid_steps, 
+                                               callbacks=[clr, sig, Early_Stop, 
+                                                          Nan_Stop, 
+                                                          model_checkpoint])
             # Save out the history
             self.historyCLR = clr.history
             if not os.path.exists(fhistory) or not self.resume:
@@ -334,9 +390,62 @@ class NNModel:
         # Load best set of weights
         self.model.load_weights(self.weight_file)
 
-    def Yeval(self, mode, dataset, preddir, denorm=False):
+    def attach_eval(self, datasets=['train', 'valid', 'test']):
+        """
+        Attaches unshuffled data pipelines, for evaluation, to the model.  
+        If the model's input is bound to the shuffled training pipeline, 
+        also makes a predictor that shares the model's layers (and hence 
+        its weights) but takes fed inputs.  The graph is only extended, so 
+        a trained model can be evaluated without rebuilding or reloading it.
+
+        Inputs
+        ------
+        datasets: list, strings. Data sets to attach.  Options: 'train', 
+                                 'valid', 'test'.
+        """
+        if self.predictor is None:
+            inp = Input(shape=(self.inD,))
+            self.predictor = Model(inp, self.model(inp))
+        nbatches = {'train' : self.train_batches, 
+                    'valid' : self.valid_batches, 
+                    'test'  : self.test_batches}
+        for dataset in datasets:
+            if dataset in self.evalsets:
+                continue
+            if dataset not in nbatches:
+                raise ValueError("Invalid data set: " + str(dataset) + "\n" +\
+                                 "Allowed options: 'train', 'valid', or "   +\
+                                 "'test'.")
+            if self.backend == 'tfrecord' and self.shuffle:
+                X, Y = U.load_TFdataset(self.TFRfiles[dataset], *self.TFRargs)
+            elif self.backend == 'packed' and self.shuffle and \
+                 dataset == 'train':
+                X, Y = PK.PackedSequence(self.X.fname, self.batch_size, 
+                                         self.train_batches), None
+            elif dataset == 'train':
+                X, Y = self.X,    self.Y
+            elif dataset == 'valid':
+                X, Y = self.Xval, self.Yval
+            else:
+                X, Y = self.Xte,  self.Yte
+            self.evalsets[dataset] = (X, Y, nbatches[dataset])
+
+    def _eval_data(self, dataset, caller):
+        """
+        Helper function to get the evaluation data pipeline of a data set, 
+        attaching it if needed.
+        """
+        if dataset not in ['train', 'valid', 'test']:
+            raise ValueError("Invalid specification for `dataset` parameter " +\
+                 "of NNModel." + caller + "().\nAllowed options: 'train', " +\
+                 "'valid', or 'test'\nPlease correct this and try again.")
+        self.attach_eval([dataset])
+        return self.evalsets[dataset]
+
+    def Yeval(self, mode, dataset, preddir, denorm=False, 
+              pred_dtype=np.float64, queue_depth=4):
         """
-        Saves out .NPY files of the true or predicted Y values for a 
+        Saves out a .NPY file of the true or predicted Y values for a 
         specified data set.
 
         Inputs
@@ -347,27 +456,17 @@ class NNModel:
                          make predictions on.
         preddir: string. Path/to/directory where predictions will be saved.
         denorm : bool.   Determines whether to denormalize the predicted values.
+        pred_dtype: data type. Data type of the saved values.
+        queue_depth: int. Maximum number of batches waiting to be 
+                          denormalized and saved in the background while 
+                          the next batches are predicted.  
+                          If 0, batches are saved as they are predicted.
+
+        Outputs
+        -------
+        fname: string. Path/to/saved .NPY file, with one row per case.
         """
-        if self.shuffle:
-            raise ValueError("This model has shuffled TFRecords.\nCreate a " +\
-                        "new NNModel object with shuffle=False and try again.")
-
-        if dataset == 'train':
-            X = self.X
-            Y = self.Y
-            num_batches = self.train_batches
-        elif dataset == 'valid':
-            X = self.Xval
-            Y = self.Yval
-            num_batches = self.valid_batches
-        elif dataset == 'test':
-            X = self.Xte
-            Y = self.Yte
-            num_batches = self.test_batches
-        else:
-            raise ValueError("Invalid specification for `dataset` parameter " +\
-                    "of NNModel.Yeval().\nAllowed options: 'train', 'valid'," +\
-                    " or 'test'\nPlease correct this and try again.")
+        X, Y, num_batches = self._eval_data(dataset, 'Yeval')
 
         # Prefix for the savefiles
         if mode == 'pred' or mode=='true':
@@ -378,34 +477,414 @@ class NNModel:
                              "'true'\nPlease correct this and try again.")
 
         if denorm:
-            fname = ''.join([fname, '-denorm_'])
+            fname = ''.join([fname, '-denorm.npy'])
         else:
-            fname = ''.join([fname, '-norm_'])
+            fname = ''.join([fname, '-norm.npy'])
 
         U.make_dir(preddir+dataset) # Ensure the directory exists
 
         # Save out the Y values
-        y_batch = np.zeros((self.batch_size, self.outD))
+        store = np.lib.format.open_memmap(fname, mode='w+', dtype=pred_dtype, 
+                                 shape=(num_batches*self.batch_size, self.outD))
+        def save_batch(i, y_batch):
+            if denorm:
+                y_batch = self._denorm(y_batch)
+            store[i*self.batch_size : (i+1)*self.batch_size] = y_batch
+        writer = U.AsyncWriter(queue_depth)
         for i in range(num_batches):
-            foo = ''.join([fname, str(i).zfill(len(str(num_batches))), '.npy'])
-            if mode == 'pred': # Predicted Y values
+            if self.backend == 'packed':
+                x_batch, y_batch = X[i]
+                if mode == 'pred': # Predicted Y values
+                    y_batch = self.predictor.predict(x_batch)
+                else:  # True Y values
+                    y_batch = np.array(y_batch)
+            elif mode == 'pred': # Predicted Y values
                 x_batch = K.eval(X)
-                y_batch = self.model.predict(x_batch)
+                y_batch = self.predictor.predict(x_batch)
             else:  # True Y values
                 y_batch = K.eval(Y)
-            if denorm:
-                y_batch = U.denormalize(U.descale(y_batch, 
-                                                  self.y_min, self.y_max, 
-                                                  self.scalelims),
-                                        self.y_mean, self.y_std)
-                if self.olog:
-                    y_batch[:, self.olog] = 10**y_batch[:, self.olog]
-            np.save(foo, y_batch)
+            writer.put(save_batch, i, y_batch)
             print(''.join(['  Batch ', str(i+1), '/', str(num_batches)]), end='\r')
+        writer.close()
         print('')
+        store.flush()
+        del store
 
         return fname
 
+    def _denorm(self, y_batch):
+        """
+        Helper function to denormalize a batch of Y values.
+        """
+        y_batch = U.denormalize(U.descale(y_batch, 
+                                          self.y_min, self.y_max, 
+                                          self.scalelims),
+                                self.y_mean, self.y_std)
+        if self.olog:
+            y_batch[:, self.olog] = 10**y_batch[:, self.olog]
+        return y_batch
+
+    def evaluate(self, dataset, preddir, norm=True, denorm=False, 
+                 pred_dtype=np.float64, save=True, metrics=None, 
+                 queue_depth=4):
+        """
+        Evaluates the model on a specified data set, in a single pass over the 
+        data set.  Each batch is loaded once, so the predicted and true values 
+        always correspond.  Optionally saves out .NPY files of the predicted 
+        and true Y values, and/or feeds them to a stats.Metrics accumulator.
+        Each file holds one row per case, in the order of the data set, and 
+        can be memory-mapped for random access by case index.
+
+        Inputs
+        ------
+        dataset: string. 'train', 'valid', or 'test'. Specifies the data set to 
+                         make predictions on.
+        preddir: string. Path/to/directory where predictions will be saved.
+        norm   : bool.   Determines whether to save the normalized values.
+        denorm : bool.   Determines whether to save the denormalized values.
+        pred_dtype: data type. Data type of the saved values.
+        save   : bool.   Determines whether to save the values.
+        metrics: object. stats.Metrics object to update with each batch. 
+                         It receives the normalized values if `norm`, 
+                         otherwise the denormalized values.
+        queue_depth: int. Maximum number of batches waiting to be 
+                          denormalized, added to `metrics`, and saved in the 
+                          background while the next batches are predicted.  
+                          If 0, batches are processed as they are predicted.
+
+        Outputs
+        -------
+        files: dict. Paths/to/saved .NPY files, with keys 
+                     'pred-norm' and 'true-norm' (if `norm`), and 
+                     'pred-denorm' and 'true-denorm' (if `denorm`).
+                     Empty if not `save`.
+        """
+        X, Y, num_batches = self._eval_data(dataset, 'evaluate')
+
+        U.make_dir(preddir+dataset) # Ensure the directory exists
+
+        kinds = []
+        if norm:
+            kinds.append('norm')
+        if denorm:
+            kinds.append('denorm')
+        files  = {}
+        stores = {}
+        if save:
+            for mode in ['pred', 'true']:
+                for kind in kinds:
+                    key = mode + '-' + kind
+                    files [key] = ''.join([preddir, dataset, os.sep, key, 
+                                           '.npy'])
+                    stores[key] = np.lib.format.open_memmap(files[key], 
+                                  mode='w+', dtype=pred_dtype, 
+                                  shape=(num_batches*self.batch_size, 
+                                         self.outD))
+        if self.backend == 'tfrecord':
+            sess = K.get_session()
+
+        def process_batch(i, y_vals):
+            for kind in kinds:
+                if kind == 'denorm':
+                    y_kind = {mode : self._denorm(y_vals[mode]) 
+                              for mode in y_vals}
+                else:
+                    y_kind = y_vals
+                if metrics is not None and kind == kinds[0]:
+                    metrics.update(y_kind['pred'], y_kind['true'])
+                if save:
+                    for mode in ['pred', 'true']:
+                        stores[mode + '-' + kind][i*self.batch_size : 
+                                            (i+1)*self.batch_size] = y_kind[mode]
+        # Denormalizing, metrics, and saving overlap with the next predictions
+        writer = U.AsyncWriter(queue_depth)
+        for i in range(num_batches):
+            # Load the batch once for both the prediction and the truth
+            if self.backend == 'packed':
+                x_batch, y_batch = X[i]
+            else:
+                x_batch, y_batch = sess.run([X, Y])
+            y_vals = {'pred' : self.predictor.predict(x_batch), 
+                      'true' : np.asarray(y_batch)}
+            writer.put(process_batch, i, y_vals)
+            print(''.join(['  Batch ', str(i+1), '/', str(num_batches)]), end='\r')
+        writer.close()
+        print('')
+        for key in stores:
+            stores[key].flush()
+        del stores
+
+        return files
+
+
+
+def build_layers(inp, ylen, layers, lay_params, activations, nodes, 
+                 train_flag=True):
+    """
+    Builds the hidden and output layers of an NN on an input tensor.
+
+    Inputs
+    ------
+    inp        : tensor. Input layer.
+    ylen       : int.    Dimensionality of the outputs.
+    layers     : list, str.  Types of hidden layers.
+    lay_params : list, ints. Parameters for the layer type 
+                             E.g., kernel size
+    activations: list, str.  Activation functions for each hidden layer.
+    nodes      : list, ints. For the layers with nodes, 
+                             number of nodes per layer.
+    train_flag : bool.   Determines whether to include dropout layers.
+
+    Outputs
+    -------
+    out: tensor. Output layer.
+    """
+    x = inp
+    # Hidden layers
+    n = 0 # Counter for layers with nodes
+    for i in range(len(layers)):
+        if layers[i] == 'conv1d':
+            tshape = tuple(val for val in K.int_shape(x) if val is not None)
+            if i == 0 or (i > 0 and layers[i-1] != 'conv1d'):
+                # Add channel for convolution
+                x = Reshape(tshape + (1,))(x)
+            if type(activations[n]) == str:
+                # Simple activation: pass as layer parameter
+                x = Convolution1D(nb_filter=nodes[n], 
+                                  kernel_size=lay_params[i], 
+                                  activation=activations[n], 
+                                  padding='same')(x)
+            else:
+                # Advanced activation: use as its own layer
+                x = Convolution1D(nb_filter=nodes[n], 
+                                  kernel_size=lay_params[i], 
+                                  padding='same')(x)
+                x = activations[n](x)
+            n += 1
+        elif layers[i] == 'dense':
+            if i > 0:
+                if layers[i-1] == 'conv1d':
+                    print('WARNING: Dense layer follows Conv1d layer. ' \
+                          + 'Flattening.')
+                    x = Flatten()(x)
+            if type(activations[n]) == str:
+                x = Dense(nodes[n], activation=activations[n])(x)
+            else:
+                x = Dense(nodes[n])(x)
+                x = activations[n] (x)
+            n += 1
+        elif layers[i] == 'maxpool1d':
+            if layers[i-1] == 'dense' or layers[i-1] == 'flatten':
+                raise Exception('MaxPool layers must follow Conv1d or ' \
+                                + 'Pool layer.')
+            x = MaxPooling1D(pool_size=lay_params[i])(x)
+        elif layers[i] == 'avgpool1d':
+            if layers[i-1] == 'dense' or layers[i-1] == 'flatten':
+                raise Exception('AvgPool layers must follow Conv1d or ' \
+                                + 'Pool layer.')
+            x = AveragePooling1D(pool_size=lay_params[i])(x)
+        elif layers[i] == 'dropout':
+            if train_flag:
+                x = Dropout(lay_params[i])(x)
+        elif layers[i] == 'flatten':
+            x = Flatten()(x)
+    # Output layer
+    out = Dense(ylen)(x)
+    return out
+
+
+def load_stats(inputdir, fmean, fstdev, fmin, fmax, inD, 
+               normalize, scale, scalelims, verb=1):
+    """
+    Loads the statistics of the training set, and gets the values to 
+    normalize and scale the inputs and outputs.
+
+    Inputs
+    ------
+    inputdir : string. Path/to/directory of the statistics files.
+    fmean    : string. File of the mean  of the training data.
+    fstdev   : string. File of the stdev of the training data.
+    fmin     : string. File of the minima of the training data.
+    fmax     : string. File of the maxima of the training data.
+    inD      : int.    Dimensionality of the inputs.
+    normalize: bool.   Determines whether the data are normalized.
+    scale    : bool.   Determines whether the data are scaled.
+    scalelims: list, floats. [min, max] of the scaled data range.
+    verb     : int.    Verbosity level.
+
+    Outputs
+    -------
+    x_mean, x_std, y_mean, y_std: arrays/floats. Mean & stdev of the inputs 
+                                  and outputs.  0 & 1 if not `normalize`.
+    x_min, x_max, y_min, y_max  : arrays/floats. Minima & maxima of the 
+                                  normalized inputs and outputs.  
+                                  0 & 1 if not `scale`.
+    scalelims: list, floats. [min, max] of the scaled data range.  
+                             [0, 1] if not `scale`.
+    """
+    # Get mean/stdev for normalizing
+    if normalize:
+        mean   = np.load(inputdir + fmean)
+        stdev  = np.load(inputdir + fstdev)
+        if verb:
+            print('\nNormalizing the data...')
+            print("mean :", mean)
+            print("stdev:", stdev)
+        # Slice desired indices
+        x_mean, y_mean = mean [:inD], mean [inD:]
+        x_std,  y_std  = stdev[:inD], stdev[inD:]
+    else:
+        x_mean = 0.
+        x_std  = 1.
+        y_mean = 0.
+        y_std  = 1.
+
+    # Get min/max values for scaling
+    if scale:
+        datmin = np.load(inputdir + fmin)
+        datmax = np.load(inputdir + fmax)
+        if verb:
+            print('\nScaling the data...')
+            print("min  :", datmin)
+            print("max  :", datmax)
+        # Slice desired indices
+        x_min, y_min = datmin[:inD], datmin[inD:]
+        x_max, y_max = datmax[:inD], datmax[inD:]
+
+        # Normalize min/max values
+        if normalize:
+            x_min = U.normalize(x_min, x_mean, x_std)
+            x_max = U.normalize(x_max, x_mean, x_std)
+            y_min = U.normalize(y_min, y_mean, y_std)
+            y_max = U.normalize(y_max, y_mean, y_std)
+    else:
+        x_min     =  0.
+        x_max     =  1.
+        y_min     =  0.
+        y_max     =  1.
+        scalelims = [0., 1.]
+
+    return x_mean, x_std, y_mean, y_std, \
+           x_min,  x_max, y_min,  y_max, scalelims
+
+
+def predict(inputdir, finput, foutput, 
+            normalize, fmean, fstdev, scale, fmin, fmax, scalelims, 
+            inD, outD, ilog, olog, 
+            layers, lay_params, activations, nodes, weight_file, 
+            ncores=1, chunk=10000, pred_dtype=np.float64):
+    """
+    Predicts the outputs for an array of inputs with a trained model, 
+    streaming the predictions to a memory-mapped .NPY file.
+
+    The model is run with the NumPy engine (see engine.py), from the export 
+    next to `weight_file`; the export is (re)made if it is missing or older 
+    than the weights or statistics.
+
+    Inputs
+    ------
+    inputdir   : string. Path/to/directory of the statistics files.
+    finput     : string. Path/to/.NPY file of inputs, shaped 
+                         (cases, inputs).  As in the data files, the inputs 
+                         are not log-scaled, normalized, or scaled.  Any 
+                         columns after the first `inD` are ignored.
+    foutput    : string. Path/to/.NPY file to save the predicted outputs, 
+                         shaped (cases, outputs), in physical units.
+    normalize  : bool.   Determines whether the model uses normalized data.
+    fmean      : string. File of the mean  of the training data.
+    fstdev     : string. File of the stdev of the training data.
+    scale      : bool.   Determines whether the model uses scaled data.
+    fmin       : string. File of the minima of the training data.
+    fmax       : string. File of the maxima of the training data.
+    scalelims  : list, floats. [min, max] of the scaled data range.
+    inD        : int.    Dimensionality of the inputs.
+    outD       : int.    Dimensionality of the outputs.
+    ilog       : bool or list, ints. Inputs  that are log10-scaled.
+    olog       : bool or list, ints. Outputs that are log10-scaled.
+    layers     : list, str.  Types of hidden layers.
+    lay_params : list, ints. Parameters for the layer type.
+    activations: list.       Activation functions for each hidden layer.
+    nodes      : list, ints. Number of nodes of the layers with nodes.
+    weight_file: string. Path/to/file of the trained NN weights.
+    ncores     : int.    Number of processes to predict with.
+    chunk      : int.    Number of cases to predict at once.
+    pred_dtype : data type. Data type of the saved predictions.
+
+    Outputs
+    -------
+    `foutput`.
+    """
+    fexport = export_engine(inputdir, normalize, fmean, fstdev, 
+                            scale, fmin, fmax, scalelims, 
+                            inD, outD, ilog, olog, 
+                            layers, lay_params, activations, nodes, 
+                            weight_file)
+    print('Predicting', finput, '->', foutput)
+    E.predict_file(fexport, finput, foutput, chunk, ncores, pred_dtype)
+
+
+def jacobian(inputdir, x, 
+             normalize, fmean, fstdev, scale, fmin, fmax, scalelims, 
+             inD, outD, ilog, olog, 
+             layers, lay_params, activations, nodes, weight_file, 
+             chunk=1024):
+    """
+    Computes the Jacobian of a trained model's outputs with respect to its 
+    inputs, for a batch of inputs, in physical units (e.g., for 
+    gradient-based retrievals or Fisher-matrix forecasts).
+
+    The Jacobian is computed by the NumPy engine (see 
+    engine.NumpyModel.jacobian()) in a single forward-mode pass per chunk 
+    of cases, rather than one gradient per output.  Inputs are as in 
+    predict(), except:
+
+    x    : array. Inputs, as in the data files, shaped (cases, inputs) or 
+                  (inputs,).
+    chunk: int.   Number of cases to differentiate at once.
+
+    Outputs
+    -------
+    y: array. Predicted outputs, shaped (cases, outputs).
+    J: array. Jacobian, dy/dx, shaped (cases, outputs, inputs).
+    """
+    fexport = export_engine(inputdir, normalize, fmean, fstdev, 
+                            scale, fmin, fmax, scalelims, 
+                            inD, outD, ilog, olog, 
+                            layers, lay_params, activations, nodes, 
+                            weight_file)
+    return E.NumpyModel(fexport).jacobian(x, chunk)
+
+
+def export_engine(inputdir, normalize, fmean, fstdev, 
+                  scale, fmin, fmax, scalelims, 
+                  inD, outD, ilog, olog, 
+                  layers, lay_params, activations, nodes, weight_file):
+    """
+    Exports a trained model for the NumPy engine (see engine.py), next to 
+    `weight_file`, if the export is missing or older than the weights or 
+    statistics.  Inputs are as in predict().
+
+    Outputs
+    -------
+    fexport: string. Path/to/exported model .npz
+    """
+    fexport = weight_file.rsplit('.', 1)[0] + '.npz'
+    fdeps   = [weight_file] + [inputdir + foo for foo, flag in 
+                               [(fmean, normalize), (fstdev, normalize), 
+                                (fmin,  scale),     (fmax,   scale)] if flag]
+    if not os.path.exists(fexport) or \
+       os.path.getmtime(fexport) < max([os.path.getmtime(foo) 
+                                        for foo in fdeps]):
+        print('Exporting the model to', fexport)
+        stats = load_stats(inputdir, fmean, fstdev, fmin, fmax, inD, 
+                           normalize, scale, scalelims, verb=0)
+        inp   = Input(shape=(inD,))
+        model = Model(inp, build_layers(inp, outD, layers, lay_params, 
+                                        activations, nodes, False))
+        model.load_weights(weight_file)
+        E.export_npz(model, fexport, ilog, olog, *stats)
+        K.clear_session()
+    return fexport
 
 
 def driver(inputdir, outputdir, datadir, plotdir, preddir, 
@@ -421,7 +900,12 @@ def driver(inputdir, outputdir, datadir, plotdir, preddir,
            epochs, patience, 
            weight_file, resume, 
            plot_cases, fxvals, xlabel, ylabel,
-           filters=None, filt2um=1.):
+           filters=None, filt2um=1., TFRblock=0, dtype=np.float64, 
+           TFRreaders=1, TFRinterleave=1, shuffle_buffer=None, 
+           cache='auto', cachedir=None, backend='tfrecord', 
+           pred_dtype=np.float64, savepred=True, queue_depth=4, 
+           export=[], onnx_threads=1, bench_inference=False, 
+           recompute_metrics=False, checksum=False):
     """
     Driver function to handle model training and evaluation.
 
@@ -480,24 +964,225 @@ def driver(inputdir, outputdir, datadir, plotdir, preddir,
                          integrated filter bandpasses.
     filt2um    : float.  Conversion factor for filter file wavelengths to 
                          microns.  Default: 1.0
+    TFRblock   : int.    Number of cases per TFRecords record.  Default: 0
+                         If 0, each record holds a single case.
+    dtype      : data type. Data type used to store the TFRecords data.
+                            Default: np.float64
+    TFRreaders : int.    Number of TFRecords files to read concurrently.
+                         Default: 1
+    TFRinterleave: int.  Number of consecutive records to read from each 
+                         TFRecords file before cycling to the next file.
+                         Default: 1
+    shuffle_buffer: int. Number of batches to use for the shuffle buffer.
+                         Default: None (uses `buffer_size`)
+    cache      : string. Caching mode of the parsed training and validation 
+                         data during training.  See utils.get_cache().
+                         Default: 'auto'
+    cachedir   : string. Path/to/directory for file caches.  Default: None
+    backend    : string. Data format to train from: 'tfrecord' or 'packed'.  
+                         Default: 'tfrecord'
+    pred_dtype : data type. Data type of the saved predicted and true values.
+                            Default: np.float64
+    savepred   : bool.   Determines whether to save the predicted and true 
+                         values of the validation and test sets.  RMSE and 
+                         R2 are computed either way.  Default: True
+    queue_depth: int.    Maximum number of predicted batches waiting to be 
+                         processed and saved in the background.  If 0, 
+                         batches are processed as they are predicted.  
+                         Default: 4
+    export     : list, strings. Formats to export the trained model to, 
+                         next to `weight_file`.  'npz' exports it for the 
+                         NumPy engine (see engine.py), and 'onnx' for ONNX 
+                         Runtime (see onnxengine.py).  Default: []
+    onnx_threads: int.   Number of intra-op threads for ONNX Runtime.  
+                         If 0, ONNX Runtime chooses.  Default: 1
+    bench_inference: bool. Determines whether to compare the prediction 
+                         latency and throughput of Keras and the exported 
+                         models.  Default: False
+    recompute_metrics: bool. Determines whether to compute the validation 
+                         and test RMSE and R2 from the predicted and true 
+                         values saved by a previous run, on `ncores` 
+                         processes, instead of predicting again.  
+                         Default: False
+    checksum   : bool.   Determines whether to identify the data files in 
+                         the catalog by their checksums, rather than their 
+                         sizes and modification times.  Default: False
     """
-    # Get file names, calculate number of cases per file
-    print('Loading files & calculating total number of batches...')
-
-    try:
-        datsize   = np.load(inputdir + fsize)
-        num_train = datsize[0]
-        num_valid = datsize[1]
-        num_test  = datsize[2]
-    except:
-        ftrain = glob.glob(datadir + 'train' + os.sep + '*.npy')
-        fvalid = glob.glob(datadir + 'valid' + os.sep + '*.npy')
-        ftest  = glob.glob(datadir + 'test'  + os.sep + '*.npy')
-        num_train = U.data_set_size(ftrain, ncores)
-        num_valid = U.data_set_size(fvalid, ncores)
-        num_test  = U.data_set_size(ftest,  ncores)
-        np.save(inputdir + fsize, np.array([num_train, num_valid, num_test]))
-        del ftrain, fvalid, ftest
+    # Catalog of the data files: numbers of cases are read from the .NPY 
+    # headers, and fingerprints of the data detect stale products
+    print('Updating the data catalog...')
+    catalog = CA.update_catalog(datadir, ncores, checksum)
+    dsets   = ['train', 'valid', 'test']
+    fdata   = {dset : CA.get_files(catalog, datadir, dset) for dset in dsets}
+    fprint  = {dset : CA.fingerprint(catalog, dset)        for dset in dsets}
+
+    # Get TFRecord file names
+    print('\nLoading TFRecords file names...')
+    TFRpath = inputdir +'TFRecords' + os.sep + TFRfile
+    # TFRecords hold whole batches, so they depend on the batch size too
+    TFRset  = {'inD'   : inD,      'ilog'  : ilog, 'olog' : olog, 
+               'block' : TFRblock, 'dtype' : np.dtype(dtype).name, 
+               'batch_size' : batch_size}
+    fTFR    = {}
+    for dset in dsets:
+        fTFR[dset] = glob.glob(TFRpath + dset + '*.tfrecords')
+        if len(fTFR[dset]) == 0:
+            continue
+        current = CA.is_current(catalog, TFRpath + dset, fprint[dset], TFRset)
+        if current is None:
+            # Made before the catalog existed -- assume they are current
+            CA.set_product(datadir, catalog, TFRpath + dset, 
+                           fprint[dset], TFRset)
+        elif not current:
+            print("The " + dset + " TFRecords are out of date and will " + \
+                  "be remade.")
+            for foo in fTFR[dset]:
+                os.remove(foo)
+            fTFR[dset] = []
+
+    # Statistics of the training data.  Partial statistics of each training 
+    # file are saved, so that adding files only requires computing 
+    # statistics for the new files
+    fpartdir = os.path.join(inputdir, 'stats_partials', '')
+    fmean_delog = fmean.replace(".npy", "_delog.npy")
+    fstats  = [fmean, fstdev, fmin, fmax]
+    if olog:
+        fstats.append(fmean_delog)
+    statset = {'inD' : inD, 'ilog' : ilog, 'olog' : olog}
+    need_stats = False
+    if normalize or scale or olog:
+        current = CA.is_current(catalog, inputdir + fmean, 
+                                fprint['train'], statset)
+        if not all([os.path.exists(inputdir + foo) for foo in fstats]):
+            need_stats = True
+        elif current is None:
+            CA.set_product(datadir, catalog, inputdir + fmean, 
+                           fprint['train'], statset)
+        elif not current:
+            print("The statistics files are out of date and will be " + \
+                  "recomputed.")
+            need_stats = True
+
+    datsize = {}
+    if backend == 'tfrecord' and any([len(fTFR[dset]) == 0 
+                                      for dset in dsets]):
+        # Doesn't exist -- make them.  Each data set is read once to count 
+        # the cases, screen for bad cases, compute the training set 
+        # statistics, and write the TFRecords
+        print("\nSome TFRecords files do not exist yet.")
+        for dset in dsets:
+            if len(fTFR[dset]):
+                continue
+            print("\nPreparing the " + dset + " data...")
+            res   = PR.prepare_data(TFRpath + dset + '.tfrecords', 
+                                    fdata[dset], inD, ilog, olog, batch_size, 
+                                    stats=(dset == 'train' and need_stats), 
+                                    delog=bool(olog), ncores=ncores, 
+                                    block=TFRblock, dtype=dtype, 
+                                    partdir=fpartdir)
+            # Data set size is the number of cases written to the TFRecords
+            datsize[dset] = res['nwrite']
+            CA.set_product(datadir, catalog, TFRpath + dset, 
+                           fprint[dset], TFRset)
+            CA.set_product(datadir, catalog, TFRpath + dset + '_size', 
+                           fprint[dset], TFRset, value=datsize[dset])
+            PR.write_report(inputdir + 'bad_cases_' + dset + '.txt', 
+                            res['report'])
+            if 'mean' in res:
+                np.save(inputdir + fmean,  res['mean'])
+                np.save(inputdir + fstdev, res['stdev'])
+                np.save(inputdir + fmin,   res['min'])
+                np.save(inputdir + fmax,   res['max'])
+                if olog:
+                    np.save(inputdir + fmean_delog, res['mean_delog'][inD:])
+                CA.set_product(datadir, catalog, inputdir + fmean, 
+                               fprint['train'], statset)
+                need_stats = False
+            del res
+        print("\nTFRecords creation complete.")
+        # Get TFR file names for real this time
+        for dset in dsets:
+            fTFR[dset] = glob.glob(TFRpath + dset + '*.tfrecords')
+    ftrain_TFR = fTFR['train']
+    fvalid_TFR = fTFR['valid']
+    ftest_TFR  = fTFR['test']
+
+    # Get the number of cases in each data set: the number of cases written 
+    # to its TFRecords, recorded per data set
+    print('Calculating total number of batches...')
+    if backend == 'tfrecord':
+        for dset in dsets:
+            if dset in datsize:
+                continue
+            fdsize = TFRpath + dset + '_size'
+            if CA.is_current(catalog, fdsize, fprint[dset], TFRset) and \
+               CA.get_value(catalog, fdsize) is not None:
+                datsize[dset] = CA.get_value(catalog, fdsize)
+            else:
+                # Size not recorded -- count the cases in the TFRecords
+                datsize[dset] = U.count_TFRecords(fTFR[dset], TFRblock)
+                CA.set_product(datadir, catalog, fdsize, fprint[dset], 
+                               TFRset, value=datsize[dset])
+
+    # Get the statistics of the training data, all in a single pass
+    if need_stats:
+        print("Calculating the mean, standard deviation, min, and max " +\
+              "of the data using Welford's method.")
+        stats  = S.mean_stdev(fdata['train'], inD, ilog, olog, 
+                              ncores=ncores, partdir=fpartdir, 
+                              delog=bool(olog))
+        np.save(inputdir + fmean,  stats[0])
+        np.save(inputdir + fstdev, stats[1])
+        np.save(inputdir + fmin,   stats[2])
+        np.save(inputdir + fmax,   stats[3])
+        if olog:
+            np.save(inputdir + fmean_delog, stats[4][inD:])
+        CA.set_product(datadir, catalog, inputdir + fmean, 
+                       fprint['train'], statset)
+        del stats
+    if olog:
+        # To properly calculate RMSE & R2 for log-scaled output
+        y_mean_delog = np.load(inputdir + fmean_delog)
+
+    x_mean, x_std, y_mean, y_std, \
+    x_min,  x_max, y_min,  y_max, scalelims = load_stats(inputdir, 
+                                                         fmean, fstdev, 
+                                                         fmin,  fmax, inD, 
+                                                         normalize, scale, 
+                                                         scalelims)
+
+    if not olog:
+        y_mean_delog = y_mean
+
+    # Pack the data sets, if training from packed data
+    if backend == 'packed':
+        print('\nLoading the packed data...')
+        packdir = inputdir + 'packed' + os.sep
+        U.make_dir(packdir)
+        packset = {'inD' : inD, 'ilog' : ilog, 'olog' : olog, 
+                   'stats' : PK.stats_id(x_mean, x_std, y_mean, y_std, 
+                                         x_min,  x_max, y_min,  y_max, 
+                                         scalelims)}
+        fpack   = {}
+        for dset in dsets:
+            fpack[dset] = packdir + TFRfile + dset + '.npy'
+            if not os.path.exists(PK.index_name(fpack[dset])) or \
+               not CA.is_current(catalog, fpack[dset], fprint[dset], packset):
+                print("Packing the " + dset + " data...")
+                PK.make_packed(fpack[dset], fdata[dset], inD, ilog, olog, 
+                               x_mean, x_std, y_mean, y_std, 
+                               x_min,  x_max, y_min,  y_max, scalelims)
+                CA.set_product(datadir, catalog, fpack[dset], 
+                               fprint[dset], packset)
+            datsize[dset] = PK.load_index(fpack[dset])['nrows']
+        ftrain_TFR = fpack['train']
+        fvalid_TFR = fpack['valid']
+        ftest_TFR  = fpack['test']
+
+    num_train = datsize['train']
+    num_valid = datsize['valid']
+    num_test  = datsize['test']
+    np.save(inputdir + fsize, np.array([num_train, num_valid, num_test]))
 
     print("Data set sizes")
     print("Training   data:", num_train)
@@ -517,116 +1202,6 @@ def driver(inputdir, outputdir, datadir, plotdir, preddir,
         clr_steps = train_batches * int(clr_steps)
         rng_test  = False
 
-    # Get mean/stdev for normalizing
-    if normalize:
-        print('\nNormalizing the data...')
-        try:
-            mean   = np.load(inputdir + fmean)
-            stdev  = np.load(inputdir + fstdev)
-        except:
-            print("Calculating the mean and standard deviation of the data " +\
-                  "using Welford's method.")
-            # Compute stats
-            ftrain = glob.glob(datadir + 'train' + os.sep + '*.npy')
-            mean, stdev, datmin, datmax = S.mean_stdev(ftrain, inD, ilog, olog)
-            np.save(inputdir + fmean,  mean)
-            np.save(inputdir + fstdev, stdev)
-            np.save(inputdir + fmin,   datmin)
-            np.save(inputdir + fmax,   datmax)
-            del datmin, datmax, ftrain
-        print("mean :", mean)
-        print("stdev:", stdev)
-        # Slice desired indices
-        x_mean, y_mean = mean [:inD], mean [inD:]
-        x_std,  y_std  = stdev[:inD], stdev[inD:]
-        # Memory cleanup -- no longer need full mean/stdev arrays
-        del mean, stdev
-    else:
-        x_mean = 0.
-        x_std  = 1.
-        y_mean = 0.
-        y_std  = 1.
-
-    if olog:
-        # To properly calculate RMSE & R2 for log-scaled output
-        try:
-            y_mean_delog = np.load(inputdir + 
-                                   fmean.replace(".npy", "_delog.npy"))
-        except:
-            mean_delog = S.mean_stdev(ftrain, inD, ilog, False)[0]
-            y_mean_delog = mean_delog[inD:]
-            np.save(inputdir + fmean.replace(".npy", "_delog.npy"), y_mean_delog)
-    else:
-        y_mean_delog = y_mean
-
-    # Get min/max values for scaling
-    if scale:
-        print('\nScaling the data...')
-        try:
-            datmin = np.load(inputdir + fmin)
-            datmax = np.load(inputdir + fmax)
-        except:
-            ftrain = glob.glob(datadir + 'train' + os.sep + '*.npy')
-            mean, stdev, datmin, datmax = S.mean_stdev(ftrain, inD, ilog, olog)
-            np.save(inputdir + fmean,  mean)
-            np.save(inputdir + fstdev, stdev)
-            np.save(inputdir + fmin,   datmin)
-            np.save(inputdir + fmax,   datmax)
-            del mean, stdev, ftrain
-        print("min  :", datmin)
-        print("max  :", datmax)
-        # Slice desired indices
-        x_min, y_min = datmin[:inD], datmin[inD:]
-        x_max, y_max = datmax[:inD], datmax[inD:]
-        # Memory cleanup -- no longer need min/max arrays
-        del datmin, datmax
-
-        # Normalize min/max values
-        if normalize:
-            x_min = U.normalize(x_min, x_mean, x_std)
-            x_max = U.normalize(x_max, x_mean, x_std)
-            y_min = U.normalize(y_min, y_mean, y_std)
-            y_max = U.normalize(y_max, y_mean, y_std)
-    else:
-        x_min     =  0.
-        x_max     =  1.
-        y_min     =  0.
-        y_max     =  1.
-        scalelims = [0., 1.]
-
-    # Get TFRecord file names
-    print('\nLoading TFRecords file names...')
-    TFRpath = inputdir +'TFRecords' + os.sep + TFRfile
-    ftrain_TFR = glob.glob(TFRpath + 'train*.tfrecords')
-    fvalid_TFR = glob.glob(TFRpath + 'valid*.tfrecords')
-    ftest_TFR  = glob.glob(TFRpath +  'test*.tfrecords')
-
-    if len(ftrain_TFR) == 0 or len(fvalid_TFR) == 0 or len(ftest_TFR) == 0:
-        # Doesn't exist -- make them
-        print("\nSome TFRecords files do not exist yet.")
-        ftrain = glob.glob(datadir + 'train' + os.sep + '*.npy')
-        fvalid = glob.glob(datadir + 'valid' + os.sep + '*.npy')
-        ftest  = glob.glob(datadir + 'test'  + os.sep + '*.npy')
-        if len(ftrain_TFR) == 0:
-            print("Making TFRecords for training data...")
-            U.make_TFRecord(inputdir+'TFRecords'+os.sep+TFRfile+'train.tfrecords', 
-                            ftrain, inD, ilog, olog, batch_size, train_batches)
-        if len(fvalid_TFR) == 0:
-            print("\nMaking TFRecords for validation data...")
-            U.make_TFRecord(inputdir+'TFRecords'+os.sep+TFRfile+'valid.tfrecords', 
-                            fvalid, inD, ilog, olog, batch_size, valid_batches)
-        if len(ftest_TFR) == 0:
-            print("\nMaking TFRecords for test data...")
-            U.make_TFRecord(inputdir+'TFRecords'+os.sep+TFRfile+'test.tfrecords', 
-                            ftest,  inD, ilog, olog, batch_size, test_batches)
-        print("\nTFRecords creation complete.")
-        # Free memory
-        del ftrain, fvalid, ftest
-        # Get TFR file names for real this time
-        ftrain_TFR = glob.glob(TFRpath + 'train*.tfrecords')
-        fvalid_TFR = glob.glob(TFRpath + 'valid*.tfrecords')
-        ftest_TFR  = glob.glob(TFRpath +  'test*.tfrecords')
-
     # Load the xvals
     xvals = np.load(fxvals)
 
@@ -652,7 +1227,11 @@ def driver(inputdir, outputdir, datadir, plotdir, preddir,
                          activations[i], act_params[i], nodes[i], 
                          lengthscale, max_lr, clr_mode, clr_steps, 
                          wfile, stop_file='./STOP', 
-                         train_flag=True, shuffle=True)
+                         train_flag=True, shuffle=True, TFRblock=TFRblock, 
+                         dtype=dtype, readers=TFRreaders, 
+                         interleave=TFRinterleave, 
+                         shuffle_buffer=shuffle_buffer, 
+                         cache=cache, cachedir=cachedir, backend=backend)
             nn.train(train_batches, valid_batches, epochs, patience)
             P.loss(nn, archdir)
         # Print/save out the minmium validation loss for each architecture
@@ -684,52 +1263,108 @@ def driver(inputdir, outputdir, datadir, plotdir, preddir,
                      layers, lay_params, activations, act_params, nodes, 
                      lengthscale, max_lr, clr_mode, clr_steps, 
                      weight_file, stop_file='./STOP', 
-                     train_flag=True, shuffle=True, resume=resume)
+                     train_flag=True, shuffle=True, resume=resume, 
+                     TFRblock=TFRblock, dtype=dtype, readers=TFRreaders, 
+                     interleave=TFRinterleave, shuffle_buffer=shuffle_buffer, 
+                     cache=cache, cachedir=cachedir, backend=backend)
         nn.train(train_batches, valid_batches, epochs, patience)
         # Plot the loss
         P.loss(nn, plotdir)
-
-    # Call new model with shuffle=False
-    nn = NNModel(ftrain_TFR, fvalid_TFR, ftest_TFR, 
-                 inD, outD, olog, 
-                 x_mean, x_std, y_mean, y_std, 
-                 x_min,  x_max, y_min,  y_max, scalelims, 
-                 ncores, buffer_size, batch_size, 
-                 [train_batches, valid_batches, test_batches], 
-                 layers, lay_params, activations, act_params, nodes, 
-                 lengthscale, max_lr, clr_mode, clr_steps, 
-                 weight_file, stop_file='./STOP', 
-                 train_flag=False, shuffle=False, resume=False)
-    nn.model.load_weights(weight_file) # Load the model
-    # Save in ONNX format
-    #onnx_model = keras2onnx.convert_keras(nn.model)
-    #onnx.save_model(onnx_model, nn.weight_file.rsplit('.', 1)[0] + '.onnx')
+        # The trained model (with its best weights) is evaluated directly, 
+        # via unshuffled pipelines in the same session
+        nn.attach_eval(['valid', 'test'])
+    else:
+        # Call new model with shuffle=False
+        nn = NNModel(ftrain_TFR, fvalid_TFR, ftest_TFR, 
+                     inD, outD, olog, 
+                     x_mean, x_std, y_mean, y_std, 
+                     x_min,  x_max, y_min,  y_max, scalelims, 
+                     ncores, buffer_size, batch_size, 
+                     [train_batches, valid_batches, test_batches], 
+                     layers, lay_params, activations, act_params, nodes, 
+                     lengthscale, max_lr, clr_mode, clr_steps, 
+                     weight_file, stop_file='./STOP', 
+                     train_flag=False, shuffle=False, resume=False, 
+                     TFRblock=TFRblock, dtype=dtype, readers=TFRreaders, 
+                     interleave=TFRinterleave, backend=backend)
+        nn.model.load_weights(weight_file) # Load the model
+    # Export for the standalone NumPy engine
+    if 'npz' in export:
+        fexport = weight_file.rsplit('.', 1)[0] + '.npz'
+        print('\nExporting the model to', fexport)
+        E.export_npz(nn.model, fexport, ilog, olog, 
+                     x_mean, x_std, y_mean, y_std, 
+                     x_min,  x_max, y_min,  y_max, scalelims)
+        xcheck  = np.random.uniform(scalelims[0], scalelims[1], 
+                                    (batch_size, inD))
+        maxdiff = E.verify(nn.predictor, E.NumpyModel(fexport), xcheck)
+        print('  NumPy engine matches Keras; max. difference:', maxdiff)
+    # Export to ONNX, with the processing steps, for ONNX Runtime
+    if 'onnx' in export:
+        fonnx = weight_file.rsplit('.', 1)[0] + '.onnx'
+        print('\nExporting the model to', fonnx)
+        O.export_onnx(nn.predictor, fonnx, ilog, olog, 
+                      x_mean, x_std, y_mean, y_std, 
+                      x_min,  x_max, y_min,  y_max, scalelims)
+        # Check it against Keras, in physical units
+        xcheck = np.random.uniform(scalelims[0], scalelims[1], 
+                                   (batch_size, inD)).astype(np.float32)
+        xraw   = U.denormalize(U.descale(xcheck.astype(np.float64), 
+                                         x_min, x_max, scalelims), 
+                               x_mean, x_std)
+        if ilog:
+            xraw[:, ilog] = 10**xraw[:, ilog]
+        pred_keras = nn._denorm(nn.predictor.predict(xcheck).astype(np.float64))
+        pred_onnx  = O.OnnxModel(fonnx, onnx_threads).predict(xraw)
+        if not np.allclose(pred_onnx, pred_keras, rtol=1e-3, atol=1e-5):
+            raise ValueError("The ONNX model does not match the Keras "    +\
+                             "model.\nMaximum absolute difference: "       +\
+                             str(np.amax(np.abs(pred_onnx - pred_keras))))
+        print('  ONNX model matches Keras; max. difference:', 
+              np.amax(np.abs(pred_onnx - pred_keras)))
+    # Compare inference speeds
+    if bench_inference:
+        print('\nBenchmarking inference...')
+        BM.inference(nn.predictor, 
+                     fonnx if 'onnx' in export else None, 
+                     fexport if 'npz' in export else None, 
+                     onnx_threads)
 
     # Validate model
     if (validflag or trainflag) and not rng_test:
         print('\nValidating the model...\n')
-        # Y values
-        print('  Predicting...')
-        fvalpred = nn.Yeval('pred', 'valid', preddir, 
-                            denorm=(normalize==False and scale==False))
-        fvalpred = glob.glob(fvalpred + '*')
-
-        print('  Loading the true Y values...')
-        fvaltrue = nn.Yeval('true', 'valid', preddir, 
-                            denorm=(normalize==False and scale==False))
-        fvaltrue = glob.glob(fvaltrue + '*')
-        ### RMSE & R2
-        print('\n Calculating RMSE & R2...')
+        # Y values, with RMSE & R2 accumulated batch by batch
+        print('  Predicting & calculating RMSE & R2...')
+        valkind  = 'denorm' if (normalize==False and scale==False) else 'norm'
         if not normalize and not scale:
-            val_stats = S.rmse_r2(fvalpred, fvaltrue, y_mean, 
-                                  olog=olog, y_mean_delog=y_mean_delog, 
-                                  x_vals=xvals, 
-                                  filters=filters, filt2um=filt2um)
+            val_metrics = S.Metrics(y_mean, 
+                                    olog=olog, y_mean_delog=y_mean_delog, 
+                                    x_vals=xvals, 
+                                    filters=filters, filt2um=filt2um)
         else:
-            val_stats = S.rmse_r2(fvalpred, fvaltrue, y_mean, 
-                                  y_std, y_min, y_max, scalelims, 
-                                  olog, y_mean_delog, 
-                                  xvals, filters, filt2um)
+            val_metrics = S.Metrics(y_mean, y_std, y_min, y_max, scalelims, 
+                                    olog=olog, y_mean_delog=y_mean_delog, 
+                                    x_vals=xvals, 
+                                    filters=filters, filt2um=filt2um)
+        # RMSE & R2 are accumulated batch by batch while predicting, unless 
+        # recomputing them from the saved values of a previous run
+        fpreds = {key : ''.join([preddir, 'valid', os.sep, key, '.npy']) 
+                  for key in ['pred-' + valkind, 'true-' + valkind]}
+        if recompute_metrics and all([os.path.exists(foo) 
+                                      for foo in fpreds.values()]):
+            print('  Using the saved predicted and true values.')
+            S.metrics_files(fpreds['pred-' + valkind], 
+                            fpreds['true-' + valkind], 
+                            val_metrics, ncores=ncores)
+        else:
+            if recompute_metrics:
+                print('  No saved predicted and true values.  Predicting.')
+            nn.evaluate('valid', preddir, 
+                        norm  =(valkind == 'norm'), 
+                        denorm=(valkind == 'denorm'), 
+                        pred_dtype=pred_dtype, save=savepred, 
+                        metrics=val_metrics, queue_depth=queue_depth)
+        val_stats = val_metrics.result()
         # RMSE
         if np.any(val_stats[0] != -1) and np.any(val_stats[1] != -1):
             print('  Normalized RMSE       : ', val_stats[0])
@@ -800,28 +1435,38 @@ def driver(inputdir, outputdir, datadir, plotdir, preddir,
     # Evaluate model on test set
     if testflag and not rng_test:
         print('\nTesting the model...\n')
-        # Y values
-        print('  Predicting...')
-        ftestpred = nn.Yeval('pred', 'test', preddir, 
-                             denorm=(normalize==False and scale==False))
-        ftestpred = glob.glob(ftestpred + '*')
-
-        print('  Loading the true Y values...')
-        ftesttrue = nn.Yeval('true', 'test', preddir, 
-                             denorm=(normalize==False and scale==False))
-        ftesttrue = glob.glob(ftesttrue + '*')
-        ### RMSE & R2
-        print('\n Calculating RMSE & R2...')
+        # Y values, with RMSE & R2 accumulated batch by batch
+        print('  Predicting & calculating RMSE & R2...')
+        testkind  = 'denorm' if (normalize==False and scale==False) else 'norm'
         if not normalize and not scale:
-            test_stats = S.rmse_r2(ftestpred, ftesttrue, y_mean, 
-                                   olog=olog, y_mean_delog=y_mean_delog, 
-                                   x_vals=xvals, 
-                                   filters=filters, filt2um=filt2um)
+            test_metrics = S.Metrics(y_mean, 
+                                     olog=olog, y_mean_delog=y_mean_delog, 
+                                     x_vals=xvals, 
+                                     filters=filters, filt2um=filt2um)
+        else:
+            test_metrics = S.Metrics(y_mean, y_std, y_min, y_max, scalelims, 
+                                     olog=olog, y_mean_delog=y_mean_delog, 
+                                     x_vals=xvals, 
+                                     filters=filters, filt2um=filt2um)
+        # RMSE & R2 are accumulated batch by batch while predicting, unless 
+        # recomputing them from the saved values of a previous run
+        fpreds = {key : ''.join([preddir, 'test', os.sep, key, '.npy']) 
+                  for key in ['pred-' + testkind, 'true-' + testkind]}
+        if recompute_metrics and all([os.path.exists(foo) 
+                                      for foo in fpreds.values()]):
+            print('  Using the saved predicted and true values.')
+            S.metrics_files(fpreds['pred-' + testkind], 
+                            fpreds['true-' + testkind], 
+                            test_metrics, ncores=ncores)
         else:
-            test_stats = S.rmse_r2(ftestpred, ftesttrue, y_mean, 
-                                   y_std, y_min, y_max, scalelims, 
-                                   olog, y_mean_delog, 
-                                   xvals, filters, filt2um)
+            if recompute_metrics:
+                print('  No saved predicted and true values.  Predicting.')
+            nn.evaluate('test', preddir, 
+                        norm  =(testkind == 'norm'), 
+                        denorm=(testkind == 'denorm'), 
+                        pred_dtype=pred_dtype, save=savepred, 
+                        metrics=test_metrics, queue_depth=queue_depth)
+        test_stats = test_metrics.result()
         # RMSE
         if np.any(test_stats[0] != -1) and np.any(test_stats[1] != -1):
             print('  Normalized RMSE       : ', test_stats[0])
@@ -890,25 +1535,36 @@ def driver(inputdir, outputdir, datadir, plotdir, preddir,
                      r2=test_stats[3], r2_mean=np.mean(test_stats[3]))
 
     # Plot requested cases
-    if not rng_test:
-        predfoo = sorted(glob.glob(preddir+'test'+os.sep+'pred*'))
-        truefoo = sorted(glob.glob(preddir+'test'+os.sep+'true*'))
-        if len(predfoo) > 0 and len(truefoo) > 0:
+    if not rng_test and not savepred:
+        if len(plot_cases):
+            print("\nPredictions were not saved (savepred = False), so the " +\
+                  "requested cases are not plotted.")
+    elif not rng_test:
+        # Test set predictions/true values, normalized if available
+        for kind in ['norm', 'denorm']:
+            fpredstore = preddir + 'test' + os.sep + 'pred-' + kind + '.npy'
+            ftruestore = preddir + 'test' + os.sep + 'true-' + kind + '.npy'
+            if os.path.exists(fpredstore) and os.path.exists(ftruestore):
+                break
+        if os.path.exists(fpredstore) and os.path.exists(ftruestore):
             print("\nPlotting the requested cases...")
+            predstore = np.load(fpredstore, mmap_mode='r')
+            truestore = np.load(ftruestore, mmap_mode='r')
             nplot = 0
             for v in plot_cases:
                 fname    = plotdir + 'spec' + str(v) + '_pred-vs-true.png'
-                predspec = np.load(predfoo[v // batch_size])[v % batch_size]
-                predspec = U.denormalize(U.descale(predspec, 
-                                                   y_min, y_max, scalelims),
-                                         y_mean, y_std)
-                truespec = np.load(truefoo[v // batch_size])[v % batch_size]
-                truespec = U.denormalize(U.descale(truespec, 
-                                                   y_min, y_max, scalelims),
-                                         y_mean, y_std)
-                if olog:
-                    predspec[olog] = 10**predspec[olog]
-                    truespec[olog] = 10**truespec[olog]
+                predspec = np.array(predstore[v], dtype=np.float64)
+                truespec = np.array(truestore[v], dtype=np.float64)
+                if kind == 'norm':
+                    predspec = U.denormalize(U.descale(predspec, 
+                                                       y_min, y_max, scalelims),
+                                             y_mean, y_std)
+                    truespec = U.denormalize(U.descale(truespec, 
+                                                       y_min, y_max, scalelims),
+                                             y_mean, y_std)
+                    if olog:
+                        predspec[olog] = 10**predspec[olog]
+                        truespec[olog] = 10**truespec[olog]
                 P.plot_spec(fname, predspec, truespec, xvals, xlabel, ylabel)
                 nplot += 1
                 print("  Plot " + str(nplot) + "/" + str(len(plot_cases)), end='\r')
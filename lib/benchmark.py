@@ -0,0 +1,349 @@
+"""
+Module that contains functions to benchmark parts of MARGE.
+
+_pipeline_rate: Helper function to time a TFRecords data pipeline.
+
+storage_dtype: Compares the disk usage, loading throughput, and precision of
+               TFRecords stored with different data types.
+
+backend: Compares the loading throughput of TFRecords and packed data.
+
+inference: Compares the prediction latency and throughput of Keras, ONNX 
+           Runtime, and the NumPy engine.
+
+"""
+
+import sys, os
+import time
+import glob
+import numpy as np
+import tensorflow as tf
+
+import stats  as S
+import utils  as U
+import packed as PK
+
+
+def _pipeline_rate(x_data, y_data, nbatches, batch_size):
+    """
+    Helper function to time how quickly a data pipeline delivers batches.
+
+    Inputs
+    ------
+    x_data    : tensor. Input  data from U.load_TFdataset().
+    y_data    : tensor. Output data from U.load_TFdataset().
+    nbatches  : int.    Number of batches to time.
+    batch_size: int.    Size of the batches.
+
+    Outputs
+    -------
+    rate: float. Number of cases delivered per second.
+    """
+    with tf.Session() as sess:
+        # First batch includes the pipeline start-up cost
+        sess.run([x_data, y_data])
+        tbeg = time.time()
+        for i in range(nbatches):
+            sess.run([x_data, y_data])
+        tend = time.time()
+    return nbatches * batch_size / (tend - tbeg)
+
+
+def storage_dtype(files, inD, outD, ilog, olog, batch_size, tmpdir,
+                  dtypes=['float64', 'float32', 'float16'], nbatches=None,
+                  ncores=1, buffer_size=10, block=0,
+                  normalize=True, scale=True, scalelims=[-1, 1], verb=1):
+    """
+    Compares TFRecords stored with different data types in terms of disk
+    usage, loading throughput, and precision.
+
+    Inputs
+    ------
+    files     : list, strings. Processed .NPY data files to benchmark with.
+    inD       : int.   Dimensionality of the inputs.
+    outD      : int.   Dimensionality of the outputs.
+    ilog      : bool.  Determines whether to take the log10 of the inputs.
+    olog      : bool.  Determines whether to take the log10 of the outputs.
+    batch_size: int.   Size of batches.
+    tmpdir    : string. Path/to/directory to write the benchmark TFRecords.
+    dtypes    : list, strings. Data types to benchmark.
+                               float64 is always included as the reference.
+    nbatches  : int.   Number of batches to time.  If None, uses all batches.
+    ncores    : int.   Number of cores to use for parallel loading.
+    buffer_size: int.  Number of batches to pre-load into memory.
+    block     : int.   Number of cases per TFRecords record.
+    normalize : bool.  Determines whether to normalize the data.
+    scale     : bool.  Determines whether to scale the data.
+    scalelims : list, floats. [min, max] of range of scaled data.
+    verb      : int.   Verbosity level.
+
+    Outputs
+    -------
+    results: dict. For each data type, the TFRecords size in bytes ('bytes'),
+                   the loading throughput in cases per second ('rate'), and
+                   the RMSE and R2 of the processed outputs with respect to
+                   the float64 TFRecords ('rmse', 'r2'; mean over outputs).
+
+    Notes
+    -----
+    The RMSE/R2 compare the data the NN would be trained/evaluated on, so they
+    bound the impact of the storage precision on a model's RMSE/R2.
+    """
+    U.make_dir(tmpdir)
+    # Double precision is the reference for the precision comparison
+    if 'float64' not in dtypes:
+        dtypes = ['float64'] + list(dtypes)
+    # Statistics to normalize/scale the data
+    mean, stdev, datmin, datmax = S.mean_stdev(files, inD, ilog, olog,
+                                               ncores=ncores)
+    if normalize:
+        x_mean, y_mean = mean [:inD], mean [inD:]
+        x_std,  y_std  = stdev[:inD], stdev[inD:]
+    else:
+        x_mean, y_mean = 0., 0.
+        x_std,  y_std  = 1., 1.
+    if scale:
+        x_min = U.normalize(datmin[:inD], x_mean, x_std)
+        x_max = U.normalize(datmax[:inD], x_mean, x_std)
+        y_min = U.normalize(datmin[inD:], y_mean, y_std)
+        y_max = U.normalize(datmax[inD:], y_mean, y_std)
+    else:
+        x_min, x_max, y_min, y_max = 0., 1., 0., 1.
+        scalelims = [0., 1.]
+    stats = (x_mean, x_std, y_mean, y_std, x_min, x_max, y_min, y_max,
+             scalelims)
+    e_batches = U.data_set_size(files, ncores) // batch_size
+    if nbatches is None or nbatches > e_batches:
+        nbatches = e_batches
+
+    # Write a single TFRecords file per data type, so the cases line up
+    fTFR = {}
+    for dtype in dtypes:
+        fname = os.path.join(tmpdir, 'bench_' + dtype + '.tfrecords')
+        for foo in glob.glob(fname.replace('.tfrecords', '*.tfrecords')):
+            os.remove(foo)
+        if verb:
+            print('Writing', dtype, 'TFRecords...')
+        U.make_TFRecord(fname, files, inD, ilog, olog, batch_size, e_batches,
+                        split=len(files), verb=verb, block=block,
+                        dtype=np.dtype(dtype))
+        fTFR[dtype] = sorted(glob.glob(fname.replace('.tfrecords',
+                                                     '*.tfrecords')))
+
+    results = {}
+    for dtype in dtypes:
+        res = {'bytes' : sum([os.path.getsize(foo) for foo in fTFR[dtype]])}
+        # Throughput
+        tf.reset_default_graph()
+        x_data, y_data = U.load_TFdataset(fTFR[dtype], ncores, batch_size,
+                                          buffer_size, inD, outD, *stats,
+                                          shuffle=True, block=block,
+                                          dtype=np.dtype(dtype))
+        res['rate'] = _pipeline_rate(x_data, y_data, nbatches, batch_size)
+        # Precision with respect to double precision
+        tf.reset_default_graph()
+        x_ref, y_ref   = U.load_TFdataset(fTFR['float64'], ncores,
+                                          batch_size, buffer_size,
+                                          inD, outD, *stats, block=block)
+        x_data, y_data = U.load_TFdataset(fTFR[dtype], ncores, batch_size,
+                                          buffer_size, inD, outD, *stats,
+                                          block=block, dtype=np.dtype(dtype))
+        n   = 0
+        rss = 0
+        ysum  = 0
+        y2sum = 0
+        with tf.Session() as sess:
+            for i in range(nbatches):
+                ref, dat = sess.run([y_ref, y_data])
+                ref = ref.astype(np.float64)
+                n     += ref.shape[0]
+                rss   += np.sum((dat - ref)**2, axis=0)
+                ysum  += np.sum(ref,    axis=0)
+                y2sum += np.sum(ref**2, axis=0)
+        tss = y2sum - ysum**2 / n
+        res['rmse'] = np.mean((rss / n)**0.5)
+        res['r2']   = np.mean(1 - rss / tss)
+        results[dtype] = res
+
+    if verb:
+        print('')
+        print('dtype    | size (MB) | cases/s   | RMSE      | R2')
+        print('---------|-----------|-----------|-----------|----------')
+        for dtype in dtypes:
+            res = results[dtype]
+            print('{:8s} | {:9.2f} | {:9.1f} | {:9.3e} | {:.8f}'.format(
+                  dtype, res['bytes']/1024**2, res['rate'],
+                  res['rmse'], res['r2']))
+
+    return results
+
+
+def backend(files, inD, outD, ilog, olog, batch_size, tmpdir,
+            nbatches=None, ncores=1, buffer_size=10, block=0,
+            normalize=True, scale=True, scalelims=[-1, 1], verb=1):
+    """
+    Compares the throughput of serving batches from TFRecords and from packed
+    data (see packed.py).
+
+    Inputs
+    ------
+    files     : list, strings. Processed .NPY data files to benchmark with.
+    inD       : int.   Dimensionality of the inputs.
+    outD      : int.   Dimensionality of the outputs.
+    ilog      : bool.  Determines whether to take the log10 of the inputs.
+    olog      : bool.  Determines whether to take the log10 of the outputs.
+    batch_size: int.   Size of batches.
+    tmpdir    : string. Path/to/directory to write the benchmark data.
+    nbatches  : int.   Number of batches to time.  If None, uses all batches.
+    ncores    : int.   Number of cores to use for parallel loading.
+    buffer_size: int.  Number of batches to pre-load into memory.
+    block     : int.   Number of cases per TFRecords record.
+    normalize : bool.  Determines whether to normalize the data.
+    scale     : bool.  Determines whether to scale the data.
+    scalelims : list, floats. [min, max] of range of scaled data.
+    verb      : int.   Verbosity level.
+
+    Outputs
+    -------
+    results: dict. Cases per second served by each backend ('tfrecord',
+                   'packed').
+
+    Notes
+    -----
+    Both backends deliver NumPy arrays of normalized and scaled, shuffled
+    batches, as the NN receives them.  The packed data are read from the page cache after
+    the first pass, like a cached TFRecords pipeline.
+    """
+    U.make_dir(tmpdir)
+    mean, stdev, datmin, datmax = S.mean_stdev(files, inD, ilog, olog,
+                                               ncores=ncores)
+    if normalize:
+        x_mean, y_mean = mean [:inD], mean [inD:]
+        x_std,  y_std  = stdev[:inD], stdev[inD:]
+    else:
+        x_mean, y_mean = 0., 0.
+        x_std,  y_std  = 1., 1.
+    if scale:
+        x_min = U.normalize(datmin[:inD], x_mean, x_std)
+        x_max = U.normalize(datmax[:inD], x_mean, x_std)
+        y_min = U.normalize(datmin[inD:], y_mean, y_std)
+        y_max = U.normalize(datmax[inD:], y_mean, y_std)
+    else:
+        x_min, x_max, y_min, y_max = 0., 1., 0., 1.
+        scalelims = [0., 1.]
+    stats = (x_mean, x_std, y_mean, y_std, x_min, x_max, y_min, y_max,
+             scalelims)
+    e_batches = U.data_set_size(files, ncores) // batch_size
+    if nbatches is None or nbatches > e_batches:
+        nbatches = e_batches
+
+    results = {}
+    # TFRecords
+    fname = os.path.join(tmpdir, 'bench_backend.tfrecords')
+    for foo in glob.glob(fname.replace('.tfrecords', '*.tfrecords')):
+        os.remove(foo)
+    if verb:
+        print('Writing TFRecords...')
+    U.make_TFRecord(fname, files, inD, ilog, olog, batch_size, e_batches,
+                    verb=verb, ncores=ncores, block=block)
+    fTFR = sorted(glob.glob(fname.replace('.tfrecords', '*.tfrecords')))
+    tf.reset_default_graph()
+    x_data, y_data = U.load_TFdataset(fTFR, ncores, batch_size, buffer_size,
+                                      inD, outD, *stats, shuffle=True,
+                                      block=block)
+    results['tfrecord'] = _pipeline_rate(x_data, y_data, nbatches, batch_size)
+
+    # Packed data
+    fpack = os.path.join(tmpdir, 'bench_backend.npy')
+    if verb:
+        print('Writing packed data...')
+    PK.make_packed(fpack, files, inD, ilog, olog, *stats, verb=verb)
+    # Shuffled as in training, like the TFRecords pipeline
+    seq   = PK.PackedSequence(fpack, batch_size, nbatches, shuffle=True)
+    seq.on_epoch_end()
+    order = np.random.permutation(nbatches)
+    # First batch includes the start-up cost
+    seq[0]
+    tbeg  = time.time()
+    for i in order:
+        x_batch, y_batch = seq[i]
+        x_batch = np.ascontiguousarray(x_batch)
+        y_batch = np.ascontiguousarray(y_batch)
+    tend  = time.time()
+    results['packed'] = nbatches * batch_size / (tend - tbeg)
+
+    if verb:
+        print('')
+        print('backend  | cases/s')
+        print('---------|----------')
+        for key in ['tfrecord', 'packed']:
+            print('{:8s} | {:.1f}'.format(key, results[key]))
+
+    return results
+
+
+def inference(model, fonnx=None, fnpz=None, nthreads=1,
+              batch_sizes=[1, 64, 1024], nrep=50, verb=1):
+    """
+    Compares the latency and throughput of predictions with Keras, ONNX
+    Runtime (see onnxengine.py), and the NumPy engine (see engine.py).
+
+    Inputs
+    ------
+    model      : Keras model.  Trained model that takes fed inputs.
+    fonnx      : string. path/to/exported model .onnx.  If None, skipped.
+    fnpz       : string. path/to/exported model .npz.   If None, skipped.
+    nthreads   : int.    Number of intra-op threads for ONNX Runtime.
+    batch_sizes: list, ints. Batch sizes to time.
+    nrep       : int.    Number of predictions to time per batch size.
+    verb       : int.    Verbosity level.
+
+    Outputs
+    -------
+    results: dict. For each backend ('keras', 'onnx', 'numpy'), a dict with
+                   the median latency per batch ('latency', in ms) and the
+                   throughput ('throughput', in cases/s) for each batch size.
+
+    Notes
+    -----
+    The timings do not depend on the input values, so random inputs are used.
+    The ONNX and NumPy timings include the processing of the inputs and
+    outputs (log, normalization, scaling); the Keras timings do not.
+    """
+    import engine     as E
+    import onnxengine as O
+
+    xlen = int(model.input_shape[-1])
+    x    = np.random.uniform(0.1, 1., (max(batch_sizes), xlen))
+    predictors = {'keras' : model.predict}
+    if fonnx is not None:
+        predictors['onnx']  = O.OnnxModel(fonnx, nthreads).predict
+    if fnpz is not None:
+        predictors['numpy'] = E.NumpyModel(fnpz).predict
+
+    results = {}
+    for key in predictors:
+        results[key] = {'latency' : [], 'throughput' : []}
+        for bs in batch_sizes:
+            xb = x[:bs].astype(np.float32)
+            # First call includes the start-up cost
+            predictors[key](xb)
+            times = np.zeros(nrep)
+            for i in range(nrep):
+                tbeg     = time.time()
+                predictors[key](xb)
+                times[i] = time.time() - tbeg
+            results[key]['latency'   ].append(1000 * np.median(times))
+            results[key]['throughput'].append(bs * nrep / np.sum(times))
+
+    if verb:
+        print('')
+        print('backend | batch size | latency (ms) | cases/s')
+        print('--------|------------|--------------|----------')
+        for key in results:
+            for j, bs in enumerate(batch_sizes):
+                print('{:7s} | {:10d} | {:12.3f} | {:.1f}'.format(key, bs,
+                      results[key]['latency'][j],
+                      results[key]['throughput'][j]))
+
+    return results
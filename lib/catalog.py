@@ -0,0 +1,352 @@
+"""
+Module that contains functions related to the data set catalog.
+
+The catalog is a JSON file in the data directory that records, for each .NPY
+file of the training, validation, and test sets, its number of cases, number
+of elements per case, data type, file size, modification time, and,
+optionally, checksum.  Files are identified by their checksums if computed,
+otherwise by their sizes and modification times.  It also records the fingerprint of the data set that each derived product
+(statistics, TFRecords, etc.) was made from, so that stale products are
+detected when the data files change.
+
+read_header: Reads the shape and data type of a .NPY file from its header.
+
+checksum: Computes the checksum of a file.
+
+_entry: Helper function to make the catalog entry of a data file.
+
+load_catalog: Loads the catalog of a data directory.
+
+save_catalog: Saves the catalog of a data directory.
+
+update_catalog: Updates the catalog for the current data files, only
+                recomputing the entries of new or modified files.
+
+get_files: Gets the data files of a data set.
+
+get_size: Gets the number of cases in a data set.
+
+fingerprint: Computes a fingerprint of a data set.
+
+is_current: Checks if a derived product was made from the current data.
+
+set_product: Records the data that a derived product was made from.
+
+get_value: Gets the value recorded with a derived product.
+
+"""
+
+import sys, os
+import glob
+import json
+import hashlib
+import multiprocessing as mp
+import numpy as np
+
+
+CATALOG = 'catalog.json'
+DATASETS = ['train', 'valid', 'test']
+
+
+def read_header(fname):
+    """
+    Reads the shape and data type of a .NPY file from its header, without
+    reading the data.
+
+    Inputs
+    ------
+    fname: string. path/to/file.npy
+
+    Outputs
+    -------
+    shape: tuple. Shape of the array.
+    dtype: string. Data type of the array.
+    """
+    with open(fname, 'rb') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran, dtype = np.lib.format.read_array_header_2_0(f)
+    return shape, dtype.str
+
+
+def checksum(fname, bufsize=2**24):
+    """
+    Computes the MD5 checksum of a file, reading it in pieces.
+
+    Inputs
+    ------
+    fname  : string. path/to/file
+    bufsize: int.    Number of bytes to read at once.
+
+    Outputs
+    -------
+    md5: string. Hex digest of the file's MD5 checksum.
+    """
+    md5 = hashlib.md5()
+    with open(fname, 'rb') as f:
+        for buf in iter(lambda: f.read(bufsize), b''):
+            md5.update(buf)
+    return md5.hexdigest()
+
+
+def _entry(args):
+    """
+    Helper function for multiprocessing.  Makes the catalog entry of a file.
+
+    Inputs
+    ------
+    args: tuple. (fname, docheck), where fname is path/to/file.npy, and
+                 docheck determines whether to compute the checksum.
+
+    Outputs
+    -------
+    entry: dict. Catalog entry of `fname`.
+    """
+    fname, docheck = args
+    fstat = os.stat(fname)
+    shape, dtype = read_header(fname)
+    if len(shape) == 2:
+        nrows, ncols = shape
+    else:
+        # Not a 2D array -- has no usable cases
+        nrows, ncols = 0, shape[-1] if len(shape) else 0
+    entry = {'nrows' : int(nrows),
+             'ncols' : int(ncols),
+             'shape' : [int(v) for v in shape],
+             'dtype' : dtype,
+             'size'  : fstat.st_size,
+             'mtime' : fstat.st_mtime,
+             'checksum' : checksum(fname) if docheck else None}
+    return entry
+
+
+def load_catalog(datadir):
+    """
+    Loads the catalog of a data directory.
+
+    Inputs
+    ------
+    datadir: string. path/to/data directory, containing train/, valid/, and
+                     test/ subdirectories.
+
+    Outputs
+    -------
+    catalog: dict. The catalog.  Empty if there is no (readable) catalog.
+    """
+    fcat = os.path.join(datadir, CATALOG)
+    if os.path.exists(fcat):
+        try:
+            with open(fcat, 'r') as f:
+                catalog = json.load(f)
+            return catalog
+        except ValueError:
+            print("*WARNING*: Could not read the catalog", fcat)
+            print("It will be rebuilt.")
+    return {'files' : {dset : {} for dset in DATASETS}, 'products' : {}}
+
+
+def save_catalog(datadir, catalog):
+    """
+    Saves the catalog of a data directory.
+
+    Inputs
+    ------
+    datadir: string. path/to/data directory.
+    catalog: dict.   The catalog.
+
+    Outputs
+    -------
+    `datadir`/catalog.json
+    """
+    fcat = os.path.join(datadir, CATALOG)
+    # Write to a temporary file first, so the catalog is never left partial
+    with open(fcat + '.tmp', 'w') as f:
+        json.dump(catalog, f, indent=1, sort_keys=True)
+    os.replace(fcat + '.tmp', fcat)
+
+
+def update_catalog(datadir, ncores=1, docheck=False, verb=1):
+    """
+    Updates the catalog of a data directory for the current data files.
+    Only the entries of new or modified files (by size and modification time)
+    are recomputed, and entries of removed files are dropped.
+
+    Inputs
+    ------
+    datadir: string. path/to/data directory, containing train/, valid/, and
+                     test/ subdirectories.
+    ncores : int.    Number of processes to use for new/modified files.
+    docheck: bool.   Determines whether to compute the checksums of the files.
+                     This reads every new or modified file in full.
+    verb   : int.    Verbosity level.
+
+    Outputs
+    -------
+    catalog: dict.   The updated catalog, also saved in `datadir`.
+    """
+    catalog = load_catalog(datadir)
+    todo    = []
+    nremove = 0
+    for dset in DATASETS:
+        entries = catalog['files'].setdefault(dset, {})
+        current = sorted(glob.glob(os.path.join(datadir, dset, '*.npy')))
+        names   = [os.path.basename(foo) for foo in current]
+        # Drop removed files
+        for name in list(entries.keys()):
+            if name not in names:
+                del entries[name]
+                nremove += 1
+        # Find new or modified files
+        for name, foo in zip(names, current):
+            fstat = os.stat(foo)
+            if name not in entries                         or \
+               entries[name]['size']  != fstat.st_size     or \
+               entries[name]['mtime'] != fstat.st_mtime    or \
+               (docheck and entries[name]['checksum'] is None):
+                todo.append((dset, name, foo))
+
+    if len(todo) or nremove:
+        if verb:
+            print("Updating the data catalog:", len(todo),
+                  "new/modified files,", nremove, "removed files.")
+        args = [(foo, docheck) for dset, name, foo in todo]
+        if ncores > 1 and len(todo) > 1:
+            pool    = mp.Pool(min(ncores, len(todo)))
+            results = pool.map(_entry, args)
+            pool.close()
+            pool.join()
+        else:
+            results = list(map(_entry, args))
+        for (dset, name, foo), entry in zip(todo, results):
+            catalog['files'][dset][name] = entry
+        save_catalog(datadir, catalog)
+    return catalog
+
+
+def get_files(catalog, datadir, dset):
+    """
+    Gets the data files of a data set, in a fixed order.
+
+    Inputs
+    ------
+    catalog: dict.   The catalog.
+    datadir: string. path/to/data directory.
+    dset   : string. Data set: 'train', 'valid', or 'test'.
+
+    Outputs
+    -------
+    files: list, strings. Paths/to/data files of the data set.
+    """
+    return [os.path.join(datadir, dset, name)
+            for name in sorted(catalog['files'][dset])]
+
+
+def get_size(catalog, dset):
+    """
+    Gets the number of cases in a data set, from the catalog.
+
+    Inputs
+    ------
+    catalog: dict.   The catalog.
+    dset   : string. Data set: 'train', 'valid', or 'test'.
+
+    Outputs
+    -------
+    ncases: int. Number of cases in the data set.
+    """
+    return sum([entry['nrows'] for entry in catalog['files'][dset].values()])
+
+
+def fingerprint(catalog, dset):
+    """
+    Computes a fingerprint of a data set, which changes if any of its data
+    files are added, removed, or modified.
+
+    Inputs
+    ------
+    catalog: dict.   The catalog.
+    dset   : string. Data set: 'train', 'valid', or 'test'.
+
+    Outputs
+    -------
+    fp: string. Fingerprint of the data set.
+    """
+    md5 = hashlib.md5()
+    for name in sorted(catalog['files'][dset]):
+        entry = catalog['files'][dset][name]
+        if entry['checksum'] is not None:
+            ident = entry['checksum']
+        else:
+            ident = str(entry['size']) + '-' + str(entry['mtime'])
+        md5.update((name + ':' + ident + ';').encode())
+    return md5.hexdigest()
+
+
+def is_current(catalog, product, fp, settings=None):
+    """
+    Checks if a derived product was made from the current data, with the
+    same settings.
+
+    Inputs
+    ------
+    catalog : dict.   The catalog.
+    product : string. Identifier of the product, e.g., path/to/mean.npy
+    fp      : string. Fingerprint of the data the product is made from.
+    settings: dict.   Settings used to make the product.
+
+    Outputs
+    -------
+    current: bool or None.  True if the product was made from the current
+                            data with the same settings, False if not, and
+                            None if the product is not in the catalog.
+    """
+    if product not in catalog['products']:
+        return None
+    record = catalog['products'][product]
+    return record['fingerprint'] == fp and \
+           record['settings']    == json.loads(json.dumps(settings))
+
+
+def set_product(datadir, catalog, product, fp, settings=None, value=None):
+    """
+    Records the data and settings that a derived product was made from, and
+    saves the catalog.
+
+    Inputs
+    ------
+    datadir : string. path/to/data directory.
+    catalog : dict.   The catalog.
+    product : string. Identifier of the product, e.g., path/to/mean.npy
+    fp      : string. Fingerprint of the data the product is made from.
+    settings: dict.   Settings used to make the product.
+    value   : JSON-serializable.  Value to record with the product, e.g., 
+                      the number of cases written to a data set's TFRecords.
+
+    Outputs
+    -------
+    None.  The catalog is updated and saved.
+    """
+    catalog['products'][product] = {'fingerprint' : fp,
+                                    'settings'    : settings,
+                                    'value'       : value}
+    save_catalog(datadir, catalog)
+
+
+def get_value(catalog, product):
+    """
+    Gets the value recorded with a derived product.
+
+    Inputs
+    ------
+    catalog: dict.   The catalog.
+    product: string. Identifier of the product.
+
+    Outputs
+    -------
+    value: The value recorded by set_product(), or None.
+    """
+    if product not in catalog['products']:
+        return None
+    return catalog['products'][product].get('value')
@@ -28,11 +28,12 @@ def generate_data(cfile, data_dir=None):
     return
 
 
-def process_data(cfile, data_dir, preserve=True):
+def process_data(cfile, data_dir, preserve=True, dtype=np.float64):
     """
     Handles data processing to match what MARGE expects.
     NOTE: this will nearly double the amount of disk space used if 
           the `preserve` flag is True!
+    `dtype` sets the data type of the saved, processed data.
     """
     print('Processing the BART data...')
     # Load config file
@@ -108,7 +109,8 @@ def process_data(cfile, data_dir, preserve=True):
                 stack   = np.delete(stack , badinds, axis=0)
                 pslice  = np.delete(pslice, badinds, axis=0)
                 # Combine arrays so each vector is params then model
-                savearr = np.concatenate((pslice, stack), axis=-1)
+                savearr = np.concatenate((pslice, stack), 
+                                         axis=-1).astype(dtype, copy=False)
                 del pslice, stack
                 # Save the data
                 fsave   = savemodel.replace('.npy', 
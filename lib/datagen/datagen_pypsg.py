@@ -23,11 +23,12 @@ def generate_data(cfile, data_dir=None):
     sys.exit()
 
 
-def process_data(cfile, data_dir, preserve=True):
+def process_data(cfile, data_dir, preserve=True, dtype=np.float64):
     """
     Handles data processing to match what MARGE expects.
     NOTE: this will nearly double the amount of disk space used if 
           the `preserve` flag is True!
+    `dtype` sets the data type of the saved, processed data.
     """
     print('Processing the pypsg data...')
     # Load config file
@@ -83,7 +84,8 @@ def process_data(cfile, data_dir, preserve=True):
                     dat     = np.load(foos[j])
                     inarr   = dat[:, ibeg:iend]
                     outarr  = dat[:, obeg:oend]
-                    savearr = np.concatenate((inarr, outarr), axis=-1)
+                    savearr = np.concatenate((inarr, outarr), 
+                                             axis=-1).astype(dtype, copy=False)
                     fsave   = outdir + foos[j].rsplit(os.sep, 1)[-1]
                     np.save(fsave, savearr)
                 print('')
@@ -3,7 +3,7 @@ import sys, os, glob
 import numpy as np
 import configparser
 
-def process_data(cfile, data_dir, preserve=True):
+def process_data(cfile, data_dir, preserve=True, dtype=np.float64):
         
     config = configparser.ConfigParser(allow_no_value = True)
     config.read_file(open(cfile, 'r'))
@@ -59,9 +59,9 @@ def process_data(cfile, data_dir, preserve=True):
                     # As of right now the parameters are included in the config file as a magic number, 
                     # but they should be read by the given file and input later. 
 
-                    teststack = np.zeros((conf.getint('cases'), conf.getint('slice_param')), dtype='f')
-                    validstack = np.zeros((conf.getint('cases'), conf.getint('slice_param')), dtype='f')
-                    trainstack = np.zeros((conf.getint('cases'), conf.getint('slice_param')), dtype='f')
+                    teststack = np.zeros((conf.getint('cases'), conf.getint('slice_param')), dtype=dtype)
+                    validstack = np.zeros((conf.getint('cases'), conf.getint('slice_param')), dtype=dtype)
+                    trainstack = np.zeros((conf.getint('cases'), conf.getint('slice_param')), dtype=dtype)
             
                     for n, file in enumerate(files):
                         # Returns the 2D array as well if it was needed for something...
@@ -110,7 +110,7 @@ def read_file(conf, file):
         params = head[:conf.getint('parameters')].astype(float)
         
         # microns | Flux (erg/cm^2/s/Hz)
-        data_arr = np.loadtxt(file, dtype='f', skiprows=2, unpack=True)
+        data_arr = np.loadtxt(file, dtype=np.float64, skiprows=2, unpack=True)
         dat_slice = data_arr[0,:]
 
         print(dat_slice)
@@ -0,0 +1,696 @@
+"""
+Module that contains a standalone NumPy inference engine for trained MARGE
+models.  It only depends on NumPy, so it starts in milliseconds, rather than
+the tens of seconds needed to import Keras/Tensorflow and rebuild the graph.
+
+A model is exported to a single, uncompressed .NPZ file that holds the layer
+weights, the layer configurations, and the constants to process the inputs
+and outputs (log, normalization, scaling).  Its arrays are memory-mapped when
+loaded.
+
+ACTIVATIONS: dict of supported activation functions.
+
+ACTIVATION_JVPS: dict of the Jacobian-vector products of the activations.
+
+export_npz: Exports a trained Keras model to a .NPZ file.
+
+_mmap_npz: Helper function to memory-map the arrays of an uncompressed .NPZ
+           file.
+
+verify: Checks that a NumpyModel matches a Keras model.
+
+NumpyModel: class that makes predictions from an exported model.
+
+PredictionCache: class that memoizes the predictions of a model.
+
+_predict_chunk: Helper function to predict a range of cases of a file.
+
+predict_file: Predicts the outputs for an array of inputs in a .NPY file, 
+              streaming them to a .NPY file.
+
+"""
+
+import sys, os
+import json
+import zipfile
+import multiprocessing as mp
+import collections
+import numpy as np
+
+
+def _softmax(x, axis=-1):
+    ex = np.exp(x - np.amax(x, axis=axis, keepdims=True))
+    return ex / np.sum(ex, axis=axis, keepdims=True)
+
+
+def _elu(x, alpha=1.0):
+    return np.where(x > 0, x, alpha * (np.exp(np.minimum(x, 0)) - 1))
+
+
+def _relu(x, max_value=None, negative_slope=0., threshold=0.):
+    y = np.where(x >= threshold, x, negative_slope * (x - threshold))
+    if max_value is not None:
+        y = np.minimum(y, max_value)
+    return y
+
+
+def _relu_jvp(x, y, t, max_value=None, negative_slope=0., threshold=0.):
+    d = np.where(x >= threshold, 1., negative_slope)
+    if max_value is not None:
+        d = np.where(y < max_value, d, 0.)
+    return d * t
+
+
+def _elu_jvp(x, y, t, alpha=1.0):
+    return np.where(x > 0, 1., y + alpha) * t
+
+
+def _softmax_jvp(x, y, t, axis=-1):
+    # Tangents have a leading axis over the inputs
+    if axis >= 0:
+        axis += 1
+    return y * (t - np.sum(y * t, axis=axis, keepdims=True))
+
+
+# Activations named in Keras layer configurations; see loader.load_activation
+ACTIVATIONS = {'linear'      : lambda x: x,
+               'exponential' : np.exp,
+               'sigmoid'     : lambda x: 1. / (1. + np.exp(-x)),
+               'tanh'        : np.tanh,
+               'relu'        : _relu,
+               'elu'         : _elu,
+               'softmax'     : _softmax}
+
+# Jacobian-vector products of the activations: given the activation's input
+# x, output y, and tangents t (shaped (inputs,) + x.shape), returns dy/dx . t
+ACTIVATION_JVPS = {'linear'      : lambda x, y, t: t,
+                   'exponential' : lambda x, y, t: y * t,
+                   'sigmoid'     : lambda x, y, t: y * (1. - y) * t,
+                   'tanh'        : lambda x, y, t: (1. - y**2) * t,
+                   'relu'        : _relu_jvp,
+                   'elu'         : _elu_jvp,
+                   'softmax'     : _softmax_jvp}
+
+
+def export_npz(model, fname, ilog, olog,
+               x_mean, x_std, y_mean, y_std,
+               x_min,  x_max, y_min,  y_max, scalelims):
+    """
+    Exports a trained Keras model to a .NPZ file for the NumPy engine.
+
+    Inputs
+    ------
+    model    : Keras model.  Trained model, as a chain of layers (see
+                             NN.NNModel).
+    fname    : string. path/to/file.npz to save.
+    ilog     : bool or list, ints. Inputs  that are log10-scaled.
+    olog     : bool or list, ints. Outputs that are log10-scaled.
+    x_mean   : array. Mean  values of the input  data.
+    x_std    : array. Stdev values of the input  data.
+    y_mean   : array. Mean  values of the output data.
+    y_std    : array. Stdev values of the output data.
+    x_min    : array. Minima of the normalized input  data.
+    x_max    : array. Maxima of the normalized input  data.
+    y_min    : array. Minima of the normalized output data.
+    y_max    : array. Maxima of the normalized output data.
+    scalelims: list, floats. [min, max] of the scaled data range.
+
+    Outputs
+    -------
+    `fname`, containing the array 'config' (JSON string of the layers and
+    input/output sizes), each layer's weights as 'L<i>_<j>', and the
+    processing constants.
+    """
+    xlen = int(model.input_shape[-1])
+    ylen = int(model.output_shape[-1])
+    config = {'xlen' : xlen, 'ylen' : ylen, 'layers' : []}
+    arrays = {}
+    for i, layer in enumerate(model.layers):
+        ltype = layer.__class__.__name__
+        lconf = layer.get_config()
+        if ltype in ['InputLayer', 'Dropout']:
+            # Nothing to do at inference
+            continue
+        elif ltype == 'Dense':
+            spec = {'activation' : lconf['activation']}
+        elif ltype in ['Conv1D', 'Convolution1D']:
+            ltype = 'Conv1D'
+            if tuple(lconf['strides']) != (1,) or \
+               tuple(lconf['dilation_rate']) != (1,):
+                raise ValueError("Only Conv1D layers with strides and " +\
+                                 "dilation rate of 1 can be exported.")
+            spec = {'activation' : lconf['activation'],
+                    'padding'    : lconf['padding']}
+        elif ltype in ['MaxPooling1D', 'AveragePooling1D']:
+            if lconf['padding'] != 'valid':
+                raise ValueError("Only pooling layers with 'valid' padding " +\
+                                 "can be exported.")
+            spec = {'pool_size' : int(lconf['pool_size'][0]),
+                    'strides'   : int(lconf['strides'][0])}
+        elif ltype == 'Reshape':
+            spec = {'target_shape' : list(lconf['target_shape'])}
+        elif ltype == 'Flatten':
+            spec = {}
+        elif ltype == 'ReLU':
+            spec = {'max_value'      : lconf.get('max_value'),
+                    'negative_slope' : float(lconf.get('negative_slope', 0.)),
+                    'threshold'      : float(lconf.get('threshold', 0.))}
+        elif ltype in ['LeakyReLU', 'ELU']:
+            spec = {'alpha' : float(lconf['alpha'])}
+        elif ltype == 'Softmax':
+            spec = {'axis' : int(lconf.get('axis', -1))}
+        elif ltype == 'Activation':
+            spec = {'activation' : lconf['activation']}
+        else:
+            raise ValueError("Layer type cannot be exported: " + ltype)
+        if 'activation' in spec and spec['activation'] not in ACTIVATIONS:
+            raise ValueError("Activation cannot be exported: " + \
+                             spec['activation'])
+        weights = layer.get_weights()
+        for j, w in enumerate(weights):
+            arrays['L' + str(i) + '_' + str(j)] = w
+        spec['type']     = ltype
+        spec['index']    = i
+        spec['nweights'] = len(weights)
+        config['layers'].append(spec)
+
+    # Log-scaled indices
+    for key, vlog, vlen in [('ilog', ilog, xlen), ('olog', olog, ylen)]:
+        if vlog is True:
+            arrays[key] = np.arange(vlen)
+        elif not vlog:
+            arrays[key] = np.zeros(0, dtype=int)
+        else:
+            arrays[key] = np.asarray(vlog, dtype=int)
+    # Processing constants, as full arrays
+    for key, val, vlen in [('x_mean', x_mean, xlen), ('x_std', x_std, xlen),
+                           ('x_min',  x_min,  xlen), ('x_max', x_max, xlen),
+                           ('y_mean', y_mean, ylen), ('y_std', y_std, ylen),
+                           ('y_min',  y_min,  ylen), ('y_max', y_max, ylen)]:
+        arrays[key] = np.broadcast_to(np.asarray(val, dtype=np.float64),
+                                      (vlen,)).copy()
+    arrays['scalelims'] = np.asarray(scalelims, dtype=np.float64)
+    arrays['config']    = np.array(json.dumps(config))
+
+    # Uncompressed, so that the arrays can be memory-mapped
+    np.savez(fname, **arrays)
+    return
+
+
+def _mmap_npz(fname):
+    """
+    Memory-maps the arrays of an uncompressed .NPZ file.
+
+    Inputs
+    ------
+    fname: string. path/to/file.npz
+
+    Outputs
+    -------
+    arrays: dict. Arrays of the file, keyed by name.  Arrays that cannot be
+                  memory-mapped (e.g., strings) are read.
+    """
+    arrays = {}
+    with zipfile.ZipFile(fname) as zf, open(fname, 'rb') as f:
+        for info in zf.infolist():
+            name = info.filename.rsplit('.npy', 1)[0]
+            if info.compress_type != zipfile.ZIP_STORED:
+                arrays[name] = np.lib.format.read_array(zf.open(info))
+                continue
+            # Skip the local file header: 30 bytes, then the name and extra
+            f.seek(info.header_offset)
+            header = f.read(30)
+            nname  = int.from_bytes(header[26:28], 'little')
+            nextra = int.from_bytes(header[28:30], 'little')
+            f.seek(info.header_offset + 30 + nname + nextra)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran, dtype = np.lib.format.read_array_header_2_0(f)
+            if dtype.hasobject or dtype.kind == 'U' or not np.prod(shape):
+                arrays[name] = np.lib.format.read_array(zf.open(info))
+            else:
+                arrays[name] = np.memmap(f.name, dtype=dtype, mode='r',
+                                         offset=f.tell(), shape=shape,
+                                         order='F' if fortran else 'C')
+    return arrays
+
+
+def verify(model, engine, x, rtol=1e-4, atol=1e-5):
+    """
+    Checks that a NumpyModel matches a Keras model.
+
+    Inputs
+    ------
+    model : Keras model.  Model that takes fed inputs.
+    engine: NumpyModel.   Engine made from the model's export.
+    x     : array.        Normalized and scaled inputs to compare on.
+    rtol  : float.        Relative tolerance.
+    atol  : float.        Absolute tolerance.
+
+    Outputs
+    -------
+    maxdiff: float. Maximum absolute difference of the outputs.
+    """
+    pred_keras = model.predict(x)
+    pred_numpy = engine.forward(x)
+    maxdiff    = np.amax(np.abs(pred_keras - pred_numpy))
+    if not np.allclose(pred_numpy, pred_keras, rtol=rtol, atol=atol):
+        raise ValueError("The NumPy engine does not match the Keras model." +\
+                         "\nMaximum absolute difference: " + str(maxdiff))
+    return maxdiff
+
+
+class NumpyModel:
+    """
+    Makes predictions from a model exported by export_npz(), using NumPy only.
+    """
+    def __init__(self, fname, mmap=True):
+        """
+        fname: string. path/to/exported model .npz
+        mmap : bool.   Determines whether to memory-map the arrays.
+        """
+        if mmap:
+            arrays = _mmap_npz(fname)
+        else:
+            arrays = dict(np.load(fname))
+        config = json.loads(str(arrays['config']))
+        self.xlen   = config['xlen']
+        self.ylen   = config['ylen']
+        self.layers = config['layers']
+        self.weights = [[arrays['L' + str(spec['index']) + '_' + str(j)]
+                         for j in range(spec['nweights'])]
+                        for spec in self.layers]
+        self.ilog   = arrays['ilog']
+        self.olog   = arrays['olog']
+        self.x_mean = arrays['x_mean']
+        self.x_std  = arrays['x_std']
+        self.y_mean = arrays['y_mean']
+        self.y_std  = arrays['y_std']
+        self.x_min  = arrays['x_min']
+        self.x_max  = arrays['x_max']
+        self.y_min  = arrays['y_min']
+        self.y_max  = arrays['y_max']
+        self.scalelims = arrays['scalelims']
+
+    def _linear(self, spec, weights, x, bias=True):
+        """
+        Applies the linear part of a layer.  Used for both the activations 
+        and, without biases, their tangents.
+        """
+        ltype = spec['type']
+        if ltype == 'Dense':
+            x = np.dot(x, weights[0])
+        elif ltype == 'Conv1D':
+            kern = weights[0] # (kernel size, in channels, out channels)
+            ksiz = kern.shape[0]
+            if spec['padding'] == 'same':
+                left = (ksiz - 1) // 2
+                x    = np.pad(x, ((0, 0), (left, ksiz - 1 - left), (0, 0)),
+                              'constant')
+            nout = x.shape[1] - ksiz + 1
+            y    = np.dot(x[:, :nout], kern[0])
+            for j in range(1, ksiz):
+                y += np.dot(x[:, j:j+nout], kern[j])
+            x = y
+        elif ltype == 'AveragePooling1D':
+            x = np.mean(self._windows(spec, x), axis=0)
+        elif ltype == 'Reshape':
+            x = x.reshape((x.shape[0],) + tuple(spec['target_shape']))
+        elif ltype == 'Flatten':
+            x = x.reshape(x.shape[0], -1)
+        if bias and ltype in ['Dense', 'Conv1D'] and len(weights) > 1:
+            x = x + weights[1]
+        return x
+
+    def _windows(self, spec, x):
+        """
+        Stacks the pooling windows of a pooling layer.
+        """
+        pool = spec['pool_size']
+        step = spec['strides']
+        nout = (x.shape[1] - pool) // step + 1
+        return np.array([x[:, j : j + step*(nout-1) + 1 : step]
+                         for j in range(pool)])
+
+    def _run(self, x, t=None):
+        """
+        Runs the network, optionally carrying tangents along 
+        (forward-mode differentiation).
+
+        Inputs
+        ------
+        x: array. Normalized and scaled inputs, shaped (cases, inputs).
+        t: array. Tangents of `x`, shaped (tangents, cases, inputs).
+
+        Outputs
+        -------
+        x: array. Normalized and scaled outputs, shaped (cases, outputs).
+        t: array. Tangents of the outputs, shaped (tangents, cases, outputs).
+        """
+        for spec, weights in zip(self.layers, self.weights):
+            ltype = spec['type']
+            # Nonlinear step, if any, as (activation, keyword arguments)
+            act = None
+            if ltype in ['Dense', 'Conv1D', 'AveragePooling1D', 
+                         'Reshape', 'Flatten']:
+                x = self._linear(spec, weights, x)
+                if t is not None:
+                    # Tangents of all inputs as one batch
+                    t = self._linear(spec, weights, 
+                                     t.reshape((-1,) + t.shape[2:]), 
+                                     bias=False)
+                    t = t.reshape((-1,) + x.shape)
+            elif ltype == 'MaxPooling1D':
+                wins = self._windows(spec, x)
+                imax = np.argmax(wins, axis=0)
+                x    = np.take_along_axis(wins, imax[None], axis=0)[0]
+                if t is not None:
+                    wins = np.array([self._windows(spec, tt) for tt in t])
+                    t    = np.take_along_axis(wins, imax[None, None], 
+                                              axis=1)[:, 0]
+            elif ltype == 'ReLU':
+                act = ('relu', {'max_value'      : spec['max_value'], 
+                                'negative_slope' : spec['negative_slope'], 
+                                'threshold'      : spec['threshold']})
+            elif ltype == 'LeakyReLU':
+                act = ('relu', {'negative_slope' : spec['alpha']})
+            elif ltype == 'ELU':
+                act = ('elu', {'alpha' : spec['alpha']})
+            elif ltype == 'Softmax':
+                act = ('softmax', {'axis' : spec['axis']})
+            if act is None and 'activation' in spec:
+                act = (spec['activation'], {})
+            if act is not None:
+                y = ACTIVATIONS[act[0]](x, **act[1])
+                if t is not None:
+                    t = ACTIVATION_JVPS[act[0]](x, y, t, **act[1])
+                x = y
+        return x, t
+
+    def forward(self, x):
+        """
+        Forward pass of the network.
+
+        Inputs
+        ------
+        x: array. Normalized and scaled inputs, shaped (cases, inputs).
+
+        Outputs
+        -------
+        y: array. Normalized and scaled outputs, shaped (cases, outputs).
+        """
+        return self._run(np.asarray(x, dtype=np.float32))[0]
+
+    def _preprocess(self, x):
+        """
+        Log-scales, normalizes, and scales inputs as in the data files.
+        """
+        x = np.array(x, dtype=np.float64, ndmin=2)
+        if self.ilog.size:
+            x[:, self.ilog] = np.log10(x[:, self.ilog])
+        x = (x - self.x_mean) / self.x_std
+        x = (self.scalelims[1] - self.scalelims[0]) * (x - self.x_min) / \
+            (self.x_max - self.x_min) + self.scalelims[0]
+        return x
+
+    def _postprocess(self, y):
+        """
+        Descales, denormalizes, and de-logs predicted outputs.
+        """
+        y = (y - self.scalelims[0]) / (self.scalelims[1] - self.scalelims[0])\
+            * (self.y_max - self.y_min) + self.y_min
+        y = y * self.y_std + self.y_mean
+        if self.olog.size:
+            y[:, self.olog] = 10**y[:, self.olog]
+        return y
+
+    def predict(self, x, denorm=True):
+        """
+        Predicts the outputs for some inputs.
+
+        Inputs
+        ------
+        x     : array. Inputs, as in the data files (i.e., not log-scaled,
+                       normalized, or scaled), shaped (cases, inputs) or
+                       (inputs,).
+        denorm: bool.  Determines whether to descale, denormalize, and
+                       de-log the outputs.
+
+        Outputs
+        -------
+        y: array. Predicted outputs, shaped (cases, outputs).
+        """
+        y = self.forward(self._preprocess(x)).astype(np.float64)
+        if not denorm:
+            return y
+        return self._postprocess(y)
+
+    def jacobian(self, x, chunk=1024):
+        """
+        Computes the Jacobian of the outputs with respect to the inputs, in 
+        physical units (i.e., through the log-scaling, normalization, and 
+        scaling of the inputs and outputs).
+
+        The Jacobian is propagated in forward mode, with the tangents of all 
+        inputs stacked into one batch, so each chunk of cases is a single 
+        pass through the network, however many outputs there are.  The pass 
+        is in float64.
+
+        Inputs
+        ------
+        x    : array. Inputs, as in the data files, shaped (cases, inputs) or 
+                      (inputs,).
+        chunk: int.   Number of cases to differentiate at once.  Memory use 
+                      is about inputs * chunk times that of a prediction.
+
+        Outputs
+        -------
+        y: array. Predicted outputs, shaped (cases, outputs).
+        J: array. Jacobian, dy/dx, shaped (cases, outputs, inputs).
+        """
+        x = np.array(x, dtype=np.float64, ndmin=2)
+        y = np.zeros((x.shape[0], self.ylen))
+        J = np.zeros((x.shape[0], self.ylen, self.xlen))
+        # d(processed input)/d(input), for each input
+        dxin = np.ones(x.shape) * (self.scalelims[1] - self.scalelims[0]) / \
+               (self.x_std * (self.x_max - self.x_min))
+        if self.ilog.size:
+            dxin[:, self.ilog] /= x[:, self.ilog] * np.log(10.)
+        # d(output)/d(network output)
+        dyout = (self.y_max - self.y_min) * self.y_std / \
+                (self.scalelims[1] - self.scalelims[0])
+        ind   = np.arange(self.xlen)
+        for i in range(0, x.shape[0], chunk):
+            xc = x[i : i + chunk]
+            t  = np.zeros((self.xlen,) + xc.shape)
+            t[ind, :, ind] = dxin[i : i + chunk].T
+            yc, t = self._run(self._preprocess(xc), t)
+            yc    = self._postprocess(yc)
+            t     = t * dyout
+            if self.olog.size:
+                t[:, :, self.olog] *= yc[:, self.olog] * np.log(10.)
+            y[i : i + chunk] = yc
+            J[i : i + chunk] = t.transpose(1, 2, 0)
+        return y, J
+
+
+class PredictionCache:
+    """
+    Memoizes the predictions of a model, keyed on the (optionally quantized) 
+    input vectors, e.g. for MCMC samplers that re-evaluate the same or 
+    nearly the same parameters.  Cached inputs are looked up per case; the 
+    remaining, unique cases are predicted in one batched call.
+
+    The cache holds at most `maxbytes` of outputs (plus keys).  When full, 
+    entries are evicted by `policy`: 'lru' evicts the least recently used 
+    entry, 'fifo' the oldest.
+    """
+    def __init__(self, predict, maxbytes=64*2**20, quantum=None, 
+                 policy='lru'):
+        """
+        predict : function. Predicts the outputs for an array of inputs, 
+                            shaped (cases, inputs).
+        maxbytes: int.      Maximum size of the cache, in bytes.
+        quantum : float or array. Step to round each input to before lookup, 
+                            so that inputs within a step share an entry.  
+                            If None or 0, inputs must match exactly.
+        policy  : string.   Eviction policy.  'lru' or 'fifo'.
+        """
+        if policy not in ['lru', 'fifo']:
+            raise ValueError("Invalid policy: " + policy + "\nAllowed " + \
+                             "options: 'lru' or 'fifo'.")
+        self.predict   = predict
+        self.maxbytes  = maxbytes
+        self.quantum   = np.asarray(quantum, dtype=np.float64) \
+                         if quantum is not None and np.any(quantum) else None
+        self.policy    = policy
+        self.cache     = collections.OrderedDict()
+        self.nbytes    = 0
+        self.hits      = 0
+        self.misses    = 0
+        self.evictions = 0
+
+    def _keys(self, x):
+        """
+        Makes the lookup keys of some inputs.
+        """
+        if self.quantum is not None:
+            x = np.round(x / self.quantum)
+        return [row.tobytes() for row in np.ascontiguousarray(x)]
+
+    def __call__(self, x):
+        """
+        Predicts the outputs for some inputs, using the cache.
+
+        Inputs
+        ------
+        x: array. Inputs, shaped (cases, inputs) or (inputs,).
+
+        Outputs
+        -------
+        y: array. Predicted outputs, shaped (cases, outputs).
+        """
+        x    = np.array(x, dtype=np.float64, ndmin=2)
+        keys = self._keys(x)
+        # Cached outputs, and the unique uncached cases
+        out  = {}
+        new  = collections.OrderedDict()
+        for i, key in enumerate(keys):
+            if key in self.cache:
+                self.hits += 1
+                out[key]   = self.cache[key]
+                if self.policy == 'lru':
+                    self.cache.move_to_end(key)
+            else:
+                self.misses += 1
+                if key not in new:
+                    new[key] = i
+        if new:
+            ynew = np.asarray(self.predict(x[list(new.values())]))
+            for key, y in zip(new, ynew):
+                out[key] = y
+                self._add(key, y)
+        return np.array([out[key] for key in keys])
+
+    def _add(self, key, y):
+        """
+        Adds an entry, evicting entries as needed.
+        """
+        size = y.nbytes + len(key)
+        if size > self.maxbytes:
+            return
+        while self.nbytes + size > self.maxbytes:
+            oldkey, oldy = self.cache.popitem(last=False)
+            self.nbytes    -= oldy.nbytes + len(oldkey)
+            self.evictions += 1
+        self.cache[key] = y.copy()
+        self.nbytes    += size
+
+    def stats(self):
+        """
+        Gets the statistics of the cache.
+
+        Outputs
+        -------
+        stats: dict. Numbers of hits, misses, and evictions, hit rate, and 
+                     the number of entries and bytes in the cache.
+        """
+        nlook = self.hits + self.misses
+        return {'hits'      : self.hits, 
+                'misses'    : self.misses, 
+                'hit_rate'  : self.hits / nlook if nlook else 0., 
+                'evictions' : self.evictions, 
+                'entries'   : len(self.cache), 
+                'bytes'     : self.nbytes}
+
+
+def _predict_chunk(args):
+    """
+    Helper function for multiprocessing.  Predicts a range of cases of an
+    input file into an existing output file.
+
+    Inputs
+    ------
+    args: tuple. (fmodel, finput, foutput, beg, end, chunk), where fmodel is
+                 the exported model, beg and end are the range of cases, and
+                 the rest are as in predict_file().
+
+    Outputs
+    -------
+    ncases: int. Number of cases predicted.
+    """
+    fmodel, finput, foutput, beg, end, chunk = args
+    model = NumpyModel(fmodel)
+    x     = np.load(finput,  mmap_mode='r')
+    y     = np.load(foutput, mmap_mode='r+')
+    for j in range(beg, end, chunk):
+        jend = min(j + chunk, end)
+        y[j:jend] = model.predict(x[j:jend, :model.xlen])
+    y.flush()
+    del y
+    return end - beg
+
+
+def predict_file(fmodel, finput, foutput, chunk=10000, ncores=1,
+                 dtype=np.float64, verb=1):
+    """
+    Predicts the outputs for an array of inputs saved in a .NPY file, and
+    saves them to a .NPY file.  Both files are memory-mapped, and cases are
+    predicted `chunk` at a time, so the arrays need not fit in memory.
+
+    Inputs
+    ------
+    fmodel : string. path/to/exported model .npz
+    finput : string. path/to/inputs .npy, shaped (cases, inputs) or
+                     (inputs,).  As in the data files, the inputs are not
+                     log-scaled, normalized, or scaled.  Any columns after
+                     the model's inputs are ignored.
+    foutput: string. path/to/outputs .npy to save, shaped (cases, outputs).
+    chunk  : int.    Number of cases to predict at once.
+    ncores : int.    Number of processes to predict with.
+    dtype  : data type. Data type of the saved outputs.
+    verb   : int.    Verbosity level.
+
+    Outputs
+    -------
+    `foutput`.
+    """
+    model  = NumpyModel(fmodel)
+    xshape = np.load(finput, mmap_mode='r').shape
+    if len(xshape) == 1:
+        # Single case
+        np.save(foutput, model.predict(np.load(finput)).astype(dtype))
+        return
+    if len(xshape) != 2 or xshape[1] < model.xlen:
+        raise ValueError("The inputs must be shaped (cases, inputs), with " +\
+                         "at least " + str(model.xlen) + " inputs.\n"       +\
+                         "Shape: " + str(xshape))
+    ncases = xshape[0]
+    store  = np.lib.format.open_memmap(foutput, mode='w+', dtype=dtype,
+                                       shape=(ncases, model.ylen))
+    del store
+
+    # Several tasks per process, for progress updates and load balancing
+    ntasks = max(1, min(4 * ncores, int(np.ceil(ncases / chunk))))
+    bounds = np.linspace(0, ncases, ntasks + 1).astype(int)
+    args   = [(fmodel, finput, foutput, bounds[i], bounds[i+1], chunk)
+              for i in range(ntasks) if bounds[i+1] > bounds[i]]
+    if ncores > 1:
+        pool    = mp.Pool(min(ncores, len(args)))
+        results = pool.imap_unordered(_predict_chunk, args)
+    else:
+        results = map(_predict_chunk, args)
+    ndone = 0
+    for res in results:
+        ndone += res
+        if verb:
+            print(str(int(100 * ndone / ncases)) + "% complete", end='\r')
+    if ncores > 1:
+        pool.close()
+        pool.join()
+    if verb:
+        print('')
+        print(ncases, "cases predicted.")
+    return
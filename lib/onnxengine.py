@@ -0,0 +1,199 @@
+"""
+Module that contains functions/classes to export trained MARGE models to ONNX
+and to run them with ONNX Runtime.
+
+The exported graph includes the processing of the inputs (log, normalization,
+scaling) and of the outputs (descaling, denormalization, de-log), so it takes
+inputs as in the data files and returns outputs in physical units.
+
+The ONNX packages are imported only when needed, so that importing this
+module is fast.
+
+_affine: Helper function to fold normalization and scaling into a
+         multiply-add.
+
+export_onnx: Exports a trained Keras model, with its processing steps, to ONNX.
+
+OnnxModel: class that makes predictions from an exported model with
+           ONNX Runtime.
+
+"""
+
+import sys, os
+import numpy as np
+
+
+def _affine(mean, std, vmin, vmax, scalelims, inverse=False):
+    """
+    Helper function to fold normalization and scaling into y = x * A + B.
+
+    Inputs
+    ------
+    mean     : array. Mean  values of the data.
+    std      : array. Stdev values of the data.
+    vmin     : array. Minima of the normalized data.
+    vmax     : array. Maxima of the normalized data.
+    scalelims: list, floats. [min, max] of the scaled data range.
+    inverse  : bool.  If False, normalizes then scales.
+                      If True,  descales then denormalizes.
+
+    Outputs
+    -------
+    A: array. Multiplicative factors.
+    B: array. Additive terms.
+    """
+    mean  = np.asarray(mean, dtype=np.float64)
+    std   = np.asarray(std,  dtype=np.float64)
+    srng  = scalelims[1] - scalelims[0]
+    vrng  = np.asarray(vmax, dtype=np.float64) - vmin
+    if not inverse:
+        A = srng / (std * vrng)
+        B = scalelims[0] - (mean / std + vmin) * srng / vrng
+    else:
+        A = vrng / srng * std
+        B = (vmin - scalelims[0] * vrng / srng) * std + mean
+    return A, B
+
+
+def export_onnx(model, fname, ilog, olog,
+                x_mean, x_std, y_mean, y_std,
+                x_min,  x_max, y_min,  y_max, scalelims):
+    """
+    Exports a trained Keras model to ONNX, with the processing of its inputs
+    and outputs included in the graph.
+
+    Inputs
+    ------
+    model    : Keras model.  Trained model that takes fed inputs.
+    fname    : string. path/to/file.onnx to save.
+    ilog     : bool or list, ints. Inputs  that are log10-scaled.
+    olog     : bool or list, ints. Outputs that are log10-scaled.
+    x_mean   : array. Mean  values of the input  data.
+    x_std    : array. Stdev values of the input  data.
+    y_mean   : array. Mean  values of the output data.
+    y_std    : array. Stdev values of the output data.
+    x_min    : array. Minima of the normalized input  data.
+    x_max    : array. Maxima of the normalized input  data.
+    y_min    : array. Minima of the normalized output data.
+    y_max    : array. Maxima of the normalized output data.
+    scalelims: list, floats. [min, max] of the scaled data range.
+
+    Outputs
+    -------
+    `fname`.  The graph has one input, 'x', shaped (cases, inputs), and one
+    output, 'y', shaped (cases, outputs).
+    """
+    import onnx
+    import keras2onnx
+    from onnx import helper, numpy_helper, TensorProto
+
+    xlen = int(model.input_shape[-1])
+    ylen = int(model.output_shape[-1])
+    onnx_model = keras2onnx.convert_keras(model, model.name)
+    graph      = onnx_model.graph
+    inits      = [init.name for init in graph.initializer]
+    netin      = [inp.name for inp in graph.input if inp.name not in inits][0]
+    netout     = graph.output[0].name
+
+    def const(name, val, dtype=np.float32):
+        graph.initializer.extend([numpy_helper.from_array(
+                                  np.asarray(val, dtype=dtype), name)])
+
+    def mask(vlog, vlen):
+        ind = np.zeros(vlen, dtype=bool)
+        if vlog is True:
+            ind[:] = True
+        elif vlog:
+            ind[vlog] = True
+        return ind
+
+    # Inputs: log10, then normalize & scale
+    pre = []
+    cur = 'x'
+    if np.any(mask(ilog, xlen)):
+        const('pre_ln10', np.log(10.))
+        const('pre_mask', mask(ilog, xlen), bool)
+        pre += [helper.make_node('Log', [cur],                 ['pre_ln']),
+                helper.make_node('Div', ['pre_ln', 'pre_ln10'], ['pre_log10']),
+                helper.make_node('Where', ['pre_mask', 'pre_log10', cur],
+                                 ['pre_log'])]
+        cur  = 'pre_log'
+    A, B = _affine(x_mean, x_std, x_min, x_max, scalelims)
+    const('pre_A', np.broadcast_to(A, (xlen,)))
+    const('pre_B', np.broadcast_to(B, (xlen,)))
+    pre += [helper.make_node('Mul', [cur, 'pre_A'],       ['pre_mul']),
+            helper.make_node('Add', ['pre_mul', 'pre_B'], [netin])]
+
+    # Outputs: descale & denormalize, then 10**
+    A, B = _affine(y_mean, y_std, y_min, y_max, scalelims, inverse=True)
+    const('post_A', np.broadcast_to(A, (ylen,)))
+    const('post_B', np.broadcast_to(B, (ylen,)))
+    post = [helper.make_node('Mul', [netout, 'post_A'],     ['post_mul'])]
+    if np.any(mask(olog, ylen)):
+        const('post_ln10', np.log(10.))
+        const('post_mask', mask(olog, ylen), bool)
+        post += [helper.make_node('Add', ['post_mul', 'post_B'], ['post_lin']),
+                 helper.make_node('Mul', ['post_lin', 'post_ln10'],
+                                  ['post_ln']),
+                 helper.make_node('Exp', ['post_ln'], ['post_pow']),
+                 helper.make_node('Where', ['post_mask', 'post_pow',
+                                            'post_lin'], ['y'])]
+    else:
+        post += [helper.make_node('Add', ['post_mul', 'post_B'], ['y'])]
+
+    nodes = pre + list(graph.node) + post
+    del graph.node[:]
+    graph.node.extend(nodes)
+    # Replace the network's input/output with the processed ones
+    inputs = [inp for inp in graph.input if inp.name != netin]
+    del graph.input[:]
+    graph.input.extend([helper.make_tensor_value_info('x', TensorProto.FLOAT,
+                                                      [None, xlen])] + inputs)
+    del graph.output[:]
+    graph.output.extend([helper.make_tensor_value_info('y', TensorProto.FLOAT,
+                                                       [None, ylen])])
+    # 'Where' requires opset 9
+    for opset in onnx_model.opset_import:
+        if opset.domain in ['', 'ai.onnx'] and opset.version < 9:
+            opset.version = 9
+    onnx.checker.check_model(onnx_model)
+    onnx.save_model(onnx_model, fname)
+    return
+
+
+class OnnxModel:
+    """
+    Makes predictions from a model exported by export_onnx(), using ONNX
+    Runtime on the CPU.
+    """
+    def __init__(self, fname, nthreads=1):
+        """
+        fname   : string. path/to/exported model .onnx
+        nthreads: int.    Number of threads to use within each operator.
+                          If 0, ONNX Runtime chooses.
+        """
+        import onnxruntime as ort
+        opts = ort.SessionOptions()
+        opts.intra_op_num_threads = nthreads
+        opts.inter_op_num_threads = 1
+        opts.graph_optimization_level = \
+                                ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.sess = ort.InferenceSession(fname, opts,
+                                         providers=['CPUExecutionProvider'])
+
+    def predict(self, x):
+        """
+        Predicts the outputs for some inputs.
+
+        Inputs
+        ------
+        x: array. Inputs, as in the data files (i.e., not log-scaled,
+                  normalized, or scaled), shaped (cases, inputs) or (inputs,).
+
+        Outputs
+        -------
+        y: array. Predicted outputs in physical units, shaped
+                  (cases, outputs).
+        """
+        x = np.array(x, dtype=np.float32, ndmin=2)
+        return self.sess.run(['y'], {'x' : x})[0]
@@ -0,0 +1,253 @@
+"""
+Module that contains functions/classes related to the packed data format.
+
+A packed data set is a single contiguous float32 .NPY file, where each row is
+a normalized and scaled case (inputs, then outputs), and the rows are stored
+in a random order.  An index file records the data files that were packed,
+the number of cases taken from each, and the shapes.  Batches are slices of
+the memory-mapped array, so no parsing is needed to train.  For training,
+the batches are made of contiguous runs of rows, which are shuffled into new
+batches every epoch.
+
+stats_id: Makes an identifier for the statistics used to pack a data set.
+
+index_name: Gets the file name of the index of a packed data set.
+
+load_index: Loads the index of a packed data set.
+
+make_packed: Packs data files into a single, memory-mappable array.
+
+PackedSequence: class that serves batches of a packed data set to Keras.
+
+"""
+
+import sys, os
+import hashlib
+import numpy as np
+import keras
+
+import stats as S
+import utils as U
+
+
+def stats_id(*args):
+    """
+    Makes an identifier for a set of statistics, to detect when a packed data
+    set needs to be remade.
+
+    Inputs
+    ------
+    args: arrays/floats/lists. Statistics used to process the data.
+
+    Outputs
+    -------
+    sid: string. Identifier of the statistics.
+    """
+    md5 = hashlib.md5()
+    for arg in args:
+        md5.update(np.asarray(arg, dtype=np.float64).tobytes())
+    return md5.hexdigest()
+
+
+def index_name(fname):
+    """
+    Gets the file name of the index of a packed data set.
+
+    Inputs
+    ------
+    fname: string. path/to/packed data set .npy
+
+    Outputs
+    -------
+    findex: string. path/to/index .npz
+    """
+    return fname.rsplit('.npy', 1)[0] + '_index.npz'
+
+
+def load_index(fname):
+    """
+    Loads the index of a packed data set.
+
+    Inputs
+    ------
+    fname: string. path/to/packed data set .npy
+
+    Outputs
+    -------
+    index: dict. Contains 'files' (data files packed), 'counts' (cases taken
+                 from each file), 'nrows' (total cases), 'xlen' and 'ylen'
+                 (number of inputs and outputs), and 'seed' (random seed used
+                 to order the cases).
+    """
+    index = np.load(index_name(fname))
+    return {'files'  : list(index['files']),
+            'counts' : index['counts'],
+            'nrows'  : int(index['nrows']),
+            'xlen'   : int(index['xlen']),
+            'ylen'   : int(index['ylen']),
+            'seed'   : int(index['seed'])}
+
+
+def make_packed(fname, files, inD, ilog, olog,
+                x_mean, x_std, y_mean, y_std,
+                x_min,  x_max, y_min,  y_max, scalelims,
+                seed=0, chunk=100000, verb=1):
+    """
+    Packs data files into a single, contiguous float32 array of normalized
+    and scaled cases, in a random order.
+
+    Inputs
+    ------
+    fname    : string. path/to/packed data set .npy to be created.
+    files    : list, strings. Data files to pack.
+    inD      : int.   Dimension of the inputs.
+    ilog     : bool.  Determines if to take the log of inputs.
+    olog     : bool.  Determines if to take the log of outputs.
+    x_mean   : array. Training set mean of the inputs.
+    x_std    : array. Training set standard deviation of the inputs.
+    y_mean   : array. Training set mean of the outputs.
+    y_std    : array. Training set standard deviation of the outputs.
+    x_min    : array. Minima of the normalized inputs.
+    x_max    : array. Maxima of the normalized inputs.
+    y_min    : array. Minima of the normalized outputs.
+    y_max    : array. Maxima of the normalized outputs.
+    scalelims: list, floats. [min, max] of the scaled data.
+    seed     : int.   Random seed for the order of the cases.
+    chunk    : int.   Number of cases to reorder at once.
+    verb     : int.   Verbosity level.
+
+    Outputs
+    -------
+    `fname` and its index file.
+
+    Notes
+    -----
+    The cases are screened by stats.screen_file(), as for the TFRecords (see
+    prepare.prepare_data()): cases with NaN or infinite values are not
+    packed, and cases that are all zeros or all -1 are reported.
+    The cases are first written in file order to a temporary array, then
+    copied in a random order into `fname`.
+    """
+    ftmp   = fname + '.tmp'
+    # Upper limit of the number of cases, from the file headers
+    shapes = [np.load(foo, mmap_mode='r').shape for foo in files]
+    ntot   = sum([shp[0] for shp in shapes if len(shp) == 2])
+    nele   = [shp[-1] for shp in shapes if len(shp) == 2][0]
+    tmp    = np.lib.format.open_memmap(ftmp, mode='w+', dtype=np.float32,
+                                       shape=(ntot, nele))
+    counts = np.zeros(len(files), dtype=int)
+    nrows  = 0
+    nbad   = [0, 0, 0]
+    for i, foo in enumerate(files):
+        # Screen for bad cases, as for the TFRecords
+        data, ydelog, ncases, bad = S.screen_file(foo, inD, ilog, olog,
+                                                  verb=verb > 1)
+        if data is None:
+            continue
+        if bad is not None:
+            nbad = [nbad[k] + len(bad[key])
+                    for k, key in enumerate(['nan', 'zero', 'neg1'])]
+        x = data[:, :inD]
+        y = data[:, inD:]
+        x = U.scale(U.normalize(x, x_mean, x_std), x_min, x_max, scalelims)
+        y = U.scale(U.normalize(y, y_mean, y_std), y_min, y_max, scalelims)
+        # Normalizing and scaling may overflow
+        good = np.all(np.isfinite(x), axis=-1) & np.all(np.isfinite(y), axis=-1)
+        if verb and ncases > np.sum(good):
+            print("Skipping", ncases - np.sum(good),
+                  "cases with NaN/inf values in", foo)
+        counts[i] = np.sum(good)
+        tmp[nrows:nrows+counts[i], :inD] = x[good]
+        tmp[nrows:nrows+counts[i], inD:] = y[good]
+        nrows += counts[i]
+        if verb:
+            print(str(int(100*(i+1)/len(files))) + "% read", end='\r')
+    if verb:
+        print('')
+        print('Bad cases:', nbad[0], 'with NaNs,', nbad[1], 'all zeros,',
+              nbad[2], 'all -1.')
+
+    # Copy to the packed array in a random order
+    order  = np.random.RandomState(seed).permutation(nrows)
+    packed = np.lib.format.open_memmap(fname, mode='w+', dtype=np.float32,
+                                       shape=(nrows, nele))
+    for j in range(0, nrows, chunk):
+        # Sorted reads are faster; put the rows back in the random order
+        rows  = order[j:j+chunk]
+        isort = np.argsort(rows)
+        packed[j:j+chunk][isort] = tmp[rows[isort]]
+    packed.flush()
+    del packed, tmp
+    os.remove(ftmp)
+
+    np.savez(index_name(fname), files=np.array(files), counts=counts,
+             nrows=nrows, xlen=inD, ylen=nele-inD, seed=seed)
+    if verb:
+        print(nrows, "cases packed into", fname)
+    return
+
+
+class PackedSequence(keras.utils.Sequence):
+    """
+    Serves batches of a packed data set, as slices of the memory-mapped array.
+
+    If shuffling, the rows are split into runs of `run` contiguous rows, and
+    each batch is made of `batch_size` / `run` runs.  The order of the runs
+    is reshuffled at the end of every epoch, so the batches change every
+    epoch while reads stay mostly sequential.
+    """
+    def __init__(self, fname, batch_size, nbatches=None, shuffle=False,
+                 run=None, seed=None):
+        """
+        fname     : string. path/to/packed data set .npy
+        batch_size: int.    Size of batches.
+        nbatches  : int.    Number of batches to serve.
+                            If None, serves all full batches.
+        shuffle   : bool.   Determines whether to reshuffle the runs of rows
+                            into new batches every epoch.
+        run       : int.    Number of contiguous rows per run.  Must evenly
+                            divide `batch_size`.  If None, `batch_size` / 8
+                            (or the largest divisor of `batch_size` below
+                            it).
+        seed      : int.    Random seed for the order of the runs.
+        """
+        index = load_index(fname)
+        self.fname      = fname
+        self.data       = np.load(fname, mmap_mode='r')
+        self.xlen       = index['xlen']
+        self.batch_size = batch_size
+        if nbatches is None:
+            nbatches = index['nrows'] // batch_size
+        self.nbatches   = nbatches
+        self.shuffle    = shuffle
+        if run is None:
+            run = max(batch_size // 8, 1)
+            while batch_size % run:
+                run -= 1
+        elif batch_size % run:
+            raise ValueError("The number of rows per run (" + str(run) + \
+                             ") must evenly divide the batch size (" +    \
+                             str(batch_size) + ").")
+        self.run   = run
+        self.rng   = np.random.RandomState(seed)
+        self.order = np.arange(nbatches * batch_size // run)
+        if shuffle:
+            self.rng.shuffle(self.order)
+
+    def __len__(self):
+        return self.nbatches
+
+    def __getitem__(self, i):
+        if not self.shuffle:
+            batch = self.data[i*self.batch_size : (i+1)*self.batch_size]
+        else:
+            nrun  = self.batch_size // self.run
+            # Read the runs of the batch in order on disk
+            runs  = np.sort(self.order[i*nrun : (i+1)*nrun])
+            batch = np.concatenate([self.data[j*self.run : (j+1)*self.run]
+                                    for j in runs])
+        return batch[:, :self.xlen], batch[:, self.xlen:]
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            self.rng.shuffle(self.order)
@@ -0,0 +1,282 @@
+"""
+Module that contains functions to prepare a data set for training in a single
+pass over its data files.
+
+_prepare_shard: Helper function to prepare a group of data files.
+
+prepare_data: Counts the cases, computes the statistics, screens for bad
+              cases, and writes the TFRecords of a data set, reading each data
+              file only once.
+
+write_report: Writes a bad-case report to a text file.
+
+"""
+
+import sys, os
+import multiprocessing as mp
+import numpy as np
+import tensorflow as tf
+
+import stats as S
+import utils as U
+
+
+def _prepare_shard(args):
+    """
+    Helper function for multiprocessing.  Prepares a group of data files,
+    writing them to a single TFRecords shard.
+
+    Inputs
+    ------
+    args: tuple. (thisfile, files, inD, ilog, olog, batch_size, block,
+          dtype, stats, delog, chunk, partdir, verb), where thisfile is the
+          TFRecords shard to write, and the rest are as in prepare_data().
+          Only whole batches are written; the number written is added to
+          the counter shared by all shards (see utils._init_TFR_worker).
+
+    Outputs
+    -------
+    result: dict. Contains
+                  'ncases': number of cases in `files`.
+                  'nwrite': number of cases written to `thisfile`.
+                  'xleft' : inputs  of the valid cases that do not fill a
+                            batch, to be combined with the other shards'.
+                  'yleft' : outputs of the valid cases that do not fill a
+                            batch.
+                  'report': dict of bad cases per file, as
+                            {file : {'nan' : [indices], 'zero' : [indices],
+                                     'neg1': [indices]}}.
+                            Only files with bad cases are included.
+                  'part'  : partial statistics of the cases, as in
+                            stats.data_moments().  Only if `stats` is True.
+    """
+    thisfile, files, inD, ilog, olog, batch_size, block, dtype, \
+    stats, delog, chunk, partdir, verb = args
+    writer = tf.python_io.TFRecordWriter(thisfile)
+    ncases = 0
+    nwrite = 0
+    report = {}
+    part   = None
+    # Cases carried over to the next file to fill a batch
+    xleft  = None
+    yleft  = None
+    for foo in files:
+        # Screen for bad cases, as for the statistics and packed data
+        data, ydelog, nc_file, bad = S.screen_file(foo, inD, ilog, olog,
+                                                   delog, verb)
+        if data is None:
+            continue
+        ncases += nc_file
+        if bad is not None:
+            report[foo] = bad
+        # Statistics, reusing the saved partial statistics of the file
+        if stats:
+            fpart = None
+            if partdir is not None:
+                fpart = S.load_partial(partdir, foo, inD, ilog, olog, delog)
+            if fpart is None:
+                fpart = S.data_moments(data, inD, ydelog, chunk)
+                if partdir is not None:
+                    S.save_partial(partdir, foo, inD, ilog, olog, fpart)
+            part = S.merge_partials(part, fpart)
+        # Convert to the storage data type, checking for overflows
+        x = data[:, :inD].astype(dtype, copy=False)
+        y = data[:, inD:].astype(dtype, copy=False)
+        isinf = np.any(np.isinf(x), axis=-1) | np.any(np.isinf(y), axis=-1)
+        if np.any(isinf):
+            if verb:
+                print("Inf alert!", foo, np.sum(isinf),
+                      "cases overflow the storage data type.")
+            x = x[~isinf]
+            y = y[~isinf]
+        if xleft is not None:
+            x = np.concatenate((xleft, x))
+            y = np.concatenate((yleft, y))
+        # Only whole batches are written, so every pass over the
+        # TFRecords is a whole number of batches
+        num = U._reserve_cases((x.shape[0] // batch_size) * batch_size)
+        U._write_examples(writer, x[:num], y[:num], block)
+        nwrite += num
+        xleft = x[num:]
+        yleft = y[num:]
+    writer.close()
+
+    result = {'ncases' : ncases, 'nwrite' : nwrite, 'report' : report,
+              'xleft'  : xleft,  'yleft'  : yleft}
+    if stats:
+        result['part'] = part
+    return result
+
+
+def prepare_data(fname, files, inD, ilog, olog, batch_size,
+                 stats=False, delog=False, split=1, ncores=1, block=0,
+                 dtype=np.float64, chunk=10000, partdir=None, verb=1):
+    """
+    Prepares a data set in a single pass over its data files.  Counts the
+    cases, screens for bad cases, writes the TFRecords, and optionally
+    computes the statistics of the data set.
+
+    Inputs
+    ------
+    fname : string. Base name for TFRecords files.
+    files : list, strings. Data files to prepare.
+    inD   : int.   Dimension of the inputs/features.
+    ilog  : bool.  Determines if to take the log of inputs/features.
+    olog  : bool.  Determines if to take the log of outputs/targets.
+    batch_size: int. Size of batches for training.
+    stats : bool.  Determines whether to compute the mean, standard deviation,
+                   min, and max of the data set.
+    delog : bool.  Determines whether to also compute the mean without the
+                   log of the outputs.  Requires `stats`.
+    split : int.   Determines the number of `files` to process before
+                   starting a new TFRecords file.  Ignored if `ncores` > 1.
+    ncores: int.   Number of worker processes.  If > 1, each worker prepares
+                   its own TFRecords shard from a subset of `files`.
+    block : int.   Number of cases packed into each record.
+                   If 0, each case is written as its own record.
+                   Must evenly divide `batch_size`.
+    dtype : data type. Data type used to store the cases.
+    chunk : int.   Maximum number of cases to process at once for the
+                   statistics.
+    partdir: string. Path/to/directory to save the partial statistics of
+                     each file, as in stats.mean_stdev().  Saved partial
+                     statistics that are still valid are reused.  If None,
+                     partial statistics are not saved.
+    verb  : int.   Verbosity level.
+
+    Outputs
+    -------
+    TFRecords files.
+    result: dict. Contains
+                  'ncases': number of cases in `files`.
+                  'nwrite': number of valid cases written to the
+                            TFRecords, (valid cases // `batch_size`) *
+                            `batch_size`.
+                  'report': bad cases per file.  See _prepare_shard().
+                  If `stats`, also contains 'mean', 'stdev', 'min', 'max',
+                  and, if `delog`, 'mean_delog'.
+
+    Notes
+    -----
+    Only whole batches are written, so that each pass over the TFRecords is
+    the same whole number of batches.  Each shard writes its whole batches;
+    the remaining cases of all shards are combined, and their whole batches
+    are written to one more shard.  The last (valid cases % `batch_size`)
+    cases are dropped.
+
+    The cases are screened by stats.screen_file(), as for stats.mean_stdev()
+    and packed.make_packed().  Cases with NaN or infinite values (e.g., from
+    the log of values <= 0) are reported and not written.  Cases that are
+    all zeros or all -1 are reported, but still written.  Cases that are all
+    zeros are not included in the mean and standard deviation.
+    """
+    if block and batch_size % block:
+        raise ValueError("The number of cases per record (" + str(block) + \
+                         ") must evenly divide the batch size (" +          \
+                         str(batch_size) + ").")
+
+    if ncores > 1:
+        # Stripe the files across the shards to balance the load
+        nshards = min(ncores, len(files))
+        groups  = [files[i::nshards] for i in range(nshards)]
+    else:
+        groups  = [files[i*split:(i+1)*split]
+                   for i in range(int(np.ceil(len(files)/split)))]
+    shardname = lambda i: fname.replace('.tfrecords',
+                                        '_'+str(i).zfill(3)+'.tfrecords')
+    if stats and partdir is not None:
+        U.make_dir(partdir)
+    args = [(shardname(i), groups[i], inD, ilog, olog, batch_size, block,
+             dtype, stats, delog and stats, chunk, partdir, verb)
+            for i in range(len(groups))]
+    # Track number of cases written to TFRecords across all shards
+    count = mp.Value('l', 0)
+    U._init_TFR_worker(count)
+    if ncores > 1:
+        pool    = mp.Pool(len(groups), initializer=U._init_TFR_worker,
+                          initargs=(count,))
+        results = pool.imap(_prepare_shard, args)
+    else:
+        results = map(_prepare_shard, args)
+
+    ncases = 0
+    report = {}
+    xleft  = []
+    yleft  = []
+    part   = None
+    for i, res in enumerate(results):
+        ncases += res['ncases']
+        report.update(res['report'])
+        if res['xleft'] is not None:
+            xleft.append(res['xleft'])
+            yleft.append(res['yleft'])
+        if stats:
+            part = S.merge_partials(part, res['part'])
+        # Print progress updates
+        if verb:
+            print(str(int(100*(i+1)/len(groups))) + "% complete", end='\r')
+    if ncores > 1:
+        pool.close()
+        pool.join()
+
+    # Write the whole batches of the shards' remaining cases
+    if len(xleft):
+        xleft = np.concatenate(xleft)
+        yleft = np.concatenate(yleft)
+        num   = (xleft.shape[0] // batch_size) * batch_size
+        if num:
+            writer = tf.python_io.TFRecordWriter(shardname(len(groups)))
+            U._write_examples(writer, xleft[:num], yleft[:num], block)
+            writer.close()
+            U._reserve_cases(num)
+        if verb > 1 and xleft.shape[0] > num:
+            print("Dropped", xleft.shape[0] - num,
+                  "cases that do not fill a batch.")
+    nwrite = count.value
+
+    if verb:
+        print('')
+        nbad = [sum([len(report[foo][key]) for foo in report])
+                for key in ['nan', 'zero', 'neg1']]
+        print(ncases, 'cases read,', nwrite, 'cases written.')
+        print('Bad cases:', nbad[0], 'with NaNs,', nbad[1], 'all zeros,',
+              nbad[2], 'all -1.')
+        print(nwrite // batch_size, 'batches written.')
+
+    result = {'ncases' : ncases, 'nwrite' : nwrite, 'report' : report}
+    if stats:
+        if part is None:
+            raise ValueError("None of the data files could be read.")
+        result['mean']  = part[1]
+        result['stdev'] = (part[2] / (part[0] - 1))**0.5
+        result['min']   = part[3]
+        result['max']   = part[4]
+        if delog:
+            result['mean_delog'] = part[5]
+    return result
+
+
+def write_report(fname, report):
+    """
+    Writes a bad-case report to a text file.
+
+    Inputs
+    ------
+    fname : string. Path/to/file to save the report.
+    report: dict.   Bad cases per file, as returned by prepare_data().
+
+    Outputs
+    -------
+    `fname`: text file listing, for each data file with bad cases, the
+             indices of cases with NaNs, that are all zeros, and that are
+             all -1.
+    """
+    with open(fname, 'w') as f:
+        f.write('# file, type of bad case, indices\n')
+        for foo in sorted(report):
+            for key in ['nan', 'zero', 'neg1']:
+                if len(report[foo][key]):
+                    f.write(foo + ', ' + key + ', ' +
+                            ' '.join([str(k) for k in report[foo][key]]) +
+                            '\n')
+    return
@@ -0,0 +1,295 @@
+"""
+Module that contains functions to perform atmospheric retrievals with a
+trained MARGE model as the forward model, in place of BART's radiative
+transfer.
+
+The MCMC is a Differential-Evolution Markov chain (ter Braak 2006), as in
+BART's 'demc' walk.  All chains propose at once, so each iteration is a
+single batched call to the model (the NumPy engine, see engine.py),
+followed by one sparse product to integrate over the filter bandpasses (see
+stats.bandpass_operator).  The posterior samples are saved as BART's
+output.npy, shaped (chains, parameters, iterations), so BART's and MARGE's
+tools can read them (e.g., datagen.process_data).
+
+read_config: Reads the retrieval settings from a BART configuration file.
+
+make_forward: Makes the forward model from an exported MARGE model.
+
+demc: Runs a Differential-Evolution MCMC with a batched forward model.
+
+retrieve: Performs a retrieval and saves the posterior samples.
+
+"""
+
+import os
+import configparser
+import numpy as np
+
+import engine as E
+import stats  as S
+
+
+def read_config(cfile):
+    """
+    Reads the retrieval settings from the [MCMC] section of a BART
+    configuration file.
+
+    Inputs
+    ------
+    cfile: string. path/to/BART configuration file.
+
+    Outputs
+    -------
+    conf: dict. Contains 'loc_dir' (output directory), 'params', 'pmin',
+                'pmax', 'stepsize' (arrays), 'numit', 'nchains', 'burnin'
+                (ints), 'data', 'uncert' (arrays), and 'parnames' (list, or
+                None if not given).
+    """
+    config = configparser.ConfigParser(allow_no_value=True)
+    config.read_file(open(cfile, 'r'))
+    mcmc = config['MCMC']
+
+    def floats(key):
+        return np.array([float(val) for val in mcmc[key].split()])
+
+    loc_dir = os.path.join(mcmc['loc_dir'], '')
+    if not os.path.isabs(loc_dir):
+        loc_dir = os.path.join(os.path.dirname(os.path.abspath(cfile)),
+                               loc_dir)
+    conf = {'loc_dir'  : loc_dir,
+            'params'   : floats('params'),
+            'pmin'     : floats('pmin'),
+            'pmax'     : floats('pmax'),
+            'stepsize' : floats('stepsize'),
+            'numit'    : int(mcmc['numit']),
+            'nchains'  : int(mcmc['nchains']),
+            'burnin'   : int(mcmc['burnin']) if 'burnin' in mcmc else 0,
+            'data'     : floats('data'),
+            'uncert'   : floats('uncert'),
+            'parnames' : mcmc['parnames'].split() if 'parnames' in mcmc
+                         else None}
+    npars = len(conf['params'])
+    for key in ['pmin', 'pmax', 'stepsize']:
+        if len(conf[key]) != npars:
+            raise ValueError("The number of " + key + " values does not " +\
+                             "match the number of params.")
+    if len(conf['data']) != len(conf['uncert']):
+        raise ValueError("The number of data and uncert values differ.")
+    return conf
+
+
+def make_forward(fmodel, x_vals=None, filters=None, filt2um=1.0):
+    """
+    Makes the forward model of a retrieval from an exported MARGE model.
+
+    Inputs
+    ------
+    fmodel : string. path/to/exported model .npz (see engine.export_npz()).
+    x_vals : array.  X values of the model's outputs.  Required if `filters`.
+    filters: list, strings. Filter bandpasses to integrate over.  If None,
+                            the model's outputs are compared to the data
+                            directly.
+    filt2um: float.  Conversion factor for the filters' wavelengths to
+                     microns.
+
+    Outputs
+    -------
+    forward: function. Takes parameters shaped (cases, parameters), and
+                       returns the (band-integrated) spectra, shaped
+                       (cases, data points).
+    xlen   : int.      Number of inputs of the model.
+    """
+    model = E.NumpyModel(fmodel)
+    if filters is None:
+        return model.predict, model.xlen
+    bandpass = S.bandpass_operator(filters, x_vals, filt2um)
+    def forward(params):
+        return bandpass.T.dot(model.predict(params).T).T
+    return forward, model.xlen
+
+
+def demc(forward, data, uncert, params, pmin, pmax, stepsize,
+         numit, nchains, burnin=0, support=0.01, seed=None, verb=1):
+    """
+    Runs a Differential-Evolution Markov chain Monte Carlo (ter Braak 2006)
+    with uniform priors.  All chains propose at once, and the proposals
+    inside the priors are evaluated with a single call to `forward`.
+
+    Inputs
+    ------
+    forward : function. Takes parameters shaped (cases, parameters), and
+                        returns model values shaped (cases, data points).
+    data    : array. Data values.
+    uncert  : array. Data uncertainties.
+    params  : array. Initial parameters; chain 0 starts here, and the other
+                     chains start uniformly within [pmin, pmax].
+    pmin    : array. Lower bounds of the uniform priors.
+    pmax    : array. Upper bounds of the uniform priors.
+    stepsize: array. As in BART: > 0 for free parameters, 0 for fixed
+                     parameters, and -n to share the value of parameter n
+                     (1-based).  Free parameters' proposals include a
+                     Gaussian support term of width `support` * stepsize.
+    numit   : int.   Total number of samples, over all chains.
+    nchains : int.   Number of chains.  Must be >= 3.
+    burnin  : int.   Number of burn-in iterations per chain, excluded from
+                     the acceptance rate and summary.
+    support : float. Width of the Gaussian support term, in units of
+                     `stepsize`.
+    seed    : int.   Random seed.
+    verb    : int.   Verbosity level.
+
+    Outputs
+    -------
+    allparams: array. Samples of each chain, shaped
+                      (nchains, parameters, numit // nchains), including the
+                      burn-in.
+    bestp    : array. Parameters with the lowest chi-squared.
+    bestchisq: float. Lowest chi-squared.
+    """
+    if nchains < 3:
+        raise ValueError("DEMC requires at least 3 chains.")
+    rng      = np.random.RandomState(seed)
+    params   = np.asarray(params, dtype=np.float64)
+    npars    = params.size
+    niter    = numit // nchains
+    ifree    = np.where(stepsize >  0)[0]
+    ishare   = np.where(stepsize <  0)[0]
+    nfree    = ifree.size
+    gamma    = 2.38 / np.sqrt(2 * nfree)
+    sigma    = support * stepsize[ifree]
+
+    def chisq(x):
+        chi = np.full(x.shape[0], np.inf)
+        inb = np.all((x[:, ifree] >= pmin[ifree]) &
+                     (x[:, ifree] <= pmax[ifree]), axis=-1)
+        if np.any(inb):
+            # One batched call for all proposals within the priors
+            model    = forward(x[inb])
+            chi[inb] = np.sum(((model - data) / uncert)**2, axis=-1)
+        return chi
+
+    # Initial state
+    x = np.tile(params, (nchains, 1))
+    x[1:, ifree] = rng.uniform(pmin[ifree], pmax[ifree],
+                               (nchains - 1, nfree))
+    for i in ishare:
+        x[:, i] = x[:, -int(stepsize[i]) - 1]
+    chi       = chisq(x)
+    ibest     = np.argmin(chi)
+    bestp     = x[ibest].copy()
+    bestchisq = chi[ibest]
+
+    allparams = np.zeros((nchains, npars, niter))
+    naccept   = 0
+    ichain    = np.arange(nchains)
+    for it in range(niter):
+        # Two other, distinct chains for each chain
+        a  = rng.randint(1, nchains,     nchains)
+        b  = rng.randint(1, nchains - 1, nchains)
+        b += b >= a
+        r1 = (ichain + a) % nchains
+        r2 = (ichain + b) % nchains
+        # Every 10th iteration, jump between modes
+        g  = 1.0 if it % 10 == 9 else gamma
+        prop = x.copy()
+        prop[:, ifree] += g * (x[r1][:, ifree] - x[r2][:, ifree]) + \
+                          rng.normal(0, sigma, (nchains, nfree))
+        for i in ishare:
+            prop[:, i] = prop[:, -int(stepsize[i]) - 1]
+        chiprop = chisq(prop)
+        # Metropolis acceptance
+        accept  = np.log(rng.uniform(size=nchains)) < -0.5 * (chiprop - chi)
+        x  [accept] = prop   [accept]
+        chi[accept] = chiprop[accept]
+        if it >= burnin:
+            naccept += np.sum(accept)
+        if np.amin(chi) < bestchisq:
+            ibest     = np.argmin(chi)
+            bestp     = x[ibest].copy()
+            bestchisq = chi[ibest]
+        allparams[:, :, it] = x
+        if verb and (it + 1) % max(1, niter // 10) == 0:
+            print(str(int(100 * (it + 1) / niter)) + "% complete", end='\r')
+
+    if verb:
+        print('')
+        print("Acceptance rate: {:.1f}%".format(100 * naccept /
+                                    max(1, nchains * (niter - burnin))))
+        print("Best chi-squared:", bestchisq)
+    return allparams, bestp, bestchisq
+
+
+def retrieve(cfile, fmodel, x_vals=None, filters=None, filt2um=1.0,
+             seed=None, predcache=False, predcache_size=64.,
+             predcache_quantum=None, predcache_policy='lru', verb=1):
+    """
+    Performs a retrieval with a trained MARGE model as the forward model, and
+    saves the posterior samples in BART's format.
+
+    Inputs
+    ------
+    cfile  : string. path/to/BART configuration file, whose [MCMC] section
+                     gives the parameters, priors, chains, and data.  The
+                     model's inputs must be the retrieved parameters, in
+                     the same order.
+    fmodel : string. path/to/exported model .npz
+    x_vals : array.  X values of the model's outputs.
+    filters: list, strings. Filter bandpasses of the data.  If None, the data
+                            correspond to the model's outputs.
+    filt2um: float.  Conversion factor for the filters' wavelengths to
+                     microns.
+    seed   : int.    Random seed.
+    predcache        : bool.   Determines whether to cache the forward 
+                               model's results (see engine.PredictionCache).
+    predcache_size   : float.  Maximum size of the cache, in MB.
+    predcache_quantum: float or array. Step to round the parameters to 
+                               before lookup.  If None, exact matches only.
+    predcache_policy : string. Eviction policy.  'lru' or 'fifo'.
+    verb   : int.    Verbosity level.
+
+    Outputs
+    -------
+    `loc_dir`/output.npy          : posterior samples, shaped
+                                    (chains, parameters, iterations).
+    `loc_dir`/retrieval_best.npz  : best-fit parameters and chi-squared.
+    """
+    conf    = read_config(cfile)
+    forward, xlen = make_forward(fmodel, x_vals, filters, filt2um)
+    npars   = len(conf['params'])
+    if xlen != npars:
+        raise ValueError("The model has " + str(xlen) + " inputs, but the " +\
+                         "retrieval has " + str(npars) + " parameters.")
+    if predcache:
+        forward = E.PredictionCache(forward, int(predcache_size * 2**20),
+                                    predcache_quantum, predcache_policy)
+    if verb:
+        print('Running', conf['nchains'], 'chains for',
+              conf['numit'] // conf['nchains'], 'iterations each.')
+    allparams, bestp, bestchisq = demc(forward, conf['data'], conf['uncert'],
+                                       conf['params'], conf['pmin'],
+                                       conf['pmax'], conf['stepsize'],
+                                       conf['numit'], conf['nchains'],
+                                       conf['burnin'], seed=seed, verb=verb)
+    if not os.path.exists(conf['loc_dir']):
+        os.makedirs(conf['loc_dir'])
+    np.save(conf['loc_dir'] + 'output.npy', allparams)
+    np.savez(conf['loc_dir'] + 'retrieval_best.npz',
+             bestp=bestp, bestchisq=bestchisq)
+
+    if verb:
+        # Posterior summary, without the burn-in
+        post  = allparams[:, :, conf['burnin']:]
+        post  = post.transpose(1, 0, 2).reshape(npars, -1)
+        names = conf['parnames'] or ['p' + str(i) for i in range(npars)]
+        lo, med, hi = np.percentile(post, [15.87, 50, 84.13], axis=-1)
+        print('Parameter | best fit | median | 68% interval')
+        for i in range(npars):
+            print('{:9s} | {:.5g} | {:.5g} | [{:.5g}, {:.5g}]'.format(
+                  names[i], bestp[i], med[i], lo[i], hi[i]))
+        if predcache:
+            stats = forward.stats()
+            print('Prediction cache: {:.1f}% hit rate ({} hits, {} misses, '
+                  '{} evictions)'.format(100 * stats['hit_rate'],
+                  stats['hits'], stats['misses'], stats['evictions']))
+        print('Posterior samples saved to', conf['loc_dir'] + 'output.npy')
+    return allparams, bestp, bestchisq
@@ -0,0 +1,271 @@
+"""
+Module that contains a local HTTP inference server for exported MARGE models.
+
+The model is loaded once.  Requests, typically of a single case each, are
+queued, and a worker thread coalesces the waiting requests into batches: a
+batch is run when it reaches the maximum batch size, or when its first
+request has waited for the maximum latency.  The server only uses the Python
+standard library, NumPy, and the exported model, so it runs fully offline.
+
+Endpoints
+---------
+POST /predict: Predicts the outputs for one or more cases.
+               JSON body {"x" : [inputs]} or {"x" : [[inputs], ...]} returns
+               {"y" : [[outputs], ...]}.  A body of raw float64 values
+               (Content-Type: application/octet-stream), a whole number of
+               cases long, returns the raw float64 outputs.
+               Inputs are as in the data files, and outputs are in physical
+               units.
+GET  /stats  : Returns the queue depth, number of requests and batches, mean
+               batch size, and request latency percentiles (ms), as JSON.
+GET  /health : Returns {"status" : "ok"}.
+
+Batcher: class that coalesces requests into batches.
+
+_make_handler: Helper function to make the HTTP request handler.
+
+serve: Runs the inference server.
+
+"""
+
+import sys, os
+import json
+import time
+import queue
+import threading
+import collections
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+
+libdir = os.path.dirname(os.path.abspath(__file__))
+if libdir not in sys.path:
+    sys.path.append(libdir)
+
+import engine as E
+
+
+class Batcher:
+    """
+    Coalesces prediction requests into batches, run by a worker thread.
+    """
+    def __init__(self, predict, xlen, max_batch=256, max_latency=2.,
+                 nlatency=10000):
+        """
+        predict    : function. Predicts the outputs for an array of inputs,
+                               shaped (cases, inputs).
+        xlen       : int.      Number of inputs.
+        max_batch  : int.      Maximum number of cases per batch.
+        max_latency: float.    Maximum time, in ms, that a request waits for
+                               other requests to join its batch.
+        nlatency   : int.      Number of recent request latencies to keep for
+                               the percentiles.
+        """
+        self.predict     = predict
+        self.xlen        = xlen
+        self.max_batch   = max_batch
+        self.max_latency = max_latency / 1000.
+        self.queue       = queue.Queue()
+        self.latency     = collections.deque(maxlen=nlatency)
+        self.nrequests   = 0
+        self.nbatches    = 0
+        self.ncases      = 0
+        self.lock        = threading.Lock()
+        self.thread      = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, x):
+        """
+        Submits a request, and waits for its outputs.
+
+        Inputs
+        ------
+        x: array. Inputs, shaped (cases, inputs) or (inputs,).
+
+        Outputs
+        -------
+        y: array. Predicted outputs, shaped (cases, outputs).
+        """
+        x = np.array(x, dtype=np.float64, ndmin=2)
+        if x.ndim != 2 or x.shape[1] != self.xlen:
+            raise ValueError("Inputs must have " + str(self.xlen) +
+                             " values per case.  Shape: " + str(x.shape))
+        req = {'x' : x, 'done' : threading.Event(), 't0' : time.time()}
+        self.queue.put(req)
+        req['done'].wait()
+        if 'error' in req:
+            raise req['error']
+        return req['y']
+
+    def _run(self):
+        """
+        Runs the waiting requests in batches.
+        """
+        while True:
+            reqs   = [self.queue.get()]
+            ncases = reqs[0]['x'].shape[0]
+            tend   = reqs[0]['t0'] + self.max_latency
+            # Gather more requests until the batch is full or time is up
+            while ncases < self.max_batch:
+                wait = tend - time.time()
+                try:
+                    if wait > 0:
+                        req = self.queue.get(timeout=wait)
+                    else:
+                        req = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                reqs.append(req)
+                ncases += req['x'].shape[0]
+            try:
+                y = self.predict(np.concatenate([req['x'] for req in reqs]))
+                i = 0
+                for req in reqs:
+                    req['y'] = y[i : i + req['x'].shape[0]]
+                    i += req['x'].shape[0]
+            except Exception as e:
+                for req in reqs:
+                    req['error'] = e
+            tnow = time.time()
+            with self.lock:
+                self.nbatches  += 1
+                self.ncases    += ncases
+                self.nrequests += len(reqs)
+                self.latency.extend([tnow - req['t0'] for req in reqs])
+            for req in reqs:
+                req['done'].set()
+
+    def stats(self):
+        """
+        Gets the statistics of the server.
+
+        Outputs
+        -------
+        stats: dict. Queue depth, numbers of requests, batches, and cases,
+                     mean batch size, and latency percentiles (ms) of recent
+                     requests.
+        """
+        with self.lock:
+            latency = 1000 * np.array(self.latency)
+            stats   = {'queue_depth' : self.queue.qsize(),
+                       'requests'    : self.nrequests,
+                       'batches'     : self.nbatches,
+                       'cases'       : self.ncases,
+                       'mean_batch'  : self.ncases / max(self.nbatches, 1)}
+        for perc in [50, 90, 99]:
+            if latency.size:
+                stats['latency_p' + str(perc)] = np.percentile(latency, perc)
+            else:
+                stats['latency_p' + str(perc)] = None
+        return stats
+
+
+def _make_handler(batcher, verb=0):
+    """
+    Helper function to make the HTTP request handler of a Batcher.
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def _send(self, code, body, ctype='application/json'):
+            self.send_response(code)
+            self.send_header('Content-Type', ctype)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _send_json(self, code, obj):
+            self._send(code, json.dumps(obj).encode())
+
+        def do_GET(self):
+            if self.path == '/stats':
+                self._send_json(200, batcher.stats())
+            elif self.path == '/health':
+                self._send_json(200, {'status' : 'ok'})
+            else:
+                self._send_json(404, {'error' : 'Unknown path: ' + self.path})
+
+        def do_POST(self):
+            if self.path != '/predict':
+                self._send_json(404, {'error' : 'Unknown path: ' + self.path})
+                return
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            try:
+                if self.headers.get('Content-Type') == \
+                                                    'application/octet-stream':
+                    x = np.frombuffer(body, dtype='<f8')
+                    y = batcher.submit(x.reshape(-1, batcher.xlen))
+                    self._send(200, y.astype('<f8').tobytes(),
+                               'application/octet-stream')
+                else:
+                    y = batcher.submit(json.loads(body.decode())['x'])
+                    self._send_json(200, {'y' : y.tolist()})
+            except (ValueError, KeyError) as e:
+                self._send_json(400, {'error' : str(e)})
+            except Exception as e:
+                self._send_json(500, {'error' : str(e)})
+
+        def log_message(self, format, *args):
+            if verb:
+                BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    return Handler
+
+
+def serve(fmodel, host='127.0.0.1', port=8000, max_batch=256,
+          max_latency=2., backend='numpy', nthreads=1, verb=1):
+    """
+    Runs the inference server until interrupted.
+
+    Inputs
+    ------
+    fmodel     : string. path/to/exported model: .npz for the NumPy engine
+                         (see engine.py), or .onnx for ONNX Runtime (see
+                         onnxengine.py).
+    host       : string. Address to listen on.  The default only accepts
+                         local connections.
+    port       : int.    Port to listen on.
+    max_batch  : int.    Maximum number of cases per batch.
+    max_latency: float.  Maximum time, in ms, that a request waits for other
+                         requests to join its batch.
+    backend    : string. 'numpy' or 'onnx'.
+    nthreads   : int.    Number of intra-op threads for ONNX Runtime.
+    verb       : int.    Verbosity level.  If > 1, logs each request.
+    """
+    if backend == 'numpy':
+        model = E.NumpyModel(fmodel)
+        xlen  = model.xlen
+    elif backend == 'onnx':
+        import onnxengine as O
+        model = O.OnnxModel(fmodel, nthreads)
+        xlen  = model.sess.get_inputs()[0].shape[-1]
+    else:
+        raise ValueError("Invalid backend: " + backend + "\nAllowed " + \
+                         "options: 'numpy' or 'onnx'.")
+    batcher = Batcher(model.predict, xlen, max_batch, max_latency)
+    server  = ThreadingHTTPServer((host, port), _make_handler(batcher, verb > 1))
+    server.daemon_threads = True
+    if verb:
+        print('Serving', fmodel, 'at http://' + host + ':' + str(port))
+        print('Maximum batch size:', max_batch, '  Maximum latency:',
+              max_latency, 'ms')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if verb:
+            print('')
+            print('Server statistics:', batcher.stats())
+
+
+if __name__ == "__main__":
+    # Usage: server.py path/to/model.npz [port] [max_batch] [max_latency]
+    args = sys.argv[1:]
+    if not len(args):
+        print(__doc__)
+        sys.exit(1)
+    serve(args[0],
+          port        = int  (args[1]) if len(args) > 1 else 8000,
+          max_batch   = int  (args[2]) if len(args) > 2 else 256,
+          max_latency = float(args[3]) if len(args) > 3 else 2.,
+          backend     = 'onnx' if args[0].endswith('.onnx') else 'numpy')
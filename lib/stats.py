@@ -1,6 +1,27 @@
 """
 Module that contains functions related to statstics.
 
+merge_moments: Merges the count, mean, and sum of squared differences of two 
+               sets of data (Chan et al.'s parallel form of Welford's method).
+
+merge_partials: Merges the partial statistics of two sets of data.
+
+screen_file: Loads a data file, takes the log10 of the inputs/outputs, and 
+             screens for bad cases.
+
+data_moments: Computes the partial statistics (count, mean, sum of squared 
+              differences, min, max) of a screened data set.
+
+load_partial: Loads the saved partial statistics of a data file, if valid.
+
+save_partial: Saves the partial statistics of a data file.
+
+_partial_file: Helper function to get the file name and validity check of 
+               the saved partial statistics of a data file.
+
+_file_stats: Helper function to compute the count, mean, sum of squared 
+             differences, min, and max of a single data file.
+
 mean_stdev: Uses Welford's method to calculate the mean and standard deviation 
             of the entire dataset, without loading all data in memory at once.
 
@@ -9,19 +30,385 @@ rmse: Calculates the RMSE for some predictions vs true values.
 r2: Calcualtes the coefficient of determination (R^2) for some predictions 
     vs true values.
 
+rmse_r2: Calculates the RMSE and R^2 for predictions vs true values saved in 
+         .NPY files, optionally in parallel.
+
+metrics_files: Accumulates the RMSE/R^2 sums of squares of prediction/true 
+               .NPY files into a Metrics object, optionally in parallel.
+
+_metrics_sums: Helper function to accumulate the RMSE/R^2 sums of squares of 
+               a set of prediction/true files.
+
+bandpass_operator: Builds the (cached) sparse operator that integrates 
+                   spectra over filter bandpasses.
+
+Metrics: class that accumulates the RMSE and R^2 one batch at a time.
+
 """
 
 import sys, os
+import copy
+import multiprocessing as mp
 import glob
+import hashlib
+import zipfile
 import numpy as np
 import scipy.interpolate as si
+import scipy.sparse      as ssp
 
 from keras import backend as K
 
 import utils as U
 
 
-def mean_stdev(datafiles, inD, ilog, olog, perc=10, num_per_file=None, verb=False):
+# Bandpass integration operators, keyed by the X values and filters
+_BANDPASS_CACHE = {}
+
+
+def merge_moments(n_a, mean_a, M2_a, n_b, mean_b, M2_b):
+    """
+    Merges the moments of two sets of data, using the parallel form of 
+    Welford's method by Chan et al.
+
+    Inputs
+    ------
+    n_a   : int.   Number of cases in set A.
+    mean_a: array. Mean of set A.
+    M2_a  : array. Sum of squared differences from the mean of set A.
+    n_b   : int.   Number of cases in set B.
+    mean_b: array. Mean of set B.
+    M2_b  : array. Sum of squared differences from the mean of set B.
+
+    Outputs
+    -------
+    n   : int.   Number of cases in the combined set.
+    mean: array. Mean of the combined set.
+    M2  : array. Sum of squared differences from the mean of the combined set.
+
+    Notes
+    -----
+    https://en.wikipedia.org/wiki/Algorithms_for_calculating_variance#Parallel_algorithm
+    """
+    n = n_a + n_b
+    if n_b == 0:
+        return n_a, mean_a, M2_a
+    if n_a == 0:
+        return n_b, mean_b, M2_b
+    delta = mean_b - mean_a
+    mean  = mean_a + delta * (n_b / n)
+    M2    = M2_a + M2_b + delta**2 * (n_a * n_b / n)
+    return n, mean, M2
+
+
+def merge_partials(part_a, part_b):
+    """
+    Merges the partial statistics of two sets of data.
+
+    Inputs
+    ------
+    part_a: tuple. Partial statistics of set A, as returned by data_moments(), 
+                   or None.
+    part_b: tuple. Partial statistics of set B, as returned by data_moments(), 
+                   or None.
+
+    Outputs
+    -------
+    part: tuple. Partial statistics of the combined set.  None if both are 
+                 None.
+    """
+    if part_a is None:
+        return part_b
+    if part_b is None:
+        return part_a
+    part  = merge_moments(*part_a[:3], *part_b[:3])
+    part += (np.minimum(part_a[3], part_b[3]), 
+             np.maximum(part_a[4], part_b[4]))
+    if len(part_a) > 5:
+        part += merge_moments(part_a[0], *part_a[5:], 
+                              part_b[0], *part_b[5:])[1:]
+    return part
+
+
+def screen_file(fname, inD, ilog, olog, delog=False, verb=0):
+    """
+    Loads a data file, takes the log10 of the inputs/outputs, and screens for 
+    bad cases.  All statistics and data formats screen the data this way.
+
+    Inputs
+    ------
+    fname: string. path/to/datafile.npy
+    inD  : int.    Dimension of the input data.
+    ilog : bool.   Whether to take the log10 of the inputs.
+    olog : bool.   Whether to take the log10 of the outputs.
+    delog: bool.   Whether to also return the outputs without the log10.
+    verb : int.    Verbosity level.
+
+    Outputs
+    -------
+    data  : array. Valid cases, in double precision, with the log10s taken.
+                   None if the file is broken.
+    ydelog: array. Outputs of the valid cases without the log10.  None if 
+                   not `delog`.
+    ncases: int.   Number of cases in the file.
+    report: dict.  Indices of the cases with NaNs, that are all zeros, and 
+                   that are all -1, as {'nan' : [indices], 'zero' : [indices], 
+                   'neg1' : [indices]}.  None if there are none.
+
+    Notes
+    -----
+    Cases with NaN or infinite values, including those from the log10 of 
+    values <= 0, are not valid.  Cases that are all zeros or all -1 are 
+    reported, but remain valid.
+    """
+    # Process in double precision, regardless of the stored data type
+    data = np.load(fname).astype(np.float64, copy=False)
+    # Files must be 2D
+    if data.ndim != 2:
+        print("*WARNING*: Broken file!!!")
+        print(fname)
+        print("Shape:", data.shape)
+        return None, None, 0, None
+    ncases = data.shape[0]
+    isnan  = np.any(np.isnan(data), axis=-1)
+    iszero = np.all(data ==  0,     axis=-1)
+    isneg1 = np.all(data == -1,     axis=-1)
+    report = None
+    if np.any(isnan) or np.any(iszero) or np.any(isneg1):
+        report = {'nan'  : np.where(isnan )[0].tolist(),
+                  'zero' : np.where(iszero)[0].tolist(),
+                  'neg1' : np.where(isneg1)[0].tolist()}
+    # Take logs; cases that become NaN/inf are not valid
+    ydelog = data[:, inD:].copy() if delog else None
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if ilog:
+            data[:, :inD][:, ilog] = np.log10(data[:, :inD][:, ilog])
+        if olog:
+            data[:, inD:][:, olog] = np.log10(data[:, inD:][:, olog])
+    isbad = np.any(~np.isfinite(data), axis=-1)
+    if verb:
+        for k in np.where(isbad & ~isnan)[0]:
+            print("Inf alert!", fname, k)
+        for k in np.where(isnan)[0]:
+            print("Nan alert!", fname, k)
+        for k in np.where(iszero)[0]:
+            print("We gotta lotta zeros here:", fname, k)
+    if np.any(isbad):
+        data = data[~isbad]
+        if delog:
+            ydelog = ydelog[~isbad]
+    return data, ydelog, ncases, report
+
+
+def data_moments(data, inD, ydelog=None, chunk=10000):
+    """
+    Computes the partial statistics of a set of cases screened by 
+    screen_file().
+
+    Inputs
+    ------
+    data  : array. Valid cases.
+    inD   : int.   Dimension of the input data.
+    ydelog: array. Outputs of the valid cases without the log10.  If given, 
+                   the mean and M2 without the log10 of the outputs are also 
+                   computed.
+    chunk : int.   Maximum number of cases to process at once.
+
+    Outputs
+    -------
+    part: tuple. (count, mean, M2, min, max), where M2 is the sum of squared 
+                 differences from the mean.  If `ydelog` is given, also 
+                 includes the mean and M2 without the log10 of the outputs.
+
+    Notes
+    -----
+    Cases that are all zeros are not included in the count, mean, and M2, 
+    but they are included in the min and max.
+    """
+    n_ele  = data.shape[-1]
+    nc     = 0
+    mean   = np.zeros(n_ele)
+    M2     = np.zeros(n_ele)
+    datmin = np.ones (n_ele) *  np.inf
+    datmax = np.ones (n_ele) * -np.inf
+    if ydelog is not None:
+        mean_d = np.zeros(n_ele)
+        M2_d   = np.zeros(n_ele)
+    for j in range(0, data.shape[0], chunk):
+        block = data[j:j+chunk]
+        # Update min/max
+        datmin = np.minimum(datmin, np.amin(block, axis=0))
+        datmax = np.maximum(datmax, np.amax(block, axis=0))
+        # Skip data vectors that are all zeros
+        nonzero = ~np.all(block == 0, axis=-1)
+        block   = block[nonzero]
+        if block.shape[0] == 0:
+            continue
+        # Moments of this chunk, merged into the running values
+        if ydelog is not None:
+            block_d = np.concatenate([block[:, :inD], 
+                                      ydelog[j:j+chunk][nonzero]], axis=-1)
+            bmean   = np.mean(block_d, axis=0)
+            bM2     = np.sum((block_d - bmean)**2, axis=0)
+            mean_d, M2_d = merge_moments(nc, mean_d, M2_d, 
+                                         block.shape[0], bmean, bM2)[1:]
+        bmean  = np.mean(block, axis=0)
+        bM2    = np.sum((block - bmean)**2, axis=0)
+        nc, mean, M2 = merge_moments(nc, mean, M2, 
+                                     block.shape[0], bmean, bM2)
+    part = (nc, mean, M2, datmin, datmax)
+    if ydelog is not None:
+        part += (mean_d, M2_d)
+    return part
+
+
+def _partial_file(partdir, fname, inD, ilog, olog):
+    """
+    Helper function to get the file name of the saved partial statistics of a 
+    data file, and the values that must match for them to be valid.
+
+    Inputs
+    ------
+    partdir: string. path/to/directory of saved partial statistics.
+    fname  : string. path/to/datafile.npy
+    inD    : int.    Dimension of the input data.
+    ilog   : bool.   Whether to take the log10 of the inputs.
+    olog   : bool.   Whether to take the log10 of the outputs.
+
+    Outputs
+    -------
+    fpart: string. path/to/partial statistics .npz
+    check: dict.   Values of the data file and settings that the saved 
+                   partial statistics must match.
+
+    Notes
+    -----
+    The partial statistics are keyed by the path of the data file relative 
+    to `partdir`, so that data files with the same name in different 
+    directories do not share partial statistics.
+    """
+    relpath = os.path.relpath(os.path.abspath(fname), os.path.abspath(partdir))
+    key     = hashlib.md5(relpath.encode()).hexdigest()[:12]
+    fpart   = os.path.join(partdir, os.path.basename(fname).rsplit('.', 1)[0] 
+                                    + '_' + key + '.npz')
+    fstat   = os.stat(fname)
+    check   = {'mtime' : fstat.st_mtime, 'size' : fstat.st_size, 
+               'inD'   : inD, 'ilog' : str(ilog), 'olog' : str(olog)}
+    return fpart, check
+
+
+def load_partial(partdir, fname, inD, ilog, olog, delog=False):
+    """
+    Loads the saved partial statistics of a data file, if they are still 
+    valid: the file and the log settings must be the same.
+
+    Inputs
+    ------
+    partdir: string. path/to/directory of saved partial statistics.
+    fname  : string. path/to/datafile.npy
+    inD    : int.    Dimension of the input data.
+    ilog   : bool.   Whether to take the log10 of the inputs.
+    olog   : bool.   Whether to take the log10 of the outputs.
+    delog  : bool.   Whether the mean and M2 without the log10 of the outputs 
+                     are needed.
+
+    Outputs
+    -------
+    part: tuple. Partial statistics, as returned by data_moments().  None if 
+                 there are no valid saved partial statistics.
+    """
+    fpart, check = _partial_file(partdir, fname, inD, ilog, olog)
+    if not os.path.exists(fpart):
+        return None
+    try:
+        saved = np.load(fpart)
+        if not all([saved[key] == check[key] for key in check]) or \
+           (delog and 'mean_delog' not in saved):
+            return None
+        part = (int(saved['n']), saved['mean'], saved['M2'], 
+                saved['min'], saved['max'])
+        if delog:
+            part += (saved['mean_delog'], saved['M2_delog'])
+    except (OSError, KeyError, ValueError, zipfile.BadZipFile) as e:
+        print("Warning: unable to load the partial statistics", fpart, 
+              "(" + str(e) + "). They will be recomputed.")
+        return None
+    return part
+
+
+def save_partial(partdir, fname, inD, ilog, olog, part):
+    """
+    Saves the partial statistics of a data file, to be reused by 
+    load_partial().
+
+    Inputs
+    ------
+    partdir: string. path/to/directory of saved partial statistics.
+    fname  : string. path/to/datafile.npy
+    inD    : int.    Dimension of the input data.
+    ilog   : bool.   Whether to take the log10 of the inputs.
+    olog   : bool.   Whether to take the log10 of the outputs.
+    part   : tuple.  Partial statistics, as returned by data_moments().
+
+    Outputs
+    -------
+    .npz file in `partdir`.
+    """
+    fpart, check = _partial_file(partdir, fname, inD, ilog, olog)
+    if len(part) > 5:
+        check.update({'mean_delog' : part[5], 'M2_delog' : part[6]})
+    np.savez(fpart, n=part[0], mean=part[1], M2=part[2], 
+             min=part[3], max=part[4], **check)
+    return
+
+
+def _file_stats(args):
+    """
+    Helper function to compute the partial statistics of a single data file.
+    If `partdir` is given, loads the partial statistics saved for the file when 
+    they are still valid, and otherwise saves them there for later reuse.
+
+    Inputs
+    ------
+    args: tuple. Contains the following:
+        fname       : string. path/to/datafile.npy
+        inD         : int.    Dimension of the input data.
+        ilog        : bool.   Whether to take the log10 of the inputs.
+        olog        : bool.   Whether to take the log10 of the outputs.
+        num_per_file: int.    Expected number of cases in the file, or None.
+        verb        : int.    Verbosity level.
+        chunk       : int.    Maximum number of cases to process at once.
+        partdir     : string. path/to/directory of saved partial statistics, 
+                              or None.
+        delog       : bool.   Whether to also compute the mean and M2 of the 
+                              data without the log10 of the outputs.
+
+    Outputs
+    -------
+    part: tuple. Partial statistics of the file, as returned by 
+                 data_moments().  None if the file is broken.
+    """
+    fname, inD, ilog, olog, num_per_file, verb, chunk, partdir, delog = args
+    if partdir is not None:
+        part = load_partial(partdir, fname, inD, ilog, olog, delog)
+        if part is not None:
+            return part
+    data, ydelog, ncases, report = screen_file(fname, inD, ilog, olog, 
+                                               delog, verb)
+    if data is None:
+        return None
+    if num_per_file is not None:
+        # Check that it's the right shape
+        if verb and ncases != num_per_file:
+            print("Warning: Incomplete file!", fname, ncases)
+    part = data_moments(data, inD, ydelog, chunk)
+    if partdir is not None:
+        save_partial(partdir, fname, inD, ilog, olog, part)
+    return part
+
+
+def mean_stdev(datafiles, inD, ilog, olog, perc=10, num_per_file=None, 
+               verb=False, chunk=10000, ncores=1, partdir=None, 
+               delog=False):
     """
     Uses Welford's method to calculate the mean and standard deviation (via the 
     variance) of the entire dataset, without loading all data in memory at once.
@@ -41,6 +428,15 @@ def mean_stdev(datafiles, inD, ilog, olog, perc=10, num_per_file=None, verb=Fals
                        Prints warning if a file does not match the expected 
                        value (requires verb > 0)
     verb: bool or int. Flag that determines whether to print additional outputs.
+    chunk: int. Maximum number of cases to process at once.  Limits the 
+                memory used for temporary arrays when files are large.
+    ncores: int. Number of processes to use.
+    partdir: string. Path/to/directory to save the partial statistics of each 
+                     file.  Files whose partial statistics are saved there, 
+                     and which have not changed since, are not re-read.  
+                     If None, partial statistics are not saved.
+    delog: bool. Determines whether to also compute the mean of the data 
+                 without taking the log10 of the outputs, in the same pass.
 
     Outputs
     -------
@@ -49,84 +445,76 @@ def mean_stdev(datafiles, inD, ilog, olog, perc=10, num_per_file=None, verb=Fals
                         Computed as sqrt of sample variance.
     datmin: arr, float. Minima of the dataset.
     datmax: arr, float. Maxima of the dataset.
+    mean_delog: arr, float. Mean values of the dataset, without the log10 of 
+                            the outputs.  Only returned if `delog` is True.
 
     Notes
     -----
     https://www.johndcook.com/blog/standard_deviation/
     https://en.wikipedia.org/wiki/Algorithms_for_calculating_variance
 
+    The mean and variance of each chunk of cases are computed directly, and 
+    merged into the running values via merge_moments().  The data are 
+    screened by screen_file(): cases with NaN or infinite values (e.g., from 
+    the log10 of values <= 0) are skipped.  Cases that are all zeros are not 
+    included in the mean and variance, but they are included in the min and 
+    max.
+
     """
-    up     = 0  # Counter for checking percent done
-    n_ele  = np.load(datafiles[0]).shape[-1] # Data vector size
-    nc     = 0                         # Number of cases seen thus far
-    mean   = np.zeros(n_ele)           # Running mean
-    M2     = np.zeros(n_ele)           # Running variance
-    datmin = np.ones (n_ele) *  np.inf # Min for each element
-    datmax = np.ones (n_ele) * -np.inf # Max for each element
-
-    for i in range(len(datafiles)):
-        data = np.load(datafiles[i])
-        # Files must be 2D
-        if len(data.shape) == 1:
-            print("*WARNING*: Broken file!!!")
-            print(datafiles[i])
-            print("Shape:", data.shape)
-            continue
-        elif len(data.shape) == 2:
-            if num_per_file is not None:
-                # Check that it's the right shape
-                if verb and data.shape[0] != num_per_file:
-                    print("Warning: Incomplete file!", datafiles[i], data.shape)
-            # Take logs
-            np.seterr(all='raise')
-            if ilog:
-                data[:, :inD][:, ilog] = np.log10(data[:, :inD][:, ilog])
-            if olog:
-                data[:, inD:][:, olog] = np.log10(data[:, inD:][:, olog])
-            # Update min/max
-            datmin = np.amin(np.vstack([datmin, data]), axis=0)
-            datmax = np.amax(np.vstack([datmax, data]), axis=0)
-            # Consider each data vector in this file
-            for j in range(data.shape[0]):
-                if np.all(data[j] == 0):
-                    if verb:
-                        print("We gotta lotta zeros here:", datafiles[i], j)
-                    continue
-                nc    += 1
-                delta  = data[j] - mean
-                mean   = mean + delta / nc
-                M2     = M2   + delta * (data[j] - mean)
-                #M2     = M2   + (nc-1) * delta**2 / nc    # alt way to calc this
-        else:
-            raise ValueError("File", datafiles[i], "has shape", data.shape,
-                             ".\nThis data format is not understood.", 
-                             "\nPlease reformat the data,",
-                             "or code this ino stats.py.")
+    up     = 0    # Counter for checking percent done
+    total  = None # Running count, mean, M2, min, and max
+
+    if partdir is not None:
+        U.make_dir(partdir)
+    args = [(foo, inD, ilog, olog, num_per_file, verb, chunk, partdir, delog) 
+            for foo in datafiles]
+    if ncores > 1:
+        pool  = mp.Pool(min(ncores, len(datafiles)))
+        parts = pool.imap(_file_stats, args)
+    else:
+        parts = map(_file_stats, args)
+
+    for i, part in enumerate(parts):
+        total = merge_partials(total, part)
         # Print status updates
-        if verb and (100*i // len(datafiles)) >= (up+1)*perc:
+        if verb and total is not None and \
+           (100*i // len(datafiles)) >= (up+1)*perc:
             up += ((100*i // len(datafiles)) - up*perc) // perc
             print(len(str(up*perc))*'-' + "----------")
             print(str(up*perc)+"% complete")
-            print("mean:", mean)
-            print("var :", M2/(nc-1))
+            print("mean:", total[1])
+            print("var :", total[2]/(total[0]-1))
             print(len(str(up*perc))*'-' + "----------")
 
+    if ncores > 1:
+        pool.close()
+        pool.join()
+
     print('-----------------------------------------')
     print('Completed mean/stdev/min/max calculations')
     print('-----------------------------------------')
+    if total is None:
+        raise ValueError("None of the data files could be read.")
+    nc, mean, M2, datmin, datmax = total[:5]
     variance = M2 / (nc - 1)
 
+    if delog:
+        return mean, variance**0.5, datmin, datmax, total[5]
     return mean, variance**0.5, datmin, datmax
 
 
 def rmse_r2(fpred, ftrue, y_mean, 
             y_std=None, y_min=None, y_max=None, scalelims=None, 
             olog=False, y_mean_delog=None, 
-            filters=None, x_vals=None, filt2um=1.0):
+            filters=None, x_vals=None, filt2um=1.0, chunk=10000, ncores=1):
     """
     Calculates the root mean squared error (RMSE) and R-squared for a data set.
     Data must be saved in .NPY file(s), and `fpred` and `ftrue` must exactly 
-    correspond.
+    correspond.  Each may be a single .NPY file with one row per case (see 
+    NN.NNModel.evaluate()), or a list of .NPY files.  Files are read `chunk` 
+    cases at a time.  If `ncores` > 1, the file pairs (or, for single files, 
+    ranges of rows) are split across worker processes, and the sums of squares 
+    of the workers are combined.
 
     Default behavior: compute RMSE/R2 for the raw predictions.
 
@@ -138,8 +526,10 @@ def rmse_r2(fpred, ftrue, y_mean,
 
     Inputs
     ------
-    fpred: list, strings. .NPY files to compute RMSE, predicted values.
-    ftrue: list, strings. .NPY files to compute RMSE, true      values.
+    fpred: string or list, strings. .NPY file(s) to compute RMSE, 
+                                    predicted values.
+    ftrue: string or list, strings. .NPY file(s) to compute RMSE, 
+                                    true      values.
     y_mean: array. Training set mean value of each output parameter.
     y_std : array. Training set standard deviation of each output parameter.
     y_min : array. Training set minimum of each output parameter.
@@ -153,6 +543,8 @@ def rmse_r2(fpred, ftrue, y_mean,
     x_vals : array.         X values corresponding to the Y values.
     filt2um: float.         Conversion factor for filter's wavelengths to 
                             microns.
+    chunk  : int.           Maximum number of cases to process at once.
+    ncores : int.           Number of worker processes.
 
     Outputs
     -------
@@ -166,142 +558,329 @@ def rmse_r2(fpred, ftrue, y_mean,
     Data will only be denormalized if y_std, y_min, y_max, scalelims, and olog 
     are all not None.
     """
-    if len(fpred) != len(ftrue):
+    metrics = Metrics(y_mean, y_std, y_min, y_max, scalelims, 
+                      olog, y_mean_delog, filters, x_vals, filt2um)
+    metrics_files(fpred, ftrue, metrics, chunk, ncores)
+    return metrics.result()
+
+
+def metrics_files(fpred, ftrue, metrics, chunk=10000, ncores=1):
+    """
+    Accumulates the RMSE/R2 sums of squares of prediction/true .NPY files 
+    into a Metrics object.  If `ncores` > 1, the file pairs (or, for single 
+    files, ranges of rows) are split across worker processes, and the sums 
+    of squares of the workers are combined exactly.
+
+    Inputs
+    ------
+    fpred  : string or list, strings. .NPY file(s) of predicted values.
+    ftrue  : string or list, strings. .NPY file(s) of true      values.
+    metrics: Metrics object. Accumulator to add the files' sums of squares to.
+    chunk  : int.  Maximum number of cases to process at once.
+    ncores : int.  Number of worker processes.
+
+    Outputs
+    -------
+    None.  `metrics` is updated; see Metrics.result().
+    """
+    if isinstance(fpred, str) and isinstance(ftrue, str):
+        fpred = [fpred]
+        ftrue = [ftrue]
+    elif len(fpred) != len(ftrue):
         raise Exception("The prediction/true file structures do not match.\n" +\
                         "Ensure that each set of files follows the same "     +\
                         "exact structure and order.\nSee NNModel.Yeval().")
 
-    # Integrate over filter bandpasses?
-    if filters is not None and x_vals is not None:
-        integ = True
-        # Load filters
-        nfilters = len(filters)
-        filttran = []
-        ifilt = np.zeros((nfilters, 2), dtype=int)
-        meanwn = []
-        for i in range(nfilters):
-            datfilt = np.loadtxt(filters[i])
-            # Convert filter wavelenths to microns, then convert um -> cm-1
-            finterp = si.interp1d(10000. / (filt2um * datfilt[:,0]), 
-                                  datfilt[:,1],
-                                  bounds_error=False, fill_value=0)
-            # Interpolate and normalize
-            tranfilt = finterp(x_vals)
-            tranfilt = tranfilt / np.trapz(tranfilt, x_vals)
-            meanwn.append(np.sum(x_vals*tranfilt)/sum(tranfilt))
-            # Find non-zero indices for faster integration
-            nonzero = np.where(tranfilt!=0)
-            ifilt[i, 0] = max(nonzero[0][ 0] - 1, 0)
-            ifilt[i, 1] = min(nonzero[0][-1] + 1, len(x_vals)-1)
-            filttran.append(tranfilt[ifilt[i,0]:ifilt[i,1]]) # Store filter
-    else:
-        integ = False
+    # Rows of each file pair, from the .NPY headers
+    pieces = []
+    for fp, ft in zip(fpred, ftrue):
+        pshape = np.load(fp, mmap_mode='r').shape
+        tshape = np.load(ft, mmap_mode='r').shape
+        if pshape != tshape:
+            raise Exception("The prediction/true files do not match.\n"    +\
+                            "Shapes: " + str(pshape) + ", " + str(tshape)  +\
+                            "\nSee NNModel.evaluate().")
+        pieces.append((fp, ft, 0, pshape[0]))
+    # Split single files into row ranges, so that each worker has a share
+    if len(pieces) < ncores:
+        pieces = [(fp, ft, beg, min(beg + step, end)) 
+                  for fp, ft, beg, end in pieces 
+                  for step in [max(chunk, int(np.ceil(end / ncores)))] 
+                  for beg in range(0, end, step)]
+    ntasks = min(ncores, len(pieces))
+    tasks  = [pieces[i::ntasks] for i in range(ntasks)]
+
+    args    = [(task, metrics, chunk) for task in tasks]
 
-    if not olog:
-        y_mean_delog = y_mean
+    # Compute RMSE & R2
+    if ntasks > 1:
+        pool    = mp.Pool(ntasks)
+        results = pool.imap_unordered(_metrics_sums, args)
     else:
-        if y_mean_delog is None:
-            raise ValueError("Must give the non-log-scaled training set mean.")
+        results = map(_metrics_sums, args)
+    for j, res in enumerate(results):
+        # Sums of squares are combined exactly
+        metrics.merge(res)
+        print("  Task "+str(j+1)+"/"+str(ntasks), end='\r')
+    print('')
+    if ntasks > 1:
+        pool.close()
+        pool.join()
+    return
 
-    if all(v is not None for v in [y_std, y_min, y_max, scalelims]) or olog:
-        denorm = True
-    else:
-        denorm = False
-
-    # Variables for computing RMSE & R2
-    n    = 0 # number of cases seen
-    mss  = 0 # Model sum of squares
-    tss  = 0 # True  sum of squares
-    rss  = 0 # Residual sum of squares -- squared error
-    if denorm:
-        mss_denorm  = 0
-        tss_denorm  = 0
-        rss_denorm  = 0
-    # By definition, R2 = 1 - rss / tss
-    # If mss + rss = tss then R2 = mss / tss
-
-    ### Helper functions to avoid repeating code
-    def squared_diffs(pred, true, y_mean):
+
+def _metrics_sums(args):
+    """
+    Helper function for multiprocessing.  Accumulates the sums of squares for 
+    the RMSE/R2 over ranges of rows of prediction/true file pairs.
+
+    Inputs
+    ------
+    args: tuple. (pieces, template, chunk), where pieces is a list of 
+                 (fpred, ftrue, beg, end), template is a Metrics object with 
+                 the inputs to use, and chunk is the maximum number of cases 
+                 to process at once.
+
+    Outputs
+    -------
+    metrics: Metrics object.  Sums of squares of `pieces`.
+    """
+    pieces, template, chunk = args
+    metrics = copy.copy(template)
+    metrics.reset()
+    for fp, ft, beg, end in pieces:
+        predstore = np.load(fp, mmap_mode='r')
+        truestore = np.load(ft, mmap_mode='r')
+        for j in range(beg, end, chunk):
+            metrics.update(predstore[j:min(j+chunk, end)], 
+                           truestore[j:min(j+chunk, end)])
+    return metrics
+
+
+def bandpass_operator(filters, x_vals, filt2um=1.0):
+    """
+    Builds the linear operator that integrates spectra over filter bandpasses.
+    Each column holds a filter's normalized transmission, interpolated to the 
+    X values, times the trapezoid-rule weights, so that integrating a batch of 
+    spectra is a single matrix product.  Operators are cached, keyed by the 
+    X values, the filter files (and their modification times), and `filt2um`.
+
+    Inputs
+    ------
+    filters: list, strings. Filter bandpasses to integrate over.
+                            Must be 2-column file: wavelength then transmission.
+    x_vals : array.         X values corresponding to the Y values.
+    filt2um: float.         Conversion factor for filter's wavelengths to 
+                            microns.
+
+    Outputs
+    -------
+    operator: sparse matrix. Shaped (outputs, filters).  
+                             Integrated values are `operator.T.dot(y.T).T` for 
+                             spectra `y` shaped (cases, outputs).
+    """
+    x_vals = np.asarray(x_vals, dtype=np.float64)
+    key    = (hashlib.md5(x_vals.tobytes()).hexdigest(), 
+              tuple([(os.path.abspath(foo), os.path.getmtime(foo)) 
+                     for foo in filters]), 
+              filt2um)
+    if key in _BANDPASS_CACHE:
+        return _BANDPASS_CACHE[key]
+
+    rows = []
+    cols = []
+    vals = []
+    for i in range(len(filters)):
+        datfilt = np.loadtxt(filters[i])
+        # Convert filter wavelenths to microns, then convert um -> cm-1
+        finterp = si.interp1d(10000. / (filt2um * datfilt[:,0]), 
+                              datfilt[:,1],
+                              bounds_error=False, fill_value=0)
+        # Interpolate and normalize
+        tranfilt = finterp(x_vals)
+        tranfilt = tranfilt / np.trapz(tranfilt, x_vals)
+        # Integrate only over the non-zero range, as before
+        nonzero = np.where(tranfilt!=0)
+        ibeg = max(nonzero[0][ 0] - 1, 0)
+        iend = min(nonzero[0][-1] + 1, len(x_vals)-1)
+        # Trapezoid-rule weights over x_vals[ibeg:iend]
+        dx = np.diff(x_vals[ibeg:iend])
+        wt = np.zeros(iend - ibeg)
+        wt[:-1] += dx / 2.
+        wt[1: ] += dx / 2.
+        rows.append(np.arange(ibeg, iend))
+        cols.append(np.full(iend - ibeg, i))
+        vals.append(wt * tranfilt[ibeg:iend])
+    operator = ssp.csc_matrix((np.concatenate(vals), 
+                               (np.concatenate(rows), np.concatenate(cols))), 
+                              shape=(len(x_vals), len(filters)))
+    _BANDPASS_CACHE[key] = operator
+    return operator
+
+
+class Metrics:
+    """
+    Accumulates the RMSE and R2 of predictions, one batch at a time.
+
+    Default behavior: compute RMSE/R2 for the raw predictions.
+
+    If y_std, y_min, y_max, scalelims, and olog are specified, 
+    it will compute RMSE/R2 for both the raw and denormalized predictions.
+
+    If filters and x_vals are specified, then the RMSE/R2 will be computed on  
+    the integrated filter bandpasses, rather than for each output parameter.
+
+    Accumulators of separate subsets of a data set can be combined via 
+    merge().
+    """
+    def __init__(self, y_mean, 
+                 y_std=None, y_min=None, y_max=None, scalelims=None, 
+                 olog=False, y_mean_delog=None, 
+                 filters=None, x_vals=None, filt2um=1.0):
+        """
+        Inputs are as in rmse_r2().
+        """
+        # Integrate over filter bandpasses?
+        if filters is not None and x_vals is not None:
+            self.integ = True
+            self.bandpass = bandpass_operator(filters, x_vals, filt2um)
+        else:
+            self.integ = False
+
+        if not olog:
+            y_mean_delog = y_mean
+        else:
+            if y_mean_delog is None:
+                raise ValueError("Must give the non-log-scaled training set " +\
+                                 "mean.")
+
+        if all(v is not None for v in [y_std, y_min, y_max, scalelims]) or olog:
+            self.denorm = True
+        else:
+            self.denorm = False
+
+        self.y_mean       = y_mean
+        self.y_std        = y_std
+        self.y_min        = y_min
+        self.y_max        = y_max
+        self.scalelims    = scalelims
+        self.olog         = olog
+        self.y_mean_delog = y_mean_delog
+        self.x_vals       = x_vals
+        if self.integ:
+            # The means do not change; integrate them only once
+            self.y_mean_integ       = self._integ(np.atleast_2d(y_mean))[0]
+            self.y_mean_delog_integ = self._integ(
+                                          np.atleast_2d(y_mean_delog))[0]
+
+        self.reset()
+
+    def reset(self):
+        """
+        Clears the sums of squares.
+        """
+        # Variables for computing RMSE & R2
+        # By definition, R2 = 1 - rss / tss
+        self.n          = 0 # number of cases seen
+        self.tss        = 0 # True  sum of squares
+        self.rss        = 0 # Residual sum of squares -- squared error
+        self.tss_denorm = 0
+        self.rss_denorm = 0
+
+    def _integ(self, y):
+        """
+        Integrates spectra, shaped (cases, outputs), over the filter bandpasses.
+        """
+        return self.bandpass.T.dot(y.T).T
+
+    def _squared_diffs(self, pred, true, y_mean):
         """
         Computes squared differences for RMSE/R2 calculations.
+        `y_mean` is already integrated when integrating over filters.
         """
-        mss   = np.sum((pred - y_mean)**2, axis=0)
+        if self.integ:
+            pred = self._integ(pred)
+            true = self._integ(true)
         tss   = np.sum((true - y_mean)**2, axis=0)
         rss   = np.sum((true - pred  )**2, axis=0)
-        return mss, tss, rss
+        return tss, rss
 
-    def integ_spec(pred, true, y_mean, x_vals, filttran, ifilt):
-        """
-        Integrates and predicted and true spectrum according to filter 
-        bandpasses.
+    def update(self, pred, true):
         """
-        nfilters = len(filttran)
-        pred_res = np.zeros((pred.shape[0], nfilters))
-        true_res = np.zeros((true.shape[0], nfilters))
-        y_mean_res = np.zeros(nfilters)
-        for i in range(nfilters):
-            pred_spec      = pred[:,ifilt[i,0]:ifilt[i,1]]
-            true_spec      = true[:,ifilt[i,0]:ifilt[i,1]]
-            xval_spec      = x_vals[ifilt[i,0]:ifilt[i,1]]
-            y_mean_spec    = y_mean[ifilt[i,0]:ifilt[i,1]]
-            pred_res[:, i] = np.trapz(pred_spec * filttran[i], xval_spec, 
-                                      axis=-1)
-            true_res[:, i] = np.trapz(true_spec * filttran[i], xval_spec, 
-                                      axis=-1)
-            y_mean_res[i]  = np.trapz(y_mean_spec * filttran[i], xval_spec)
-        return pred_res, true_res, y_mean_res
-
-    # Compute RMSE & R2
-    for j in range(len(fpred)):
-        # Load batch
-        pred  = np.load(fpred[j])
-        true  = np.load(ftrue[j])
-        # Add contributions to RMSE/R2
-        if integ:
-            pred_res, true_res, y_mean_res = integ_spec(pred, true, y_mean, x_vals, filttran, ifilt)
-            contribs = squared_diffs(pred_res, true_res, y_mean_res)
-            
-        else:
-            contribs = squared_diffs(pred, true, y_mean)
-        n    += pred.shape[0]
-        mss  += contribs[0]
-        tss  += contribs[1]
-        rss  += contribs[2]
+        Adds a batch of predicted and true values to the RMSE/R2.
 
-        if denorm:
+        Inputs
+        ------
+        pred: array. Predicted values, shaped (cases, outputs).
+        true: array. True      values, shaped (cases, outputs).
+        """
+        pred = np.asarray(pred, dtype=np.float64)
+        true = np.asarray(true, dtype=np.float64)
+        contribs  = self._squared_diffs(pred, true, 
+                                        self.y_mean_integ if self.integ 
+                                        else self.y_mean)
+        self.n   += pred.shape[0]
+        self.tss += contribs[0]
+        self.rss += contribs[1]
+
+        if self.denorm:
             # Calculate this for the denormalized values
             pred = U.denormalize(U.descale(pred, 
-                                           y_min, y_max, scalelims),
-                                 y_mean, y_std)
+                                           self.y_min, self.y_max, 
+                                           self.scalelims),
+                                 self.y_mean, self.y_std)
             true = U.denormalize(U.descale(true, 
-                                           y_min, y_max, scalelims),
-                                 y_mean, y_std)
-            if olog:
-                pred[:,olog] = 10**pred[:,olog]
-                true[:,olog] = 10**true[:,olog]
-            if integ:
-                pred_res, true_res, y_mean_res = integ_spec(pred, true, 
-                                                            y_mean_delog, 
-                                                            x_vals, 
-                                                            filttran, ifilt)
-                contribs = squared_diffs(pred_res, true_res, y_mean_res)
-            else:
-                contribs = squared_diffs(pred, true, y_mean_delog)
-            mss_denorm  += contribs[0]
-            tss_denorm  += contribs[1]
-            rss_denorm  += contribs[2]
-        print("  Batch "+str(j+1)+"/"+str(len(fpred)), end='\r')
-    print('')
-    rmse = (rss / n)**0.5
-    r2   = 1 - rss / tss
+                                           self.y_min, self.y_max, 
+                                           self.scalelims),
+                                 self.y_mean, self.y_std)
+            if self.olog:
+                pred[:,self.olog] = 10**pred[:,self.olog]
+                true[:,self.olog] = 10**true[:,self.olog]
+            contribs = self._squared_diffs(pred, true, 
+                                           self.y_mean_delog_integ 
+                                           if self.integ 
+                                           else self.y_mean_delog)
+            self.tss_denorm += contribs[0]
+            self.rss_denorm += contribs[1]
+
+    def merge(self, other):
+        """
+        Adds the sums of another Metrics object, made with the same inputs, 
+        to this one.
 
-    if denorm:
-        rmse_denorm = (rss_denorm / n)**0.5
-        r2_denorm   = 1 - rss_denorm / tss_denorm
-    else:
-        rmse_denorm = -1
-        r2_denorm   = -1
+        Inputs
+        ------
+        other: Metrics object.
+        """
+        self.n          += other.n
+        self.tss        += other.tss
+        self.rss        += other.rss
+        self.tss_denorm += other.tss_denorm
+        self.rss_denorm += other.rss_denorm
+
+    def result(self):
+        """
+        Computes the RMSE and R2 of the batches seen thus far.
+
+        Outputs
+        -------
+        rmse_norm  : array. RMSE for each parameter,   normalized data.
+        rmse_denorm: array. RMSE for each parameter, denormalized data.
+                            -1 if not denormalizing.
+        r2_norm    : array. R2   for each parameter,   normalized data.
+        r2_denorm  : array. R2   for each parameter, denormalized data.
+                            -1 if not denormalizing.
+        """
+        rmse = (self.rss / self.n)**0.5
+        r2   = 1 - self.rss / self.tss
+
+        if self.denorm:
+            rmse_denorm = (self.rss_denorm / self.n)**0.5
+            r2_denorm   = 1 - self.rss_denorm / self.tss_denorm
+        else:
+            rmse_denorm = -1
+            r2_denorm   = -1
+
+        return rmse, rmse_denorm, r2, r2_denorm
 
-    return rmse, rmse_denorm, r2, r2_denorm
-    
 
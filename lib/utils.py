@@ -7,7 +7,8 @@ limit_mem: Sets a limit on the amount of memory the program can use.
            Not currently used by MARGE.
 
 get_free_mem: Gets the amount of free memory on the system.
-              Not currently used by MARGE.
+
+get_cache: Determines how to cache a data set, based on the free memory.
 
 get_num_per_file: Calculates the number of cases per file in a data set.
                   Not currently used by MARGE.
@@ -32,14 +33,30 @@ _bytes_feature: helper function to make Feature definition
 get_file_names: Find all file names in the data directory with a given file 
                 extension.
 
+_write_examples: Helper function to write cases to a TFRecords file.
+
+_reserve_cases: Helper function to reserve cases to write across TFRecords 
+                shards.
+
+_write_TFR_shard: Helper function for writing TFRecords in parallel.
+
 make_TFRecord: Creates TFRecords representation of a data set.
 
+count_TFRecords: Counts the cases in TFRecords files.
+
 get_TFR_file_names: Loads file names of the TFRecords files.
 
+_normscale: Helper function to normalize and scale parsed TFRecords data.
+
 _parse_function: Helper function for loading TFRecords dataset objects.
 
+_parse_block_function: Helper function for loading TFRecords dataset objects 
+                       with multiple cases per record.
+
 load_TFdataset: Loads a TFRecords dataset for usage.
 
+AsyncWriter: class that runs saving tasks in a bounded background queue.
+
 """
 
 import sys, os
@@ -47,6 +64,8 @@ import resource
 import multiprocessing as mp
 import functools
 import glob
+import queue
+import threading
 import numpy as np
 import scipy.stats as ss
 import tensorflow as tf
@@ -103,6 +122,81 @@ def get_free_mem():
     return free_memory
 
 
+def get_cache(name, ncases, xlen, ylen, cache='auto', cachedir=None, 
+              reserved=0, frac=0.5, verb=1):
+    """
+    Determines how to cache a parsed data set, based on the available memory.
+
+    Inputs
+    ------
+    name    : string. Name of the data set, e.g., 'train'.  Used for the 
+                      file name of a file cache.
+    ncases  : int.    Number of cases in the data set.
+    xlen    : int.    Number of inputs.
+    ylen    : int.    Number of outputs.
+    cache   : string. Caching mode.  Options: 
+                      'auto'  : in memory, if it fits.  Else, in a file if 
+                                `cachedir` is set.  Else, no caching.
+                      'memory': in memory.
+                      'file'  : in a file in `cachedir`.
+                      'none'  : no caching.
+    cachedir: string. Path/to/directory for file caches.
+                      Ideally on a fast local disk.
+    reserved: int.    Bytes of memory already reserved by other caches.
+    frac    : float.  Fraction of the available memory that caches may use.
+    verb    : int.    Verbosity level.
+
+    Outputs
+    -------
+    cachearg: None (no caching), '' (memory), or path/to/cache file.  
+              For use with load_TFdataset().
+    nbytes  : int. Bytes of memory reserved by this cache.
+    """
+    # Parsed data is float32
+    nbytes = ncases * (xlen + ylen) * 4
+    budget = int(frac * get_free_mem() * 1024) - reserved
+    sizes  = str(nbytes // 1024**2) + ' MB needed, ' + \
+             str(max(budget, 0) // 1024**2) + ' MB available'
+    if cache == 'auto':
+        if nbytes <= budget:
+            mode   = 'memory'
+            reason = 'fits in memory (' + sizes + ')'
+        elif cachedir is not None:
+            mode   = 'file'
+            reason = 'does not fit in memory (' + sizes + ')'
+        else:
+            mode   = 'none'
+            reason = 'does not fit in memory (' + sizes + \
+                     '), and no cachedir is set'
+    elif cache in ['memory', 'file', 'none']:
+        mode   = cache
+        reason = 'requested'
+        if mode == 'memory' and nbytes > budget:
+            reason += '. WARNING: may exceed the available memory (' + \
+                      sizes + ')'
+    else:
+        raise ValueError("Invalid cache mode: " + cache + "\nAllowed " + \
+                         "options: 'auto', 'memory', 'file', or 'none'.")
+
+    if mode == 'file':
+        if cachedir is None:
+            raise ValueError("File caching requires `cachedir`.")
+        cachearg = os.path.join(cachedir, name + '.cache')
+        # Remove any stale cache from a previous run
+        for foo in glob.glob(cachearg + '*'):
+            os.remove(foo)
+        nbytes   = 0
+    elif mode == 'memory':
+        cachearg = ''
+    else:
+        cachearg = None
+        nbytes   = 0
+    if verb:
+        print("Caching the " + name + " data: " + mode + " (" + reason + ")")
+
+    return cachearg, nbytes
+
+
 def get_num_per_file(foos, nfoo=10):
     """
     Loads a few files to determine the number of entries per data file.
@@ -128,8 +222,9 @@ def get_num_per_file(foos, nfoo=10):
 def count_cases(foo):
     """
     Helper function for multiprocessing. Counts number of cases in file.
+    Only the file header is read.
     """
-    return np.load(foo).shape[0]
+    return np.load(foo, mmap_mode='r').shape[0]
 
 
 def data_set_size(foos, ncores=1):
@@ -288,10 +383,149 @@ def _bytes_feature(value):
     return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
 
 
+def _init_TFR_worker(counter):
+    """
+    Helper function for multiprocessing. Shares the counter of cases written 
+    to the TFRecords shards with each worker process.
+    """
+    global _TFR_count
+    _TFR_count = counter
+
+
+def _reserve_cases(num, ncases=None):
+    """
+    Helper function for multiprocessing.  Reserves cases to write from the 
+    total shared by all TFRecords shards.
+
+    Inputs
+    ------
+    num   : int. Number of cases to write.
+    ncases: int. Maximum number of cases to write across all shards.  
+                 If None, there is no maximum.
+
+    Outputs
+    -------
+    num: int. Number of cases reserved; the counter is increased by `num`.
+    """
+    with _TFR_count.get_lock():
+        if ncases is not None:
+            num = max(min(num, ncases - _TFR_count.value), 0)
+        _TFR_count.value += num
+    return num
+
+
+def _write_examples(writer, x, y, block=0):
+    """
+    Helper function to write cases to a TFRecords file.
+
+    Inputs
+    ------
+    writer: object. TFRecordWriter to write to.
+    x     : array.  Inputs  to write.
+    y     : array.  Outputs to write.
+    block : int.    Number of cases per record.  If 0, each case is written 
+                    as its own record.  Otherwise, the number of cases in 
+                    `x` and `y` must be a multiple of `block`.
+
+    Outputs
+    -------
+    None. Writes the records via `writer`.
+    """
+    step = max(block, 1)
+    for k in range(0, x.shape[0], step):
+        if block:
+            xk = x[k:k+block]
+            yk = y[k:k+block]
+        else:
+            xk = x[k]
+            yk = y[k]
+        # Define feature
+        feature = {'x' : _bytes_feature(tf.compat.as_bytes(xk.tostring())),
+                   'y' : _bytes_feature(tf.compat.as_bytes(yk.tostring()))}
+        # Create an example protocol buffer
+        example = tf.train.Example(features=tf.train.Features(feature=feature))
+        # Serialize to string and write on the file
+        writer.write(example.SerializeToString())
+
+
+def _write_TFR_shard(args):
+    """
+    Helper function for multiprocessing. Writes a single TFRecords shard.
+
+    Inputs
+    ------
+    args: tuple. (thisfile, files, inD, ilog, olog, batch_size, ncases, 
+          block, dtype, verb), where thisfile is the TFRecords shard to 
+          write, ncases is the maximum number of cases to write across all 
+          shards (a multiple of batch_size), and the rest are as in 
+          make_TFRecord().  Only whole batches are written.
+
+    Outputs
+    -------
+    nwrite: int.   Number of cases written to `thisfile`.
+    xleft : array. Inputs  of the cases that do not fill a batch, or None if 
+                   `ncases` has been reached.
+    yleft : array. Outputs of the cases that do not fill a batch, or None.
+    """
+    thisfile, files, inD, ilog, olog, batch_size, ncases, \
+    block, dtype, verb = args
+    if _TFR_count.value >= ncases:
+        return 0, None, None
+    writer = tf.python_io.TFRecordWriter(thisfile)
+    nwrite = 0
+    # Cases carried over to the next file to fill a batch
+    xleft  = None
+    yleft  = None
+    for foo in files:
+        x, y = L.load_data_file(foo, inD, ilog, olog)
+        # Check for NaNs
+        isnan = np.any(np.isnan(x), axis=-1) | np.any(np.isnan(y), axis=-1)
+        if np.any(isnan):
+            if verb:
+                for k in np.where(isnan)[0]:
+                    print("Nan alert!", foo, k)
+            x = x[~isnan]
+            y = y[~isnan]
+        # Convert to the storage data type, checking for overflows
+        x = x.astype(dtype, copy=False)
+        y = y.astype(dtype, copy=False)
+        isinf = np.any(np.isinf(x), axis=-1) | np.any(np.isinf(y), axis=-1)
+        if np.any(isinf):
+            if verb:
+                for k in np.where(isinf)[0]:
+                    print("Inf alert!", foo, k)
+            x = x[~isinf]
+            y = y[~isinf]
+        if xleft is not None:
+            x = np.concatenate((xleft, x))
+            y = np.concatenate((yleft, y))
+        # Only whole batches are written
+        nfull = (x.shape[0] // batch_size) * batch_size
+        # Reserve cases from the total shared by all shards
+        num = _reserve_cases(nfull, ncases)
+        _write_examples(writer, x[:num], y[:num], block)
+        nwrite += num
+        if num < nfull:
+            # Total number of cases has been reached
+            xleft = None
+            yleft = None
+            break
+        xleft = x[num:]
+        yleft = y[num:]
+    writer.close()
+    return nwrite, xleft, yleft
+
+
 def make_TFRecord(fname, files, inD, ilog, olog, 
-                  batch_size, e_batches, split=1, verb=1):
+                  batch_size, e_batches, split=1, verb=1, ncores=1, block=0, 
+                  dtype=np.float64):
     """
-    Function to write TFRecords for large data sets.
+    Function to write TFRecords for large data sets, up to an expected number 
+    of batches.  The driver prepares the TFRecords with 
+    prepare.prepare_data(), which also computes the statistics in the same 
+    pass; this function is kept for writing TFRecords on their own (e.g., 
+    benchmark.py).  Both write only whole batches, via the same shared 
+    counter (see _reserve_cases()).
 
     Inputs
     ------
@@ -304,7 +538,19 @@ def make_TFRecord(fname, files, inD, ilog, olog,
     e_batches : int. Expected number of batches to be processed.
     split: int. Determines the number of `files` to process before 
                 starting a new TFRecords file.
+                Ignored if `ncores` > 1.
     verb : int. Verbosity level.
+    ncores: int. Number of worker processes.  If > 1, each worker writes 
+                 its own TFRecords shard from a subset of `files`, and 
+                 `e_batches` * `batch_size` is enforced across all shards.
+                 The shards' cases that do not fill a batch are combined, 
+                 and their whole batches are written to one more shard.
+    block: int. Number of cases packed into each record.  
+                If 0, each case is written as its own record.
+                Must evenly divide `batch_size`.
+    dtype: data type. Data type used to store the cases.  Cases with 
+                      infinite values (e.g., that overflow `dtype`) are 
+                      dropped.
 
     Outputs
     -------
@@ -312,70 +558,149 @@ def make_TFRecord(fname, files, inD, ilog, olog,
     """
     if verb > 1:
         print("\nWriting TFRecords file...")
-
-    # Track number of files left to load
-    filesleft = len(files)
-    # Track number of cases written to TFRecord
-    N_batches = 0
-    count     = 0
-
-    for i in range(int(np.ceil(len(files)/split))):
-        # TFRecords file
-        thisfile = fname.replace('.tfrecords', '_'+str(i).zfill(3)+'.tfrecords')
-        writer = tf.python_io.TFRecordWriter(thisfile)
-        for j in range(min(split, filesleft)):
-            # Load file
-            x, y = L.load_data_file(files[i*split+j], inD, ilog, olog)
-            filesleft -= 1
-            # Print progress updates
-            if verb:
-                print(str(int(100/len(files)/split*(i + j/split))) + \
-                      "% complete", end='\r')
-            # TF is lame and requires arrays to be 1D. Write each sequentially
-            for k in range(x.shape[0]):
-                # Check for Nans
-                if np.any(np.isnan(x[k])) or np.any(np.isnan(y[k])):
-                    if verb:
-                        print("Nan alert!", files[i*split+j], k)
-                    continue
-                # Define feature
-                feature = {'x' : _bytes_feature(
-                                        tf.compat.as_bytes(x[k].tostring())),
-                           'y' : _bytes_feature(
-                                        tf.compat.as_bytes(y[k].tostring()))}
-                # Create an example protocol buffer
-                example = tf.train.Example(features=tf.train.Features(feature=
-                                                                      feature))
-                # Serialize to string and write on the file
-                writer.write(example.SerializeToString())
-                # Make sure that the TFRecord has exactly N*batch_size entries
-                count += 1
-                if count==batch_size:
-                    count      = 0
-                    N_batches += 1
-                if N_batches==e_batches:
-                    writer.close()
-                    if verb:
-                        print("100% complete")
-                    if verb > 1:
-                        print("Ended writing TFRecords to ensure " + \
-                              "N*batch_size entries.")
-                        print("Writing TFRecords file complete.")
-                    return
-        writer.close()
+    if block and batch_size % block:
+        raise ValueError("The number of cases per record (" + str(block) + \
+                         ") must evenly divide the batch size (" +          \
+                         str(batch_size) + ").")
+
+    if ncores > 1:
+        # Stripe the files across the shards to balance the load
+        nshards = min(ncores, len(files))
+        groups  = [files[i::nshards] for i in range(nshards)]
+    else:
+        groups  = [files[i*split:(i+1)*split] 
+                   for i in range(int(np.ceil(len(files)/split)))]
+    shardname = lambda i: fname.replace('.tfrecords', 
+                                        '_'+str(i).zfill(3)+'.tfrecords')
+    ncases = e_batches * batch_size
+    args = [(shardname(i), groups[i], inD, ilog, olog, batch_size, ncases, 
+             block, dtype, verb) 
+            for i in range(len(groups))]
+    # Track number of cases written to TFRecords
+    count  = mp.Value('l', 0)
+    _init_TFR_worker(count)
+    xleft  = []
+    yleft  = []
+    if ncores > 1:
+        pool = mp.Pool(len(groups), initializer=_init_TFR_worker, 
+                       initargs=(count,))
+        results = pool.imap_unordered(_write_TFR_shard, args)
+    else:
+        results = map(_write_TFR_shard, args)
+    for i, (num, xl, yl) in enumerate(results):
+        if xl is not None and xl.shape[0]:
+            xleft.append(xl)
+            yleft.append(yl)
+        # Print progress updates
+        if verb:
+            print(str(int(100*(i+1)/len(groups))) + "% complete", end='\r')
+    if ncores > 1:
+        pool.close()
+        pool.join()
+    # Write the whole batches of the shards' remaining cases
+    if len(xleft):
+        xleft = np.concatenate(xleft)
+        yleft = np.concatenate(yleft)
+        num   = _reserve_cases((xleft.shape[0] // batch_size) * batch_size, 
+                               ncases)
+        if num:
+            writer = tf.python_io.TFRecordWriter(shardname(len(groups)))
+            _write_examples(writer, xleft[:num], yleft[:num], block)
+            writer.close()
+    nwrite = count.value
     if verb:
-        print("100% complete")
+        print('')
     if verb > 1:
+        if nwrite == e_batches * batch_size:
+            print("Ended writing TFRecords to ensure N*batch_size entries.")
         print("Writing TFRecords file complete.")
-        print(N_batches, 'batches written,', e_batches, 'batches expected.')
-        print(count, 'remaining count.')
+        print(nwrite // batch_size, 'batches written,', 
+              e_batches, 'batches expected.')
+        print(nwrite % batch_size, 'remaining count.')
     return
 
 
+def count_TFRecords(files, block=0):
+    """
+    Counts the cases in TFRecords files, by reading their records.
+
+    Inputs
+    ------
+    files: list, strings. Path/to/TFRecords files.
+    block: int.  Number of cases per record.  If 0, one case per record.
+
+    Outputs
+    -------
+    ncases: int. Number of cases in `files`.
+    """
+    nrec = 0
+    for foo in files:
+        for _ in tf.python_io.tf_record_iterator(foo):
+            nrec += 1
+    return nrec * max(block, 1)
+
+
+def _normscale(x, y, 
+               x_mean=None, x_std=None, y_mean=None, y_std=None, 
+               x_min=None,  x_max=None, y_min=None,  y_max=None, 
+               scalelims=None):
+    """
+    Helper function to normalize and scale parsed TFRecords data.
+
+    Inputs
+    ------
+    x     : tensor. Parsed inputs.
+    y     : tensor. Parsed outputs.
+    Others: As in _parse_function().
+
+    Outputs
+    -------
+    x: Normalized and scaled inputs,  as float32.
+    y: Normalized and scaled outputs, as float32.
+
+    Notes
+    -----
+    Data stored at less than double precision is processed as float32.
+    """
+    if x.dtype != tf.float64:
+        x = tf.cast(x, tf.float32)
+        y = tf.cast(y, tf.float32)
+    # Parameters to process data
+    norm    = (x_mean, x_std, y_mean, y_std)
+    scaling = (x_min,  x_max, y_min,  y_max, scalelims)
+    # Set defaults if not specified
+    if any(v is None for v in norm):
+        x_mean    = 0
+        x_std     = 1
+        y_mean    = 0
+        y_std     = 1
+    if any(v is None for v in scaling):
+        x_min     = 0
+        x_max     = 1
+        y_min     = 0
+        y_max     = 1
+        scalelims = [0, 1]
+    # Match the data type of the parsed data
+    npdtype = x.dtype.as_numpy_dtype
+    x_mean, x_std, x_min, x_max = [np.asarray(v, dtype=npdtype) 
+                                   for v in [x_mean, x_std, x_min, x_max]]
+    y_mean, y_std, y_min, y_max = [np.asarray(v, dtype=npdtype) 
+                                   for v in [y_mean, y_std, y_min, y_max]]
+
+    # Normalize and scale
+    x = scale(normalize(x, x_mean, x_std), x_min, x_max, scalelims)
+    y = scale(normalize(y, y_mean, y_std), y_min, y_max, scalelims)
+
+    x = tf.cast(x, tf.float32)
+    y = tf.cast(y, tf.float32)
+
+    return x, y
+
+
 def _parse_function(proto, xlen, ylen, 
                     x_mean=None, x_std=None, y_mean=None, y_std=None, 
                     x_min=None,  x_max=None, y_min=None,  y_max=None, 
-                    scalelims=None):
+                    scalelims=None, dtype=np.float64):
     """
     Helper function for loading TFRecords
     
@@ -393,6 +718,7 @@ def _parse_function(proto, xlen, ylen,
     y_min : array.  Minima of output data.
     y_max : array.  Maxima of output data.
     scalelims: list, floats. [min, max] of range of scaled data.
+    dtype : data type. Data type of the stored data.
 
     Outputs
     -------
@@ -407,44 +733,60 @@ def _parse_function(proto, xlen, ylen,
     parsed_features = tf.parse_single_example(proto, keys_to_features)
 
     # Turn string into array
-    x = tf.decode_raw(parsed_features["x"], tf.float64)
-    y = tf.decode_raw(parsed_features["y"], tf.float64)
+    x = tf.decode_raw(parsed_features["x"], tf.as_dtype(dtype))
+    y = tf.decode_raw(parsed_features["y"], tf.as_dtype(dtype))
 
     # Make sure it has the right shape
     x = tf.reshape(x, (np.sum(xlen),))
     y = tf.reshape(y, (np.sum(ylen),))
 
-    # Parameters to process data
-    norm    = (x_mean, x_std, y_mean, y_std)
-    scaling = (x_min,  x_max, y_min,  y_max, scalelims)
-    # Set defaults if not specified
-    if any(v is None for v in norm):
-        x_mean    = 0
-        x_std     = 1
-        y_mean    = 0
-        y_std     = 1
-    if any(v is None for v in scaling):
-        x_min     = 0
-        x_max     = 1
-        y_min     = 0
-        y_max     = 1
-        scalelims = [0, 1]
+    return _normscale(x, y, x_mean, x_std, y_mean, y_std, 
+                            x_min,  x_max, y_min,  y_max, scalelims)
 
-    # Normalize and scale
-    x = scale(normalize(x, x_mean, x_std), x_min, x_max, scalelims)
-    y = scale(normalize(y, y_mean, y_std), y_min, y_max, scalelims)
 
-    x = tf.cast(x, tf.float32)
-    y = tf.cast(y, tf.float32)
+def _parse_block_function(protos, xlen, ylen, 
+                          x_mean=None, x_std=None, y_mean=None, y_std=None, 
+                          x_min=None,  x_max=None, y_min=None,  y_max=None, 
+                          scalelims=None, dtype=np.float64):
+    """
+    Helper function for loading TFRecords written with multiple cases per 
+    record.  Parses a batch of records at once.
+    
+    Inputs
+    ------
+    protos: object. Batch of serialized records from a Tensorflow Dataset.
+    Others: As in _parse_function().
 
-    return x, y
+    Outputs
+    -------
+    x: Parsed inputs,  shape (cases, xlen).
+    y: Parsed outputs, shape (cases, ylen).
+    """
+    # Define the TFRecord
+    keys_to_features = {"x" : tf.FixedLenFeature([], tf.string),
+                        "y" : tf.FixedLenFeature([], tf.string)}
+
+    # Load all records of the batch
+    parsed_features = tf.parse_example(protos, keys_to_features)
+
+    # Turn strings into arrays
+    x = tf.decode_raw(parsed_features["x"], tf.as_dtype(dtype))
+    y = tf.decode_raw(parsed_features["y"], tf.as_dtype(dtype))
+
+    # Unpack the blocks into cases
+    x = tf.reshape(x, (-1, np.sum(xlen)))
+    y = tf.reshape(y, (-1, np.sum(ylen)))
+
+    return _normscale(x, y, x_mean, x_std, y_mean, y_std, 
+                            x_min,  x_max, y_min,  y_max, scalelims)
 
 
 def load_TFdataset(files, ncores, batch_size, buffer_size, 
                    xlen, ylen, 
                    x_mean=None, x_std=None, y_mean=None, y_std=None,
                    x_min=None,  x_max=None, y_min=None,  y_max=None, 
-                   scalelims=None, shuffle=False):
+                   scalelims=None, shuffle=False, block=0, dtype=np.float64, 
+                   readers=1, interleave=1, shuffle_buffer=None, cache=None):
     """
     Builds data loading pipeline for TFRecords.
 
@@ -466,29 +808,93 @@ def load_TFdataset(files, ncores, batch_size, buffer_size,
     y_max      : array.  Maxima of output data.
     scalelims  : list, floats. [min, max] of range of scaled data.
     shuffle    : bool.         Determines whether to shuffle the order or not.
+    block      : int.   Number of cases per record.  If 0, each record 
+                        holds a single case.  See make_TFRecord().
+    dtype      : data type. Data type of the stored data.
+    readers    : int.   Number of TFRecords files to read concurrently.
+    interleave : int.   Number of consecutive records to take from each 
+                        file before cycling to the next file.
+    shuffle_buffer: int. Number of times `batch_size` to use for the 
+                         shuffle buffer.  If None, uses `buffer_size`.
+                         If shuffling, the order of the files is also 
+                         shuffled, so this can be small for data sets 
+                         split over many files.
+    cache      : string. If None, the data is re-read and re-parsed every 
+                         epoch.  Otherwise, the parsed data is cached in 
+                         memory (if '') or in the file `cache`.  
+                         See get_cache().  With `block`, the parsed blocks 
+                         are cached, and are shuffled into new batches 
+                         every epoch.
 
     Outputs
     -------
     x_data: Parsed input  data.
     y_data: Parsed output data.
     """
-    # Make dataset
-    dataset = tf.data.TFRecordDataset(files)
-    # Make static parse_function
-    parse_function = functools.partial(_parse_function, 
-                                       xlen=xlen, ylen=ylen, 
-                                       x_mean=x_mean, x_std=x_std, 
-                                       y_mean=y_mean, y_std=y_std,
-                                       x_min=x_min,   x_max=x_max, 
-                                       y_min=y_min,   y_max=y_max, 
-                                       scalelims=scalelims)
-    # Maps the parser on every filepath in the array
-    dataset = dataset.map(parse_function, num_parallel_calls=ncores)
-    # Shuffle buffer -- train in random order
+    if shuffle_buffer is None:
+        shuffle_buffer = buffer_size
+    # Make dataset of the file names
+    dataset = tf.data.Dataset.from_tensor_slices(files)
     if shuffle:
-        dataset = dataset.shuffle(buffer_size*batch_size, 
-                                  reshuffle_each_iteration=True)
-    dataset = dataset.batch(batch_size, drop_remainder=False)
+        # Random order of files, which changes each epoch
+        dataset = dataset.shuffle(len(files), reshuffle_each_iteration=True)
+    # Read `readers` files in parallel, and interleave their records
+    # Order is only deterministic when not shuffling
+    dataset = dataset.apply(tf.data.experimental.parallel_interleave(
+                                    tf.data.TFRecordDataset, 
+                                    cycle_length=readers, 
+                                    block_length=interleave, 
+                                    sloppy=shuffle))
+    if block:
+        # Make static parse_function
+        parse_function = functools.partial(_parse_block_function, 
+                                           xlen=xlen, ylen=ylen, 
+                                           x_mean=x_mean, x_std=x_std, 
+                                           y_mean=y_mean, y_std=y_std,
+                                           x_min=x_min,   x_max=x_max, 
+                                           y_min=y_min,   y_max=y_max, 
+                                           scalelims=scalelims, dtype=dtype)
+        # Shuffle buffer -- train in random order of blocks
+        if shuffle and cache is None:
+            dataset = dataset.shuffle(shuffle_buffer*batch_size//block, 
+                                      reshuffle_each_iteration=True)
+        # Gather the records of a batch, then parse them all at once
+        dataset = dataset.batch(batch_size//block, drop_remainder=False)
+        dataset = dataset.map(parse_function, num_parallel_calls=ncores)
+        if cache is not None:
+            # Cache the parsed blocks, not batches, so that the blocks are 
+            # shuffled into new batches every epoch
+            xsum = np.sum(xlen)
+            ysum = np.sum(ylen)
+            dataset = dataset.map(lambda x, y: (tf.reshape(x, (-1, block, xsum)), 
+                                                tf.reshape(y, (-1, block, ysum))))
+            dataset = dataset.apply(tf.data.experimental.unbatch())
+            dataset = dataset.cache(cache)
+            if shuffle:
+                dataset = dataset.shuffle(shuffle_buffer*batch_size//block, 
+                                          reshuffle_each_iteration=True)
+            dataset = dataset.batch(batch_size//block, drop_remainder=False)
+            dataset = dataset.map(lambda x, y: (tf.reshape(x, (-1, xsum)), 
+                                                tf.reshape(y, (-1, ysum))))
+    else:
+        # Make static parse_function
+        parse_function = functools.partial(_parse_function, 
+                                           xlen=xlen, ylen=ylen, 
+                                           x_mean=x_mean, x_std=x_std, 
+                                           y_mean=y_mean, y_std=y_std,
+                                           x_min=x_min,   x_max=x_max, 
+                                           y_min=y_min,   y_max=y_max, 
+                                           scalelims=scalelims, dtype=dtype)
+        # Maps the parser on every filepath in the array
+        dataset = dataset.map(parse_function, num_parallel_calls=ncores)
+        # Keep the parsed data after the first epoch
+        if cache is not None:
+            dataset = dataset.cache(cache)
+        # Shuffle buffer -- train in random order
+        if shuffle:
+            dataset = dataset.shuffle(shuffle_buffer*batch_size, 
+                                      reshuffle_each_iteration=True)
+        dataset = dataset.batch(batch_size, drop_remainder=False)
     dataset = dataset.repeat() # Go forever! Until fit() stops it
     dataset = dataset.prefetch(buffer_size)
 
@@ -500,3 +906,60 @@ def load_TFdataset(files, ncores, batch_size, buffer_size,
     return x_data, y_data
 
 
+
+class AsyncWriter:
+    """
+    Runs post-processing/saving tasks in a background thread, so that they 
+    overlap with the next batch's inference.  Tasks are queued in order, and 
+    at most `queue_depth` tasks wait in the queue: if the writer falls behind 
+    (e.g., slow disk), adding a task blocks until there is room.
+
+    If `queue_depth` is 0, tasks are run immediately in the calling thread.
+    """
+    def __init__(self, queue_depth=4):
+        """
+        queue_depth: int. Maximum number of tasks waiting to be run.
+        """
+        self.queue_depth = queue_depth
+        self.error       = None
+        if queue_depth > 0:
+            self.queue  = queue.Queue(maxsize=queue_depth)
+            self.thread = threading.Thread(target=self._run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def _run(self):
+        """
+        Runs queued tasks until the end signal (None) is received.
+        """
+        while True:
+            task = self.queue.get()
+            if task is None:
+                break
+            if self.error is None:
+                try:
+                    task[0](*task[1])
+                except Exception as e:
+                    # Skip the remaining tasks; raised in the main thread
+                    self.error = e
+
+    def put(self, func, *args):
+        """
+        Adds a task, `func(*args)`.  Blocks while the queue is full.
+        """
+        if self.error is not None:
+            raise self.error
+        if self.queue_depth > 0:
+            self.queue.put((func, args))
+        else:
+            func(*args)
+
+    def close(self):
+        """
+        Waits for all queued tasks to finish, and stops the thread.
+        """
+        if self.queue_depth > 0:
+            self.queue.put(None)
+            self.thread.join()
+        if self.error is not None:
+            raise self.error
@@ -0,0 +1,8 @@
+"""
+Makes the modules in lib/ importable by the tests, as MARGE.py does.
+"""
+
+import sys, os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'lib'))
@@ -0,0 +1,144 @@
+"""
+Tests of the NumPy inference engine in lib/engine.py.
+"""
+
+import json
+import pytest
+
+np = pytest.importorskip('numpy')
+
+import engine as E
+
+
+def _make_model(fname, xlen=3, ylen=4, nodes=8, seed=0):
+    # Two Dense layers, in the format written by export_npz()
+    rng    = np.random.RandomState(seed)
+    config = {'xlen'   : xlen, 'ylen' : ylen,
+              'layers' : [{'type' : 'Dense', 'activation' : 'tanh',
+                           'index' : 1, 'nweights' : 2},
+                          {'type' : 'Dense', 'activation' : 'linear',
+                           'index' : 2, 'nweights' : 2}]}
+    arrays = {'L1_0'      : rng.normal(0., 0.5, (xlen, nodes)),
+              'L1_1'      : rng.normal(0., 0.1, nodes),
+              'L2_0'      : rng.normal(0., 0.5, (nodes, ylen)),
+              'L2_1'      : rng.normal(0., 0.1, ylen),
+              'ilog'      : np.array([0]),
+              'olog'      : np.array([1, 3]),
+              'x_mean'    : rng.normal(0., 1., xlen),
+              'x_std'     : rng.uniform(0.5, 2., xlen),
+              'y_mean'    : rng.normal(0., 1., ylen),
+              'y_std'     : rng.uniform(0.5, 2., ylen),
+              'x_min'     : -np.ones(xlen) * 2,
+              'x_max'     :  np.ones(xlen) * 3,
+              'y_min'     : -np.ones(ylen),
+              'y_max'     :  np.ones(ylen) * 2,
+              'scalelims' : np.array([-1., 1.]),
+              'config'    : np.array(json.dumps(config))}
+    np.savez(fname, **arrays)
+    return fname
+
+
+@pytest.fixture
+def model(tmpdir):
+    return E.NumpyModel(_make_model(str(tmpdir.join('model.npz'))))
+
+
+def test_jacobian_matches_finite_differences(model):
+    rng = np.random.RandomState(1)
+    # Input 0 is log-scaled, so it must be positive
+    x   = np.stack([rng.uniform(0.5, 5., 6),
+                    rng.normal(0., 1., 6),
+                    rng.normal(0., 1., 6)], axis=-1)
+    y, J = model.jacobian(x, chunk=4)
+    assert y.shape == (x.shape[0], model.ylen)
+    assert J.shape == (x.shape[0], model.ylen, model.xlen)
+    assert np.allclose(y, model._postprocess(model._run(
+                                             model._preprocess(x))[0]))
+    # Central differences, in float64 as the Jacobian
+    def f(x):
+        return model._postprocess(model._run(model._preprocess(x))[0])
+    for k in range(model.xlen):
+        h  = 1e-6 * np.maximum(np.abs(x[:, k]), 1.)
+        dx = np.zeros(x.shape)
+        dx[:, k] = h
+        fd = (f(x + dx) - f(x - dx)) / (2 * h[:, None])
+        assert np.allclose(J[:, :, k], fd, rtol=1e-5, atol=1e-7)
+
+
+def test_jacobian_single_case(model):
+    x    = np.array([2., 0.3, -0.4])
+    y, J = model.jacobian(x)
+    assert y.shape == (1, model.ylen)
+    assert J.shape == (1, model.ylen, model.xlen)
+    yb, Jb = model.jacobian(np.tile(x, (5, 1)), chunk=2)
+    assert np.allclose(Jb, J)
+
+
+class _Counter:
+    # Model that records the cases it is asked to predict
+    def __init__(self):
+        self.calls = []
+    def __call__(self, x):
+        self.calls.append(x.shape[0])
+        return np.stack([x.sum(axis=-1), x.prod(axis=-1)], axis=-1)
+
+
+def test_prediction_cache_hits():
+    predict = _Counter()
+    cache   = E.PredictionCache(predict)
+    x       = np.array([[1., 2.], [3., 4.], [1., 2.]])
+    y       = cache(x)
+    assert np.allclose(y, _Counter()(x))
+    # Duplicates within a call are predicted once
+    assert predict.calls == [2]
+    y2      = cache(x[::-1])
+    assert np.allclose(y2, y[::-1])
+    assert predict.calls == [2] # No new call to the model
+    stats   = cache.stats()
+    assert stats['hits']    == 3
+    assert stats['misses']  == 3
+    assert stats['entries'] == 2
+    assert stats['hit_rate'] == 0.5
+
+
+def test_prediction_cache_quantum():
+    predict = _Counter()
+    cache   = E.PredictionCache(predict, quantum=0.1)
+    cache([[1.00, 2.00]])
+    cache([[1.01, 1.99]])
+    assert predict.calls == [1]
+    cache([[1.20, 2.00]])
+    assert predict.calls == [1, 1]
+    # Without a quantum, only exact matches hit
+    exact = E.PredictionCache(_Counter(), quantum=0.)
+    exact([[1.00, 2.00]])
+    exact([[1.01, 1.99]])
+    assert exact.stats()['hits'] == 0
+
+
+@pytest.mark.parametrize('policy', ['lru', 'fifo'])
+def test_prediction_cache_eviction(policy):
+    predict = _Counter()
+    x       = np.arange(6.).reshape(3, 2)
+    # Room for two entries: 2 outputs and a key of 2 inputs, in float64
+    cache   = E.PredictionCache(predict, maxbytes=2 * 32, policy=policy)
+    cache(x[:2])
+    cache(x[:1])        # Uses entry 0
+    cache(x[2:])        # Evicts one entry
+    stats = cache.stats()
+    assert stats['evictions'] == 1
+    assert stats['entries']   == 2
+    assert stats['bytes']     <= 2 * 32
+    ncalls = len(predict.calls)
+    cache(x[:1])
+    if policy == 'lru':
+        # Entry 0 was used last, so entry 1 was evicted
+        assert len(predict.calls) == ncalls
+    else:
+        # Entry 0 was added first, so it was evicted
+        assert len(predict.calls) == ncalls + 1
+
+
+def test_prediction_cache_invalid_policy():
+    with pytest.raises(ValueError):
+        E.PredictionCache(_Counter(), policy='random')
@@ -0,0 +1,76 @@
+"""
+Tests of the micro-batching of requests in lib/server.py.
+"""
+
+import threading
+import pytest
+
+np = pytest.importorskip('numpy')
+
+import server as SV
+
+
+def _submit_all(batcher, xs):
+    # Submits each request from its own thread, as the HTTP handlers do
+    ys      = [None] * len(xs)
+    errors  = [None] * len(xs)
+    def run(i):
+        try:
+            ys[i] = batcher.submit(xs[i])
+        except Exception as e:
+            errors[i] = e
+    threads = [threading.Thread(target=run, args=(i,))
+               for i in range(len(xs))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    return ys, errors
+
+
+def test_batcher_results_and_batching():
+    sizes = []
+    def predict(x):
+        sizes.append(x.shape[0])
+        return np.stack([x.sum(axis=-1), x[:, 0]], axis=-1)
+    batcher = SV.Batcher(predict, 3, max_batch=8, max_latency=200.)
+    rng     = np.random.RandomState(0)
+    xs      = [rng.normal(size=(rng.randint(1, 4), 3)) for i in range(20)]
+    ys, errors = _submit_all(batcher, xs)
+    assert all([err is None for err in errors])
+    # Each request gets the outputs of its own cases
+    for x, y in zip(xs, ys):
+        assert y.shape == (x.shape[0], 2)
+        assert np.allclose(y[:, 0], x.sum(axis=-1))
+        assert np.allclose(y[:, 1], x[:, 0])
+    stats = batcher.stats()
+    assert stats['requests'] == len(xs)
+    assert stats['cases']    == sum([x.shape[0] for x in xs])
+    assert stats['batches']  == len(sizes) < len(xs)
+    # A batch only exceeds max_batch by its last request
+    assert max(sizes) < 8 + 3
+
+
+def test_batcher_single_case():
+    batcher = SV.Batcher(lambda x: 2 * x, 2, max_latency=0.)
+    y = batcher.submit([1., 2.])
+    assert y.shape == (1, 2)
+    assert np.allclose(y, [[2., 4.]])
+
+
+def test_batcher_bad_shape():
+    batcher = SV.Batcher(lambda x: x, 2, max_latency=0.)
+    with pytest.raises(ValueError):
+        batcher.submit(np.zeros((4, 3)))
+    assert batcher.stats()['requests'] == 0
+
+
+def test_batcher_errors_reach_all_requests():
+    def predict(x):
+        raise RuntimeError("model failed")
+    batcher = SV.Batcher(predict, 2, max_batch=64, max_latency=200.)
+    ys, errors = _submit_all(batcher, [np.ones((1, 2))] * 5)
+    assert all([isinstance(err, RuntimeError) for err in errors])
+    # The worker keeps serving after an error
+    batcher.predict = lambda x: x + 1
+    assert np.allclose(batcher.submit(np.zeros(2)), 1.)
@@ -0,0 +1,108 @@
+"""
+Tests of the statistics functions in lib/stats.py.
+"""
+
+import os
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('scipy')
+pytest.importorskip('keras')
+
+import stats as S
+
+
+def _moments(data):
+    return data.shape[0], np.mean(data, axis=0), \
+           np.sum((data - np.mean(data, axis=0))**2, axis=0)
+
+
+def test_merge_moments_matches_direct():
+    rng  = np.random.RandomState(0)
+    data = rng.normal(3., 2., (1000, 5))
+    for split in [1, 10, 500, 999]:
+        n, mean, M2 = S.merge_moments(*_moments(data[:split]),
+                                      *_moments(data[split:]))
+        assert n == data.shape[0]
+        assert np.allclose(mean, np.mean(data, axis=0))
+        assert np.allclose(M2 / (n - 1), np.var(data, axis=0, ddof=1))
+
+
+def test_merge_moments_empty():
+    rng  = np.random.RandomState(1)
+    part = _moments(rng.normal(size=(20, 3)))
+    zero = (0, np.zeros(3), np.zeros(3))
+    for merged in [S.merge_moments(*part, *zero),
+                   S.merge_moments(*zero, *part)]:
+        assert merged[0] == part[0]
+        assert np.allclose(merged[1], part[1])
+        assert np.allclose(merged[2], part[2])
+
+
+def test_merge_moments_sequential():
+    # Merging chunk by chunk, as mean_stdev() does, is order-independent
+    rng    = np.random.RandomState(2)
+    data   = rng.lognormal(0., 3., (777, 4))
+    chunks = np.array_split(data, 13)
+    fwd    = (0, np.zeros(4), np.zeros(4))
+    rev    = (0, np.zeros(4), np.zeros(4))
+    for chunk in chunks:
+        fwd = S.merge_moments(*fwd, *_moments(chunk))
+    for chunk in chunks[::-1]:
+        rev = S.merge_moments(*rev, *_moments(chunk))
+    assert fwd[0] == rev[0] == data.shape[0]
+    assert np.allclose(fwd[1], rev[1])
+    assert np.allclose(fwd[2], rev[2])
+    assert np.allclose(fwd[2] / (fwd[0] - 1), np.var(data, axis=0, ddof=1))
+
+
+def _write_filters(tmpdir):
+    # Box and triangle bandpasses, wavelengths in microns
+    wl     = np.linspace(0.9, 1.3, 81)
+    box    = np.where((wl > 1.0) & (wl < 1.2), 1., 0.)
+    tri    = np.maximum(0., 1. - np.abs(wl - 1.1) / 0.15)
+    fnames = []
+    for name, tran in [('box.dat', box), ('tri.dat', tri)]:
+        fname = str(tmpdir.join(name))
+        np.savetxt(fname, np.stack([wl, tran], axis=-1))
+        fnames.append(fname)
+    return fnames
+
+
+def _trapz(y, x):
+    return np.sum((y[..., 1:] + y[..., :-1]) / 2. * np.diff(x), axis=-1)
+
+
+def test_bandpass_operator_matches_trapezoid(tmpdir):
+    filters = _write_filters(tmpdir)
+    x_vals  = np.linspace(7000., 12000., 501) # cm-1
+    rng     = np.random.RandomState(3)
+    spectra = rng.uniform(0.5, 1.5, (7, x_vals.size))
+    op      = S.bandpass_operator(filters, x_vals)
+    assert op.shape == (x_vals.size, len(filters))
+    integ   = op.T.dot(spectra.T).T
+    assert integ.shape == (spectra.shape[0], len(filters))
+    # Integrate each filter directly over its non-zero range
+    for i, foo in enumerate(filters):
+        datfilt  = np.loadtxt(foo)
+        tranfilt = np.interp(x_vals, 10000. / datfilt[::-1, 0],
+                             datfilt[::-1, 1], left=0., right=0.)
+        tranfilt = tranfilt / _trapz(tranfilt, x_vals)
+        nonzero  = np.where(tranfilt != 0)[0]
+        ibeg     = max(nonzero[ 0] - 1, 0)
+        iend     = min(nonzero[-1] + 1, x_vals.size - 1)
+        direct   = _trapz(spectra[:, ibeg:iend] * tranfilt[ibeg:iend],
+                          x_vals[ibeg:iend])
+        assert np.allclose(integ[:, i], direct)
+
+
+def test_bandpass_operator_cache(tmpdir):
+    filters = _write_filters(tmpdir)
+    x_vals  = np.linspace(7000., 12000., 501)
+    op      = S.bandpass_operator(filters, x_vals)
+    assert S.bandpass_operator(filters, x_vals.copy()) is op
+    assert S.bandpass_operator(filters, x_vals, filt2um=2.) is not op
+    assert S.bandpass_operator(filters, x_vals[:-1]) is not op
+    # Modified filter files are reloaded
+    os.utime(filters[0], (0, os.path.getmtime(filters[0]) + 10))
+    assert S.bandpass_operator(filters, x_vals) is not op